@@ -30,6 +30,8 @@ echo "MetaPept is running..."
 ### step 1.2 (MSFragger): before the FragPipe output transformation, remove decoy sequences from the FragPipe output 
 ### (reference.fasta - the initial reference FASTA file you used with FragPipe; reference.fasta.fas - the FASTA file which was created by FragPipe after adding decoy sequences):
 #python3 scripts/ContaminationSearch.py -fa path_to_reference.fasta -fas path_to_reference.fasta.fas -i path_to_FragPipe_output_dir/combined_peptide.tsv -o path_to_FragPipe_output_dir/combined_peptide.no_contaminant.tsv
+### if decoy and contaminant entries of the FragPipe FASTA file are marked by header prefixes, the reference FASTA file is not needed:
+#python3 scripts/ContaminationSearch.py -prefix rev_ contam_ -fas path_to_reference.fasta.fas -i path_to_FragPipe_output_dir/combined_peptide.tsv -o path_to_FragPipe_output_dir/combined_peptide.no_contaminant.tsv
 
 ### step 1.3 (MSFragger): the transformation of the MSFragger output to the MaxQuant output (msms.txt and peptides.txt)
 #python3 scripts/MSF_combiner.py -d path_to_FragPipe_output_dir/ -c path_to_FragPipe_output_dir/combined_peptide.no_contaminant.tsv
@@ -43,11 +45,13 @@ echo "MetaPept is running..."
 #python3 scripts/IMP.py -b tools/netMHCpan/Linux_x86_64 -d data/ORFs -c CDS.fasta -n nuORFdb.fasta -s input/sample_description.csv -a input/hla_alleles.csv -i input/maxquant/Peffect -o output/maxquant/Peffect
 
 ### step 2: MaxQuant/MSFragger scan validation
-#python3 scripts/scan_validation.py -a output/maxquant/Aeffect/IMP_filtered.csv -b output/maxquant/Canonical/IMP_filtered.csv -o output/maxquant/Aeffect/
-#python3 scripts/scan_validation.py -a output/maxquant/Peffect/IMP_filtered.csv -b output/maxquant/Canonical/IMP_filtered.csv -o output/maxquant/Peffect/
+### several experimental files can be validated against the canonical file in one run (one output folder per experimental file)
+#python3 scripts/scan_validation.py -a output/maxquant/Aeffect/IMP_filtered.csv output/maxquant/Peffect/IMP_filtered.csv -b output/maxquant/Canonical/IMP_filtered.csv -o output/maxquant/Aeffect/ output/maxquant/Peffect/
 
 ### step 3: combine MaxQuant/MSFragger validated files
-#python3 scripts/mq_combiner.py -s input/sample_description.csv -i output/maxquant/Aeffect/IMP_scan_validation.csv output/maxquant/Peffect/IMP_scan_validation.csv -n A_effect P_effect -o output/maxquant/mq_combined.csv
+#python3 scripts/scan_combiner.py -s input/sample_description.csv -i output/maxquant/Aeffect/IMP_scan_validation.csv output/maxquant/Peffect/IMP_scan_validation.csv -n A_effect P_effect -o output/maxquant/mq_combined.csv -db output/maxquant/mq_combined.db
+### a new experiment can be added to the combined data later (-p sets its priority, the lowest number wins)
+#python3 scripts/scan_combiner.py -s input/sample_description.csv -i output/maxquant/Neffect/IMP_scan_validation.csv -n N_effect -o output/maxquant/mq_combined.csv -db output/maxquant/mq_combined.db --update
 
 ### step 4: preparing a batch file for Peptide-PRISM
 ### default aliases for PRISM categories:
@@ -69,9 +73,9 @@ echo "MetaPept is running..."
 ### step 6.1 (optional): modification of Peptide-PRISM output without binding prediction to make it compartable with the downstream pipeline
 #python3 scripts/binding_prediction.py -i output/prism
 
-### step 6.2: combine Peptide-PRISM output including decoy peptides
-#python3 scripts/prism_combiner.py -s input/sample_description.csv -cat frameshift prio2 prio3 -i output/prism -r 2.0 -o output/prism/prism_combined.binders.csv
-#python3 scripts/prism_combiner.py -D -s input/sample_description.csv -i output/prism -o output/prism/prism_combined.decoy.csv
+### step 6.2: combine Peptide-PRISM output including decoy peptides (annotated files are read once for both outputs)
+#python3 scripts/prism_combiner.py -s input/sample_description.csv -cat frameshift prio2 prio3 -i output/prism -r 2.0 -o output/prism/prism_combined.binders.csv -decoy_o output/prism/prism_combined.decoy.csv -decoy_cat frameshift prio1 prio2 prio3
+# add --update to process only new or changed annotated files when samples are added to the project
 
 ### step 7: scan integration
 #python3 scripts/pipeline_integrator.py -s input/sample_description.csv -mq output/maxquant/mq_combined.csv -prism output/prism/prism_combined.binders.csv -o output/scan_integration.csv
@@ -85,16 +89,15 @@ echo "MetaPept is running..."
 ### to specify non-default thresholds use the command options: -alc_suff, -alc_comb, -cov_comb, -delta_comb, -alc_uni, -q_uni, -rank_uni (see README.md)
 #python3 scripts/integration_filter.py -com output/combined_scan_integration.csv -uni output/prism_unique_scan_integration.csv -o output/scan_integration.filtered.csv
 
-### step 9: searching the peptides in a FASTA file taking into account I2L modifications 
+### step 9: searching the peptides in FASTA files taking into account I2L modifications
+### all databases are searched in one run: -d NAME FASTA MODE I2L (the query peptides are read and deduplicated once)
 ### 'strict' mode prevents I2L variant searching, 'peptide' and 'protein' modes are for FASTA files with peptides and proteins respectively
 ### 'peptide' mode (only for FASTA files with peptides) implements exact match between query and target peptides
 ### 'protein' mode implements full-text search across sequences
-#python3 scripts/search_in_fasta.py -i output/scan_integration.filtered.csv -p Sequence -n HLA_atlas_WEB -f data/HLA_atlas/WEB/HLA_atlas.2020_12.HLA_I_and_HLA_IplusII.fa -t peptide -o output/scan_integration.filtered.HLA_atlas_WEB.csv
-#python3 scripts/search_in_fasta.py -i output/scan_integration.filtered.HLA_atlas_WEB.csv -p Sequence -n HLA_atlas_PRISM -f data/HLA_atlas/PRISM/HLA_atlas.Q_less_0.1__ALC_more_70__Rank_less_2.0.fasta -t peptide -o output/scan_integration.filtered.HLA_atlas_WEB_PRISM.csv
-#python3 scripts/search_in_fasta.py -strict -i output/scan_integration.filtered.HLA_atlas_WEB_PRISM.csv -p Sequence -n IEDB -f data/IEDB/epitope_table_export_1668681696.linear_peptides.fa -t peptide -o output/scan_integration.filtered.HLA_atlas_WEB_PRISM.IEDB.csv
+### the Extra database is only needed for step 10
+#python3 scripts/FastFastaSearch.py -i output/scan_integration.filtered.csv -p Sequence -k 8 14 -bloom 0.01 -d HLA_atlas_WEB data/HLA_atlas/WEB/HLA_atlas.2020_12.HLA_I_and_HLA_IplusII.fa peptide i2l -d HLA_atlas_PRISM data/HLA_atlas/PRISM/HLA_atlas.Q_less_0.1__ALC_more_70__Rank_less_2.0.fasta peptide i2l -d IEDB data/IEDB/epitope_table_export_1668681696.linear_peptides.fa peptide strict -d Extra data/proxyPhe/A375_PA_all.fasta protein i2l -o output/scan_integration.filtered.HLA_atlas_WEB_PRISM.IEDB.Extra.csv
 
 ### step 10 (optional): cryptic peptides filtering
-#python3 scripts/search_in_fasta.py -i output/scan_integration.filtered.HLA_atlas_WEB_PRISM.IEDB.csv -p Sequence -n Extra -f data/proxyPhe/A375_PA_all.fasta -t protein -o output/scan_integration.filtered.HLA_atlas_WEB_PRISM.IEDB.Extra.csv
 #python3 scripts/integration_filter.exp.py -i output/scan_integration.filtered.HLA_atlas_WEB_PRISM.IEDB.Extra.csv -o output/scan_integration.experimental.csv
 
 echo -e "\n...all tasks are completed"
@@ -4,21 +4,60 @@ __author__ = "Dmitry Malko"
 
 
 import re
+import os
+import io
 import csv
 import gzip
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import numpy as np
+from RunReport import RunReport
+
+try:  # the multithreaded pyarrow parser is optional, the C parser is used without pyarrow
+    import pyarrow
+    ENGINE = 'pyarrow'
+except ImportError:
+    ENGINE = None
 
 
 class CSV:
+    # gzip outputs are written in BGZF format: the file is a series of gzip members (blocks) up to 64 KB,
+    # so it is readable by the standard gzip tools, but the blocks can be decompressed independently.
+    # The blocks are cut at line ends and the sidecar index (<file>.idx) keeps the offsets of the blocks
+    # and the numbers of their first lines, it is used to decompress the file in parallel and to read row ranges.
+    # The index counts lines, not CSV records: a table with line breaks in its values (quoted multi-line fields)
+    # is written by write() without the index, so its row ranges are never read by wrong lines
+    _gzip_magic = b'\x1f\x8b'
+    _bgzf_block_size = 0xff00  # the maximal size of uncompressed data in BGZF block (as in htslib)
+    _bgzf_eof = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')  # the empty BGZF block
+    _index_suffix = '.idx'
+    _chunk_size = 50000  # the number of rows formatted and compressed at once by write()
+    _piece_size = 2 ** 24  # the size of text pieces compressed at once by compress()
+    _compresslevel = 6  # gzip level of write(), the default level 9 is much slower for a few percent of size
+
     @staticmethod
-    def get_delimiter(file_path):
-        sniffer = csv.Sniffer()
-        if re.search(r'.gz$', file_path):
-            with gzip.open(file_path, "rt") as f:
+    def get_compression(file_path):
+        # the compression is detected by the content, not by the file extension
+        with open(file_path, 'rb') as f:
+            return 'gzip' if f.read(2) == CSV._gzip_magic else None
+
+    # end of get_compression()
+
+    @staticmethod
+    def get_format(file_path):
+        # the delimiter and compression of the file (the header is read once)
+        compression = CSV.get_compression(file_path)
+        if compression == 'gzip':
+            with gzip.open(file_path, 'rt') as f:
                 header = f.readline()
         else:
-            with open(file_path, "rt") as f:
+            with open(file_path, 'rt') as f:
                 header = f.readline()
 
+        sniffer = csv.Sniffer()
         delimiter = sniffer.sniff(header).delimiter
         if not re.search(r'[\t, ]', header):
             delimiter = '\t'  # fix the delimiter for one column file
@@ -27,8 +66,294 @@ class CSV:
             file_name = re.sub(r'.*/', '', file_path)
             raise ValueError('Can not determine CSV delimiter for {} file'.format(file_name))
 
-        return delimiter
+        return delimiter, compression
+
+    # end of get_format()
+
+    @staticmethod
+    def get_delimiter(file_path):
+        return CSV.get_format(file_path)[0]
 
     # end of get_delimiter()
 
+    @staticmethod
+    def read(file_path, sep=None, usecols=None, rows=None, threads=None, **kwargs):
+        # the file is parsed by the multithreaded pyarrow engine with the projection of columns (usecols),
+        # the C parser is used without pyarrow or if the options or the data are not supported by pyarrow.
+        # Both parsers read floats exactly: the C parser gets float_precision='round_trip' by default
+        # (its default float parser can differ from the exact value in the last digit).
+        # rows: the range of data rows (start, stop) to read, only the blocks of the rows of the indexed BGZF files
+        # are decompressed; the whole indexed file is decompressed in the worker threads if there are several threads
+        # (one thread reads the gzip stream faster than the blocks which are decompressed at once)
+        n_bytes = os.path.getsize(file_path)
+        if sep:
+            compression = CSV.get_compression(file_path)
+        else:
+            sep, compression = CSV.get_format(file_path)
+        if callable(usecols):  # pyarrow needs the names of columns
+            columns = pd.read_csv(file_path, sep=sep, compression=compression, nrows=0).columns
+            usecols = [col for col in columns if usecols(col)]
+
+        header = kwargs.get('header', 'infer')
+        n_header = 0 if header is None else 1
+        block_index = None
+        threads = threads if threads else os.cpu_count()
+        if compression == 'gzip' and header in ['infer', 0, None] and (rows or threads > 1):  # one header line or none
+            block_index = CSV.read_block_index(file_path)
+
+        if block_index is not None:
+            n_lines = block_index['Line'].iloc[-1]
+            start, stop = (n_header + rows[0], min(n_header + rows[1], n_lines)) if rows else (n_header, n_lines)
+            text = CSV._read_lines(file_path, block_index, 0, min(n_header, n_lines), threads) + \
+                CSV._read_lines(file_path, block_index, start, max(start, stop), threads)
+            file_path, compression, n_bytes = io.BytesIO(text), None, 0  # the bytes are counted by _read_lines()
+        elif rows:
+            kwargs.update(skiprows=range(n_header, n_header + rows[0]), nrows=rows[1] - rows[0])
+
+        if ENGINE:
+            try:
+                data = pd.read_csv(file_path, sep=sep, compression=compression, usecols=usecols, engine=ENGINE,
+                                   **kwargs)
+                # missing strings are None in pyarrow output, they are NaN as in the C parser output
+                for column in data.select_dtypes(include='object').columns:
+                    if data[column].isna().all():
+                        data[column] = data[column].astype(float)
+                    elif data[column].isna().any():
+                        data[column] = data[column].where(data[column].notna(), np.nan)
+                RunReport.count(rows_in=len(data.index), bytes_read=n_bytes)
+
+                return data
+            except (ValueError, TypeError):  # unsupported options or the type inference failed on later blocks
+                if isinstance(file_path, io.BytesIO):
+                    file_path.seek(0)
+
+        kwargs.setdefault('float_precision', 'round_trip')
+        data = pd.read_csv(file_path, sep=sep, compression=compression, usecols=usecols, engine='c',
+                           low_memory=False, **kwargs)
+        RunReport.count(rows_in=len(data.index), bytes_read=n_bytes)
+
+        return data
+
+    # end of read()
+
+    @staticmethod
+    def write(data, file_path, sep='\t', index=False, header=True, mode='w', compression='infer', threads=None,
+              **kwargs):
+        # the rows are formatted and compressed to BGZF blocks by chunks in the worker threads (zlib releases GIL),
+        # the blocks are written in order with the block index (the index is kept in the append mode if it is valid).
+        # The output is the same as DataFrame.to_csv() output after decompression, the uncompressed output is written
+        # by DataFrame.to_csv() at once (the formatting holds GIL, the chunks would only add copies)
+        if compression == 'infer':
+            compression = 'gzip' if re.search(r'\.gz$', file_path) else None
+
+        n_rows = len(data.index)
+        size = os.path.getsize(file_path) if mode == 'a' and os.path.exists(file_path) else 0
+        if compression != 'gzip':
+            data.to_csv(file_path, sep=sep, index=index, header=header, mode=mode, compression=None, **kwargs)
+            RunReport.count(rows_out=n_rows, bytes_written=os.path.getsize(file_path) - size)
+            return file_path
+
+        starts = range(0, n_rows, CSV._chunk_size) if n_rows else [0]
+        multiline_chunks = []  # the chunks with more lines than rows
+
+        def format_chunk(i):
+            chunk = data.iloc[starts[i]:starts[i] + CSV._chunk_size]
+            text = chunk.to_csv(None, sep=sep, index=index, header=header if i == 0 else False, **kwargs).encode()
+            if text.count(b'\n') != len(chunk.index) + (1 if header and i == 0 else 0):
+                multiline_chunks.append(i)
+
+            return CSV._bgzf_blocks(text)
+
+        CSV._write_bgzf(file_path, mode, CSV._imap(format_chunk, range(len(starts)), threads),
+                        lambda: not len(multiline_chunks))
+        RunReport.count(rows_out=n_rows, bytes_written=os.path.getsize(file_path) - size)
+
+        return file_path
+
+    # end of write()
+
+    @staticmethod
+    def compress(input_file, output_file, threads=None):
+        # a text file is compressed to BGZF with the block index (a missing line end is added to the last line)
+        def read_pieces():
+            rest = b''
+            with open(input_file, 'rb') as f:
+                for piece in iter(lambda: f.read(CSV._piece_size), b''):
+                    piece = rest + piece
+                    cut = piece.rfind(b'\n') + 1
+                    rest = piece[cut:]
+                    if cut:
+                        yield piece[:cut]
+            if rest:
+                yield rest + b'\n'
+
+        CSV._write_bgzf(output_file, 'w', CSV._imap(CSV._bgzf_blocks, read_pieces(), threads))
+        RunReport.count(bytes_read=os.path.getsize(input_file), bytes_written=os.path.getsize(output_file))
+
+        return output_file
+
+    # end of compress()
+
+    @staticmethod
+    def read_block_index(file_path):
+        # the index of BGZF blocks (Offset, Line), the last record is the offset of the EOF block and the number
+        # of lines; the index is not valid (None) if it is missing or the data file was changed after the index
+        index_file = file_path + CSV._index_suffix
+        if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(file_path):
+            return None
+
+        block_index = pd.read_csv(index_file, sep='\t')
+        if not len(block_index.index) or \
+                block_index['Offset'].iloc[-1] + len(CSV._bgzf_eof) != os.path.getsize(file_path):
+            return None
+
+        return block_index
+
+    # end of read_block_index()
+
+    @staticmethod
+    def get_row_count(file_path):
+        # the number of data rows of the indexed BGZF file with one header line (None without the index)
+        block_index = CSV.read_block_index(file_path)
+        if block_index is None:
+            return None
+
+        return max(block_index['Line'].iloc[-1] - 1, 0)
+
+    # end of get_row_count()
+
+    @staticmethod
+    def _imap(function, items, threads=None):
+        # the ordered map in the worker threads, only a limited number of results is kept in memory
+        threads = threads if threads else os.cpu_count()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = deque()
+            for item in items:
+                futures.append(executor.submit(function, item))
+                if len(futures) >= 2 * threads:
+                    yield futures.popleft().result()
+
+            while len(futures):
+                yield futures.popleft().result()
+
+    # end of _imap()
+
+    @staticmethod
+    def _bgzf_block(data):
+        # the gzip member with the BGZF extra field `BC` (the size of the block - 1)
+        compressor = zlib.compressobj(CSV._compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        cdata = compressor.compress(data) + compressor.flush()
+        header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+
+        return header + cdata + struct.pack('<II', zlib.crc32(data), len(data))
+
+    # end of _bgzf_block()
+
+    @staticmethod
+    def _bgzf_blocks(text):
+        # the text is cut at line ends into BGZF blocks: (block, the number of line ends, it starts a line),
+        # only a line longer than a block is split over several blocks
+        blocks = []
+        start = 0
+        line_start = True
+        while start < len(text):
+            end = min(start + CSV._bgzf_block_size, len(text))
+            cut = text.rfind(b'\n', start, end) + 1 if end < len(text) else end
+            if cut <= start:
+                cut = end
+            piece = text[start:cut]
+            blocks.append((CSV._bgzf_block(piece), piece.count(b'\n'), line_start))
+            line_start = piece.endswith(b'\n')
+            start = cut
+
+        return blocks
+
+    # end of _bgzf_blocks()
+
+    @staticmethod
+    def _write_bgzf(file_path, mode, block_lists, is_indexed=None):
+        # is_indexed() tells after the blocks are written if their lines are rows (all blocks are indexed by default)
+        offset = 0
+        line = 0
+        entries = []
+        if mode == 'a' and os.path.exists(file_path):
+            block_index = CSV.read_block_index(file_path)
+            if block_index is not None:  # the new blocks overwrite the EOF block
+                offset = block_index['Offset'].iloc[-1]
+                line = block_index['Line'].iloc[-1]
+                entries = list(block_index.itertuples(index=False, name=None))[:-1]
+            else:  # the blocks are appended, but the rows can't be indexed
+                offset = os.path.getsize(file_path)
+                entries = None
+
+        with open(file_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            for blocks in block_lists:
+                for block, n_lines, line_start in blocks:
+                    if line_start and entries is not None:
+                        entries.append((offset, line))
+                    f.write(block)
+                    offset += len(block)
+                    line += n_lines
+            f.write(CSV._bgzf_eof)
+            f.truncate()
+
+        index_file = file_path + CSV._index_suffix
+        if is_indexed is not None and not is_indexed():
+            entries = None
+        if entries is not None:
+            entries.append((offset, line))
+            pd.DataFrame(entries, columns=['Offset', 'Line']).to_csv(index_file, sep='\t', index=False)
+        elif os.path.exists(index_file):
+            os.remove(index_file)
+
+    # end of _write_bgzf()
+
+    @staticmethod
+    def _bgzf_decompress(data):
+        # the blocks are found by their sizes in the headers (BSIZE of `BC` extra field)
+        view = memoryview(data)
+        pieces = []
+        pos = 0
+        while pos < len(view):
+            size = struct.unpack_from('<H', view, pos + 16)[0] + 1
+            pieces.append(zlib.decompress(view[pos + 18:pos + size - 8], -zlib.MAX_WBITS))
+            pos += size
+
+        return b''.join(pieces)
+
+    # end of _bgzf_decompress()
+
+    @staticmethod
+    def _read_lines(file_path, block_index, start, stop, threads=None):
+        # the lines [start, stop) of the indexed BGZF file, the blocks are decompressed by parts in the worker threads
+        if stop <= start:
+            return b''
+
+        threads = threads if threads else os.cpu_count()
+        offsets = block_index['Offset'].to_numpy()
+        lines = block_index['Line'].to_numpy()
+        first = np.searchsorted(lines, start, side='right') - 1
+        last = np.searchsorted(lines, stop, side='left')
+        bounds = np.unique(np.linspace(first, last, min(last - first, 4 * threads) + 1).astype(int))
+
+        with open(file_path, 'rb') as f:
+            f.seek(offsets[first])
+            data = memoryview(f.read(offsets[last] - offsets[first]))
+        RunReport.count(bytes_read=len(data))
+        parts = [data[offsets[a] - offsets[first]:offsets[b] - offsets[first]] for a, b in zip(bounds, bounds[1:])]
+        text = b''.join(CSV._imap(CSV._bgzf_decompress, parts, threads))
+
+        # the lines before start and after stop in the first and last blocks are cut off
+        begin = 0
+        for _ in range(start - lines[first]):
+            begin = text.index(b'\n', begin) + 1
+        end = len(text)
+        for _ in range(lines[last] - stop):
+            end = text.rindex(b'\n', 0, end - 1) + 1
+
+        return text[begin:end]
+
+    # end of _read_lines()
+
 # end of class CSV
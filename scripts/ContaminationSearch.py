@@ -7,39 +7,147 @@ __author__ = "Dmitry Malko"
 
 import argparse
 import re
+import os
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
 from Bio import SeqIO
-from FastFastaSearch import FastaSearch
+from CSVtools import CSV
+from FastFastaSearch import FastaCache, ProteomeStore, KmerIndex
+from RunReport import RunReport
 
 
 class ContSearch:
-    _sqlite_file_default = ':memory:'
     _decoy_column_name = 'Contaminant'
 
-    def __init__(self, ref_fasta_file, msfragg_fasta_file, db_file=None):
-        self._db_file = db_file if db_file else self._sqlite_file_default
-        self._ref_headers = set()
-        self._cont_fasta = None
-
-        with open(ref_fasta_file) as fasta_handle:
-            for header, seq in SeqIO.FastaIO.SimpleFastaParser(fasta_handle):
-                self._ref_headers.add(header)
+    # the contaminant index is cached next to the MSFragger FASTA file in a directory with the contaminant entries
+    # (contaminant.fas), their proteome store and the k-mer index of all positions (k-mers of any length are found)
+    _cache_suffix = '.contaminant.'
+    _cont_fasta_name = 'contaminant.fas'
+    _store_name = 'store'
+    _index_name = 'kmer'
+    _key_file = 'fasta_key.npy'  # the sizes and modification times of the FASTA files (see FastaCache)
 
+    def __init__(self, ref_fasta_file, msfragg_fasta_file, prefixes=None):
         if not re.search(r'\.fas$', msfragg_fasta_file):
             raise ValueError('ERROR: wrong input file name ({}), the file extension must be `.fas`'.format(msfragg_fasta_file))
 
-        self._cont_fasta = re.sub(r'\.fas$', '.contaminant.fas', msfragg_fasta_file)
-        with open(msfragg_fasta_file, 'r') as fasta_handle:
-            with open(self._cont_fasta, 'wt') as cont_handler:
-                for header, seq in SeqIO.FastaIO.SimpleFastaParser(fasta_handle):
-                    if header not in self._ref_headers:
-                        cont_handler.write(''.join(['>', header, '\n', seq, '\n']))
+        if not prefixes and ref_fasta_file is None:
+            raise ValueError('ERROR: the reference FASTA file or header prefixes must be specified')
+
+        cache_dir = self.get_cache_dir(ref_fasta_file, msfragg_fasta_file, prefixes)
+        fasta_key = FastaCache.get_key(*([msfragg_fasta_file] if prefixes else [ref_fasta_file, msfragg_fasta_file]))
+        valid_dirs = [path for path in [cache_dir, self.get_cache_tmp_dir(cache_dir)] if
+                      self._is_valid(path, fasta_key)]
+        if len(valid_dirs):
+            cache_dir = valid_dirs[0]
+            print('using the cached contaminant index {}'.format(cache_dir))
+        else:
+            cache_dir = self._create_cache(ref_fasta_file, msfragg_fasta_file, prefixes, cache_dir, fasta_key)
+
+        self._cont_fasta = os.path.join(cache_dir, self._cont_fasta_name)
+        self._store = ProteomeStore(os.path.join(cache_dir, self._store_name))
+        self._index_dir = os.path.join(cache_dir, self._index_name)
 
     # end of __init__()
 
+    @classmethod
+    def get_cache_dir(cls, ref_fasta_file, msfragg_fasta_file, prefixes=None):
+        # one cache for the pair of FASTA files (or the FASTA file and the prefixes): it is rebuilt in place
+        # when the sizes or modification times of the files are changed, so old caches are not piled up
+        key = [None if prefixes else os.path.abspath(ref_fasta_file), os.path.abspath(msfragg_fasta_file),
+               sorted(prefixes) if prefixes else None]
+        digest = hashlib.md5(repr(key).encode()).hexdigest()[:16]
+
+        return re.sub(r'\.fas$', '', msfragg_fasta_file) + cls._cache_suffix + digest
+
+    # end of get_cache_dir()
+
+    @staticmethod
+    def get_cache_tmp_dir(cache_dir):
+        # the cache in the temporary directory if the directory of the MSFragger FASTA file is read-only
+        digest = hashlib.md5(os.path.abspath(cache_dir).encode()).hexdigest()[:16]
+
+        return os.path.join(tempfile.gettempdir(), 'contaminant_index_' + digest)
+
+    # end of get_cache_tmp_dir()
+
+    @classmethod
+    def _is_valid(cls, cache_dir, fasta_key):
+        try:  # the key file is the last one to be written
+            return np.array_equal(np.load(os.path.join(cache_dir, cls._key_file)), fasta_key)
+        except (OSError, ValueError):
+            return False
+
+    # end of _is_valid()
+
+    def _create_cache(self, ref_fasta_file, msfragg_fasta_file, prefixes, cache_dir, fasta_key):
+        # the index is built in a temporary directory which replaces the cache directory at the end (see FastaCache),
+        # so an interrupted run leaves no cache
+        def write(tmp_dir):
+            cont_fasta = os.path.join(tmp_dir, self._cont_fasta_name)
+            if prefixes:  # contaminant and decoy entries are recognized by the header prefix
+                header_prefixes = tuple(prefixes)
+                is_contaminant = lambda header: header.startswith(header_prefixes)
+            else:  # the entries which are absent in the reference FASTA file
+                ref_headers = set()
+                with open(ref_fasta_file) as fasta_handle:
+                    for header, seq in SeqIO.FastaIO.SimpleFastaParser(fasta_handle):
+                        ref_headers.add(header)
+                is_contaminant = lambda header: header not in ref_headers
+
+            with open(msfragg_fasta_file, 'r') as fasta_handle:
+                with open(cont_fasta, 'wt') as cont_handler:
+                    for header, seq in SeqIO.FastaIO.SimpleFastaParser(fasta_handle):
+                        if is_contaminant(header):
+                            cont_handler.write(''.join(['>', header, '\n', seq, '\n']))
+
+            store = ProteomeStore.create(cont_fasta, os.path.join(tmp_dir, self._store_name))
+            KmerIndex(1, 1).build(store).save(os.path.join(tmp_dir, self._index_name))
+            np.save(os.path.join(tmp_dir, self._key_file), fasta_key)
+
+        try:
+            return FastaCache.save(cache_dir, write, is_dir=True)
+        except OSError:  # the directory is read-only
+            return FastaCache.save(self.get_cache_tmp_dir(cache_dir), write, is_dir=True)
+
+    # end of _create_cache()
+
+    def search(self, peptides):
+        # vectorized search of all peptides by the k-mer index of the contaminant entries,
+        # the hits are in the same format as FastaSearch.db_search(): PEPTIDE_POS/LENGTH:ID joined by ','
+        peptides = pd.Series(peptides, dtype=object).dropna().drop_duplicates()
+        peptides = peptides[peptides.str.len() > 0].to_numpy()
+        if not len(peptides):
+            return {}
+
+        kmer_index = KmerIndex(1, max([len(pep) for pep in peptides])).load(self._index_dir, self._store)
+        query_index, seq_index, offsets = kmer_index.search(peptides)
+
+        # the first position of the peptide in each entry, the entries in the order of the FASTA file
+        hits = pd.DataFrame({'Row': query_index, 'Seq_index': seq_index, 'Offset': offsets})
+        hits = hits.groupby(['Row', 'Seq_index'], sort=True)['Offset'].min().reset_index()
+        rows, seq_index = hits['Row'].to_numpy(), hits['Seq_index'].to_numpy()
+        hits['Hit'] = (pd.Series(peptides[rows]) + '_' + (hits['Offset'] + 1).astype(str) + '/' +
+                       self._store.lengths[seq_index].astype(str) + ':' + self._store.ids[seq_index].astype(str))
+        hits = hits.groupby('Row', sort=True)['Hit'].agg(','.join)
+
+        return dict(zip(peptides[hits.index.to_numpy()], hits.to_numpy()))
+
+    # end of search()
+
     def filter(self, input_name, seq_column_name, keep_decoy=False):
-        search_engine = FastaSearch(self._db_file)
-        search_engine.set_db(self._cont_fasta, true_match=False)
-        data = search_engine.db_search(input_name, seq_column_name, self._decoy_column_name, i2l_mode=False)
+        if isinstance(input_name, str):  # if the input is a file name
+            data = CSV.read(input_name)
+        else:
+            data = input_name
+
+        if seq_column_name not in data.columns:
+            raise ValueError('ERROR: there is no column {} in the input data'.format(seq_column_name))
+
+        hits = self.search(data[seq_column_name])
+        data[self._decoy_column_name] = data[seq_column_name].map(hits).fillna('')
         if not keep_decoy:  # remove Decoy sequences from the output file
             data = data[data[self._decoy_column_name].str.len() == 0]
 
@@ -50,14 +158,15 @@ class ContSearch:
 
 def main():
     parser = argparse.ArgumentParser(description='A script for the search of contaminated data in MSFragger outputs.')
-    parser.add_argument('-fa', required=True, help='reference FASTA file for MSFragger')
+    parser.add_argument('-fa', required=False, help='reference FASTA file for MSFragger (not used with `-prefix`)')
     parser.add_argument('-fas', required=True, help='contaminated FASTA file from MSFragger')
     parser.add_argument('-i', required=True, help='CSV file with peptide sequences to remove contamination')
     parser.add_argument('-o', default='output.csv', required=False, help='output file')
     parser.add_argument('-p', default='Peptide Sequence', required=False,
                         help='query column with peptide sequences in the input CSV file')
-    parser.add_argument('-db', required=False,
-                        help='database file (if not specified, the data will be stored in memory')
+    parser.add_argument('-prefix', nargs='+', required=False,
+                        help='header prefixes of contaminant and decoy entries in the FASTA file from MSFragger '
+                             '(for example: rev_ contam_); the reference FASTA file is not needed in this mode')
     parser.add_argument('-k', action='store_true', help='keep `Decoy` sequences in the output file')
 
     args = parser.parse_args()
@@ -66,15 +175,20 @@ def main():
     input_file = args.i
     output_file = args.o
     seq_column_name = args.p
-    db_file = args.db
+    prefixes = args.prefix
     keep_decoy = args.k
 
+    RunReport.start('ContaminationSearch', output_file)
     try:
-        search_engine = ContSearch(fa_file, fas_file, db_file)
-        data = search_engine.filter(input_file, seq_column_name, keep_decoy)
-        data.to_csv(output_file, sep='\t', index=False)
+        with RunReport.section('contaminant index'):
+            search_engine = ContSearch(fa_file, fas_file, prefixes)
+        with RunReport.section('search'):
+            data = search_engine.filter(input_file, seq_column_name, keep_decoy)
+        with RunReport.section('write'):
+            CSV.write(data, output_file)
     except Exception as err:
         print('Something went wrong: {}'.format(err))
+        RunReport.error(err)
     else:
         print('Contamination clean up: done')
 
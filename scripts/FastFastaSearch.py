@@ -10,11 +10,592 @@ import re
 import os
 import sys
 import csv
+import mmap
+import pickle
+import shutil
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import sqlite3
 from Bio import SeqIO
 from CSVtools import CSV
+from PeptideDict import PeptideDict
+from RunReport import RunReport
+
+
+class FastaCache:
+    # the caches of a FASTA file are written to a temporary name beside the cache and renamed at the end,
+    # so an interrupted run leaves no partial cache and the files mapped by other processes are never rewritten.
+    # a cache is valid for the FASTA file of the same size and modification time (in nanoseconds)
+
+    @staticmethod
+    def get_key(*fasta_file_names):
+        stats = [os.stat(fasta_file_name) for fasta_file_name in fasta_file_names]
+        return np.array([value for stat in stats for value in [stat.st_size, stat.st_mtime_ns]], dtype=np.int64)
+
+    # end of get_key()
+
+    @classmethod
+    def is_valid(cls, key_file, fasta_file_name, key_name=None):
+        # the key is kept in a .npy file or as the key_name array of a .npz file
+        try:
+            key = np.load(key_file)
+            if key_name is not None:
+                with key:
+                    key = key[key_name]
+            return np.array_equal(key, cls.get_key(fasta_file_name))
+        except (OSError, ValueError, KeyError):  # the cache is absent, incomplete or has no key
+            return False
+
+    # end of is_valid()
+
+    @staticmethod
+    def save(path, write, is_dir=False):
+        # write(tmp_path) writes the cache, the temporary name is specific for the process
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        try:
+            if is_dir:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                os.makedirs(tmp_path)
+            write(tmp_path)
+
+            if os.path.isdir(path):  # a directory can't replace a non-empty one: the old one is moved away first
+                old_path = '{}.old{}'.format(path, os.getpid())
+                os.replace(path, old_path)
+                shutil.rmtree(old_path, ignore_errors=True)
+            os.replace(tmp_path, path)
+        except BaseException:  # no partial cache is left
+            if is_dir:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return path
+
+    # end of save()
+
+# end of class FastaCache
+
+
+class ProteomeStore:
+    # a binary copy of a FASTA file: the sequences are concatenated with separators into one file
+    # which is memory-mapped (it is shared between processes without copying),
+    # IDs, headers, start positions and lengths of the sequences are kept in NumPy arrays
+    _separator = b'\n'
+    _files = ['starts', 'lengths', 'ids', 'headers']
+    _key_file = 'fasta_key.npy'  # the size and modification time of the FASTA file (see FastaCache)
+
+    def __init__(self, store_dir):
+        self._store_dir = store_dir
+        with open(os.path.join(store_dir, 'sequences.bin'), 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.residues = np.frombuffer(self._mmap, dtype=np.uint8)
+        for name in self._files:
+            setattr(self, name, np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r'))
+
+    # end of __init__()
+
+    @staticmethod
+    def get_store_dir(fasta_file_name):
+        return fasta_file_name + '.store'
+
+    # end of get_store_dir()
+
+    @staticmethod
+    def get_store_tmp_dir(fasta_file_name):
+        # one store for each FASTA file in the temporary directory if the FASTA directory is read-only
+        digest = hashlib.md5(os.path.abspath(fasta_file_name).encode()).hexdigest()[:16]
+
+        return os.path.join(tempfile.gettempdir(), 'proteome_store_' + digest)
+
+    # end of get_store_tmp_dir()
+
+    @classmethod
+    def create(cls, fasta_file_name, store_dir):
+        FastaCache.save(store_dir, lambda tmp_dir: cls._write(fasta_file_name, tmp_dir), is_dir=True)
+
+        return cls(store_dir)
+
+    # end of create()
+
+    @classmethod
+    def _write(cls, fasta_file_name, store_dir):
+        key = FastaCache.get_key(fasta_file_name)  # before reading: a FASTA file changed meanwhile is not valid
+        ids, headers, lengths = [], [], []
+        with open(fasta_file_name) as fasta_handle:
+            with open(os.path.join(store_dir, 'sequences.bin'), 'wb') as seq_handle:
+                for header, seq in SeqIO.FastaIO.SimpleFastaParser(fasta_handle):
+                    # the same as re.sub(r'^(\S+).*', r'\1', header)
+                    ids.append(header.split(None, 1)[0] if len(header) and not header[0].isspace() else header)
+                    headers.append(header)
+                    lengths.append(len(seq))
+                    seq_handle.write(seq.encode('ascii', errors='replace') + cls._separator)
+                if not len(lengths):  # an empty file can't be memory-mapped
+                    seq_handle.write(cls._separator)
+        RunReport.count(bytes_read=os.path.getsize(fasta_file_name))
+
+        lengths = np.array(lengths, dtype=np.int64)
+        starts = np.cumsum(lengths + 1) - lengths - 1
+        np.save(os.path.join(store_dir, 'starts.npy'), starts)
+        np.save(os.path.join(store_dir, 'lengths.npy'), lengths)
+        np.save(os.path.join(store_dir, 'ids.npy'), np.array(ids, dtype=str))
+        np.save(os.path.join(store_dir, 'headers.npy'), np.array(headers, dtype=str))
+        np.save(os.path.join(store_dir, cls._key_file), key)
+
+    # end of _write()
+
+    @classmethod
+    def from_fasta(cls, fasta_file_name, store_dir=None):
+        # the store is created once and reused while the FASTA file has the same size and modification time
+        store_dir = store_dir if store_dir else cls.get_store_dir(fasta_file_name)
+        tmp_dir = cls.get_store_tmp_dir(fasta_file_name)
+        for path in [store_dir, tmp_dir]:
+            if FastaCache.is_valid(os.path.join(path, cls._key_file), fasta_file_name):
+                return cls(path)
+
+        try:
+            return cls.create(fasta_file_name, store_dir)
+        except OSError:  # the store is created in the temporary directory if the FASTA directory is read-only
+            return cls.create(fasta_file_name, tmp_dir)
+
+    # end of from_fasta()
+
+    def __len__(self):
+        return len(self.starts)
+
+    # end of __len__()
+
+    def get_sequence(self, i, start=0, end=None):
+        end = self.lengths[i] if end is None else min(end, self.lengths[i])
+        return self._mmap[self.starts[i] + start:self.starts[i] + end].decode('ascii')
+
+    # end of get_sequence()
+
+    def sequences(self):
+        for i in range(len(self)):
+            yield self.get_sequence(i)
+
+    # end of sequences()
+
+    def find(self, peptide):
+        # all occurrences of the peptide: (sequence number, position in the sequence)
+        pattern = peptide.encode('ascii')
+        positions = []
+        pos = self._mmap.find(pattern)
+        while pos >= 0:
+            positions.append(pos)
+            pos = self._mmap.find(pattern, pos + 1)
+
+        positions = np.array(positions, dtype=np.int64)
+        seq_index = np.searchsorted(self.starts, positions, side='right') - 1
+
+        return seq_index, positions - self.starts[seq_index]
+
+    # end of find()
+
+    def to_dataframe(self, columns=('ID', 'Sequence', 'Header')):
+        return pd.DataFrame({columns[0]: self.ids, columns[1]: list(self.sequences()), columns[2]: self.headers})
+
+    # end of to_dataframe()
+
+# end of class ProteomeStore
+
+
+def make_residue_lut(il_collapse=False):
+    # residue codes: 1-26 for letters, 27 for other symbols and 0 for the separator of sequences
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[1:] = 27
+    lut[ord(ProteomeStore._separator)] = 0
+    for i, aa in enumerate('ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
+        lut[ord(aa)] = lut[ord(aa.lower())] = i + 1
+    if il_collapse:
+        lut[ord('I')] = lut[ord('i')] = lut[ord('L')]
+
+    return lut
+
+# end of make_residue_lut()
+
+
+class KmerIndex:
+    # all k-mers of the proteome packed into 64-bit codes (5 bits per residue) and sorted,
+    # a peptide is found by a range search over the codes which start with its residues.
+    # only 12 residues fit into a code: the rest of longer peptides is verified by the proteome store
+    _bits = 5
+    _width = 12
+    _key_file = ProteomeStore._key_file
+
+    def __init__(self, min_len=8, max_len=14, il_collapse=False):
+        self.min_len = min_len
+        self.max_len = max_len
+        self.il_collapse = il_collapse
+
+        self._lut = make_residue_lut(il_collapse)
+
+        self._store = None
+        self._codes = None  # sorted codes
+        self._positions = None  # positions of the codes in the proteome store
+
+    # end of __init__()
+
+    def get_index_dir(self, fasta_file_name):
+        return '{}.kmer{}-{}{}'.format(fasta_file_name, self.min_len, self.max_len, '.il' if self.il_collapse else '')
+
+    # end of get_index_dir()
+
+    def build(self, store):
+        self._store = store
+        residues = np.append(self._lut[store.residues], np.zeros(self._width, dtype=np.uint8))
+
+        n_pos = len(store.residues)
+        codes = np.zeros(n_pos, dtype=np.uint64)
+        for i in range(self._width):
+            codes = (codes << np.uint64(self._bits)) | residues[i:i + n_pos].astype(np.uint64)
+
+        # only positions with at least min_len residues before the end of the sequence are indexed
+        separators = np.flatnonzero(residues[:n_pos] == 0)
+        next_separator = separators[np.searchsorted(separators, np.arange(n_pos))]
+        positions = np.flatnonzero(next_separator - np.arange(n_pos) >= self.min_len)
+
+        order = np.argsort(codes[positions], kind='stable')
+        positions = positions[order]
+        self._codes = codes[positions]
+        self._positions = positions.astype(np.uint32 if n_pos < 2 ** 32 else np.int64)
+
+        return self
+
+    # end of build()
+
+    def save(self, index_dir, fasta_key=None):
+        def write(tmp_dir):
+            for name in ['codes', 'positions']:
+                np.save(os.path.join(tmp_dir, name + '.npy'), getattr(self, '_' + name))
+            if fasta_key is not None:
+                np.save(os.path.join(tmp_dir, self._key_file), fasta_key)
+
+        return FastaCache.save(index_dir, write, is_dir=True)
+
+    # end of save()
+
+    def load(self, index_dir, store):
+        # the arrays are memory-mapped: the index is shared between processes by the OS page cache
+        self._store = store
+        for name in ['codes', 'positions']:
+            setattr(self, '_' + name, np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r'))
+
+        return self
+
+    # end of load()
+
+    def set_fasta(self, fasta_file_name, store):
+        # the index is a cache next to the FASTA file, it is reused while the FASTA file is the same (see FastaCache)
+        index_dir = self.get_index_dir(fasta_file_name)
+        if FastaCache.is_valid(os.path.join(index_dir, self._key_file), fasta_file_name):
+            return self.load(index_dir, store)
+
+        fasta_key = FastaCache.get_key(fasta_file_name)
+        self.build(store)
+        try:
+            self.save(index_dir, fasta_key)
+        except OSError:  # the index is used from memory if it can't be saved
+            pass
+
+        return self
+
+    # end of set_fasta()
+
+    def is_indexed(self, peptides):
+        peptides = pd.Series(peptides, dtype=object)
+
+        return peptides.str.len().between(self.min_len, self.max_len) & peptides.str.fullmatch('[A-Z]+')
+
+    # end of is_indexed()
+
+    def search(self, peptides):
+        # vectorized search of the whole batch: (query number, sequence number, position in the sequence)
+        peptides = list(peptides)
+        if not len(peptides):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        text = ''.join([pep.ljust(self.max_len, '\0') for pep in peptides])
+        query = self._lut[np.frombuffer(text.encode('ascii'), dtype=np.uint8)].reshape(len(peptides), self.max_len)
+        lengths = np.array([len(pep) for pep in peptides])
+
+        # the residues of the query are the high bits of the code, the low bits are any
+        codes = np.zeros(len(peptides), dtype=np.uint64)
+        for i in range(self._width):
+            codes = (codes << np.uint64(self._bits)) | query[:, i].astype(np.uint64)
+        free_bits = (self._bits * np.clip(self._width - lengths, 0, None)).astype(np.uint64)
+        low = (codes >> free_bits) << free_bits
+        high = low | ((np.uint64(1) << free_bits) - np.uint64(1))
+
+        left = np.searchsorted(self._codes, low, side='left')
+        right = np.searchsorted(self._codes, high, side='right')
+
+        counts = right - left
+        query_index = np.repeat(np.arange(len(peptides)), counts)
+        hit_index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(left, counts)
+        positions = np.asarray(self._positions[hit_index]).astype(np.int64)
+
+        # verification of the residues which are not in the code
+        matched = np.ones(len(positions), dtype=bool)
+        last_position = len(self._store.residues) - 1  # it is always a separator
+        for i in range(self._width, self.max_len):
+            check = lengths[query_index] > i
+            residues = self._lut[self._store.residues[np.minimum(positions[check] + i, last_position)]]
+            matched[check] &= residues == query[query_index[check], i]
+        query_index = query_index[matched]
+        positions = positions[matched]
+
+        seq_index = np.searchsorted(self._store.starts, positions, side='right') - 1
+
+        return query_index, seq_index, positions - self._store.starts[seq_index]
+
+    # end of search()
+
+# end of class KmerIndex
+
+
+class BloomFilter:
+    # the Bloom filter over all k-mers of the proteome: a peptide can be in the proteome
+    # only if all its k-mers are in the filter, so the definite misses are discarded before the positional search
+    _bits = 5
+    _chunk_size = 1 << 20  # residues (or bytes of the bit array) processed at once
+    _popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)  # the set bits of a byte
+    _key_name = 'fasta_key'
+
+    def __init__(self, k=8, fpr=0.01):
+        if not 0 < k <= 12:
+            raise ValueError('ERROR: k-mer length of the Bloom filter must be from 1 to 12')
+        self.k = k
+        self.fpr = fpr  # the target false-positive rate for a k-mer
+        self.fpr_estimated = None
+        self._lut = make_residue_lut()
+        self._bit_array = None
+        self._n_bits = None
+        self._n_hashes = None
+
+    # end of __init__()
+
+    def get_filter_file(self, fasta_file_name):
+        return '{}.bloom{}-{}.npz'.format(fasta_file_name, self.k, self.fpr)
+
+    # end of get_filter_file()
+
+    @staticmethod
+    def _mix(codes):  # splitmix64 finalizer
+        codes = codes + np.uint64(0x9E3779B97F4A7C15)
+        codes = (codes ^ (codes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        codes = (codes ^ (codes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+        return codes ^ (codes >> np.uint64(31))
+
+    # end of _mix()
+
+    def _get_bit_index(self, codes):
+        # double hashing: h1 + i * h2
+        h1 = self._mix(codes)
+        h2 = self._mix(codes ^ np.uint64(0x5851F42D4C957F2D)) | np.uint64(1)
+        for i in range(self._n_hashes):
+            yield (h1 + np.uint64(i) * h2) % np.uint64(self._n_bits)
+
+    # end of _get_bit_index()
+
+    def _get_codes(self, residues):
+        n_pos = len(residues) - self.k + 1
+        codes = np.zeros(max(n_pos, 0), dtype=np.uint64)
+        for i in range(self.k):
+            codes = (codes << np.uint64(self._bits)) | residues[i:i + n_pos].astype(np.uint64)
+
+        return codes
+
+    # end of _get_codes()
+
+    def _iter_codes(self, residues):
+        # the codes of k-mers within sequences by chunks of residues (a k-mer can't contain the separator)
+        n_pos = len(residues) - self.k + 1
+        for start in range(0, max(n_pos, 0), self._chunk_size):
+            end = min(start + self._chunk_size, n_pos)
+            chunk = self._lut[residues[start:end + self.k - 1]]
+            separators = np.concatenate([[0], np.cumsum(chunk == 0, dtype=np.int32)])
+            yield self._get_codes(chunk)[separators[self.k:] == separators[:end - start]]
+
+    # end of _iter_codes()
+
+    def build(self, store):
+        # the bits are set in the packed array by chunks of the proteome, so the memory doesn't grow with it
+        n_items = max(sum([len(codes) for codes in self._iter_codes(store.residues)]), 1)
+        self._n_bits = max(int(np.ceil(-n_items * np.log(self.fpr) / np.log(2) ** 2)), 8)
+        self._n_hashes = max(int(round(self._n_bits / n_items * np.log(2))), 1)
+
+        self._bit_array = np.zeros((self._n_bits + 7) // 8, dtype=np.uint8)
+        for codes in self._iter_codes(store.residues):
+            if not len(codes):
+                continue
+            for bit_index in self._get_bit_index(codes):
+                # the sorted bits of the same byte are combined, so each byte is updated once
+                bit_index = np.unique(bit_index)
+                byte_index = bit_index >> np.uint64(3)
+                masks = np.left_shift(1, bit_index & np.uint64(7)).astype(np.uint8)
+                firsts = np.flatnonzero(np.concatenate([[True], byte_index[1:] != byte_index[:-1]]))
+                self._bit_array[byte_index[firsts]] |= np.bitwise_or.reduceat(masks, firsts)
+
+        n_set = sum([int(self._popcount[self._bit_array[i:i + self._chunk_size]].sum(dtype=np.int64))
+                     for i in range(0, len(self._bit_array), self._chunk_size)])
+        self.fpr_estimated = (n_set / self._n_bits) ** self._n_hashes
+
+        return self
+
+    # end of build()
+
+    def save(self, filter_file, fasta_key=None):
+        def write(tmp_file):
+            arrays = {} if fasta_key is None else {self._key_name: fasta_key}
+            with open(tmp_file, 'wb') as f:  # a file object: no .npz extension is added to the temporary name
+                np.savez(f, bit_array=self._bit_array,
+                         params=np.array([self._n_bits, self._n_hashes, self.fpr_estimated]), **arrays)
+
+        return FastaCache.save(filter_file, write)
+
+    # end of save()
+
+    def load(self, filter_file):
+        with np.load(filter_file) as data:
+            self._bit_array = data['bit_array']
+            self._n_bits, self._n_hashes, self.fpr_estimated = data['params']
+        self._n_bits, self._n_hashes = int(self._n_bits), int(self._n_hashes)
+
+        return self
+
+    # end of load()
+
+    def set_fasta(self, fasta_file_name, store):
+        # the filter is a cache next to the FASTA file, it is reused while the FASTA file is the same (see FastaCache)
+        filter_file = self.get_filter_file(fasta_file_name)
+        if FastaCache.is_valid(filter_file, fasta_file_name, self._key_name):
+            return self.load(filter_file)
+
+        fasta_key = FastaCache.get_key(fasta_file_name)
+        self.build(store)
+        try:
+            self.save(filter_file, fasta_key)
+        except OSError:  # the filter is used from memory if it can't be saved
+            pass
+
+        return self
+
+    # end of set_fasta()
+
+    def contains(self, peptides):
+        # vectorized check of all k-mers of all peptides,
+        # peptides shorter than k or with unusual symbols are never discarded
+        peptides = pd.Series(peptides, dtype=object).reset_index(drop=True)
+        result = np.ones(len(peptides), dtype=bool)
+        checked = ((peptides.str.len() >= self.k) & peptides.str.fullmatch('[A-Z]+')).to_numpy(dtype=bool)
+        if not checked.any():
+            return result
+
+        queries = peptides[checked]
+        text = '\0'.join(queries) + '\0'
+        residues = self._lut[np.frombuffer(text.encode('ascii'), dtype=np.uint8)]
+        codes = self._get_codes(residues)
+
+        # all k-mers within the queries
+        lengths = queries.str.len().to_numpy()
+        starts = np.cumsum(lengths + 1) - lengths - 1
+        n_kmers = lengths - self.k + 1
+        first_kmers = np.cumsum(n_kmers) - n_kmers
+        kmer_positions = np.repeat(starts, n_kmers) + np.arange(n_kmers.sum()) - np.repeat(first_kmers, n_kmers)
+        codes = codes[kmer_positions]
+
+        found = np.ones(len(codes), dtype=bool)
+        for bit_index in self._get_bit_index(codes):
+            found &= (self._bit_array[bit_index >> np.uint64(3)] >> (bit_index & np.uint64(7)).astype(np.uint8)) & 1 == 1
+        result[checked] = np.logical_and.reduceat(found, first_kmers)
+
+        return result
+
+    # end of contains()
+
+# end of class BloomFilter
+
+
+class PeptideMap:
+    # exact match of peptides: all hits of each distinct sequence of a FASTA file as SEQUENCE:ID joined by ','
+    # (the same as the SQL search), the I/L-normalized key of a sequence joins all its I/L variants
+    _key = 'Key'
+    _target = 'Target'
+    _hit = 'Hit'
+
+    def __init__(self):
+        self._hits = None
+
+    # end of __init__()
+
+    @staticmethod
+    def get_map_file(fasta_file_name):
+        return fasta_file_name + '.peptides.pkl'
+
+    # end of get_map_file()
+
+    def build(self, store):
+        data = pd.DataFrame({self._target: list(store.sequences()), 'ID': store.ids.astype(str)})
+        data[self._hit] = data[self._target] + ':' + data['ID']
+        data = data.drop_duplicates(subset=[self._hit])
+
+        # only the hits of repeated sequences need to be joined
+        repeated = data[self._target].duplicated(keep=False)
+        self._hits = pd.concat([
+            data.loc[~repeated, [self._target, self._hit]],
+            data[repeated].groupby(self._target, sort=False)[self._hit].agg(','.join).reset_index()
+        ], ignore_index=True)
+        self._hits.insert(0, self._key, self._hits[self._target].str.replace('I', 'L', regex=False))
+
+        return self
+
+    # end of build()
+
+    def set_fasta(self, fasta_file_name, store):
+        # the map is a cache next to the FASTA file, it is reused while the FASTA file is the same (see FastaCache):
+        # the map and the key of the FASTA file are pickled together
+        map_file = self.get_map_file(fasta_file_name)
+        try:
+            cache = pd.read_pickle(map_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            cache = None
+        if isinstance(cache, dict) and np.array_equal(cache.get('fasta_key'), FastaCache.get_key(fasta_file_name)):
+            self._hits = cache['hits']
+            return self
+
+        fasta_key = FastaCache.get_key(fasta_file_name)
+        self.build(store)
+        try:
+            FastaCache.save(map_file, lambda tmp_file: pd.to_pickle({'fasta_key': fasta_key, 'hits': self._hits},
+                                                                     tmp_file))
+        except OSError:  # the map is used from memory if it can't be saved
+            pass
+
+        return self
+
+    # end of set_fasta()
+
+    def search(self, queries, i2l_mode=False):
+        # one vectorized merge for all queries in their order: (query number, found peptide, hits),
+        # the found peptides are I/L variants of the queries in the I2L mode
+        queries = pd.DataFrame({'Row': np.arange(len(queries)), self._target: np.asarray(queries, dtype=object)})
+        if i2l_mode:
+            queries[self._key] = queries[self._target].str.replace('I', 'L', regex=False)
+            q_data = queries.drop(columns=[self._target]).merge(self._hits, on=self._key)
+        else:
+            q_data = queries.merge(self._hits.drop(columns=[self._key]), on=self._target)
+
+        return q_data[['Row', self._target, self._hit]]
+
+    # end of search()
+
+# end of class PeptideMap
 
 
 class FastaSearch:
@@ -49,39 +630,73 @@ class FastaSearch:
             os.rename(db_file, db_file + '.bak')
 
         self._conn = sqlite3.connect(db_file)
+        self._db_file = db_file
         self._true_match = None
+        self._store = None
+        self._kmer_index = None
+        self._bloom_filter = None
+        self._peptide_map = None
+        self._db_created = False
+        self._fts5_created = False
 
     # end of __init__()
 
-    def set_db(self, fasta_file_name, true_match=False):
-        fasta_data = []
+    def set_db(self, fasta_file_name, true_match=False, kmer_len=None, il_collapse=False, bloom_fpr=None, bloom_k=8):
+        # kmer_len: (min, max) length of peptides to search them by the k-mer index in the protein mode,
+        # other peptides are searched by the full-text index.
+        # bloom_fpr: the false-positive rate of the Bloom filter to discard peptides before the full-text search.
+        # the sequences are kept in the proteome store, SQLite tables are created only for SQL queries
         self._true_match = true_match
-        with open(fasta_file_name) as fasta_handle:
-            for header, seq in SeqIO.FastaIO.SimpleFastaParser(fasta_handle):
-                seq_id = re.sub(r'^(\S+).*', r'\1', header)
-                fasta_data.append((seq_id, seq, header))
+        with RunReport.section('FASTA index build'):
+            self._store = ProteomeStore.from_fasta(fasta_file_name)
+
+            if not self._true_match and bloom_fpr:
+                self._bloom_filter = BloomFilter(bloom_k, bloom_fpr).set_fasta(fasta_file_name, self._store)
+                print('Bloom filter ({}-mers): estimated false-positive rate {:.4%}'.format(
+                    bloom_k, self._bloom_filter.fpr_estimated))
+
+            if self._true_match and self._db_file == self._sqlite_file_default:
+                self._peptide_map = PeptideMap().set_fasta(fasta_file_name, self._store)
+            elif self._true_match:  # SQLite tables are created only if the database file is specified
+                self._create_db()
+            elif kmer_len:
+                self._kmer_index = KmerIndex(kmer_len[0], kmer_len[1], il_collapse).set_fasta(fasta_file_name,
+                                                                                              self._store)
+            elif self._bloom_filter is None:  # the full-text index is created on demand with the Bloom filter
+                self._create_fts5()
+
+        return self._store
+
+    # end of set_db()
 
-        fasta_data = pd.DataFrame(fasta_data, columns=self._db_columns)
+    def _create_db(self):
+        fasta_data = self._store.to_dataframe(self._db_columns)
         fasta_data.to_sql(name=self._db_name, con=self._conn)
 
         self._conn.execute("""CREATE INDEX id_index ON {}({});""".format(self._db_name, self._db_column_id))
-
         if self._true_match:
             self._conn.execute("""CREATE INDEX seq_index ON {}({});""".format(self._db_name, self._db_column_seq))
-        else:
-            # let's use SQLite FTS5 extension to make full-text search faster (USE TRIGRAM TOKEN!)
-            self._conn.execute(
-                """CREATE VIRTUAL TABLE {} USING fts5 ({}, tokenize="trigram");""".format(
-                    self._db_name_fts5, ','.join(self._db_columns)))
-            self._conn.execute(  # copy data to fts5 table (trigram tokens don't work with content='table')
-                """INSERT INTO {} ({}) SELECT {} FROM {};""".format(
-                    self._db_name_fts5, ','.join(self._db_columns), ','.join(self._db_columns), self._db_name))
 
         self._conn.commit()
+        self._db_created = True
 
-        return fasta_data
+    # end of _create_db()
 
-    # end of set_db()
+    def _create_fts5(self):
+        if not self._db_created:
+            self._create_db()
+
+        # let's use SQLite FTS5 extension to make full-text search faster (USE TRIGRAM TOKEN!)
+        self._conn.execute(
+            """CREATE VIRTUAL TABLE {} USING fts5 ({}, tokenize="trigram");""".format(
+                self._db_name_fts5, ','.join(self._db_columns)))
+        self._conn.execute(  # copy data to fts5 table (trigram tokens don't work with content='table')
+            """INSERT INTO {} ({}) SELECT {} FROM {};""".format(
+                self._db_name_fts5, ','.join(self._db_columns), ','.join(self._db_columns), self._db_name))
+        self._conn.commit()
+        self._fts5_created = True
+
+    # end of _create_fts5()
 
     def i2l(self, pep):
         all_perm = set()  # a list to hold all current peptide permutations initialized with original peptide
@@ -105,26 +720,107 @@ class FastaSearch:
 
     # end of i2l()
 
+    def _kmer_search(self, data2search, i2l_mode):
+        # the same result as the full-text search: one row for each query with all hits as PEPTIDE_POS/LENGTH:ID
+        queries = data2search[self._query_column_pep].to_numpy()
+        query_index, seq_index, offsets = self._kmer_index.search(queries)
+
+        hits = pd.DataFrame({'Row': query_index, 'Seq_index': seq_index, 'Offset': offsets})
+        if self._kmer_index.il_collapse:  # the found peptide can be an I/L variant of the query
+            lengths = [len(queries[i]) for i in query_index]
+            hits[self._query_column_pep] = [self._store.get_sequence(i, j, j + n)
+                                            for i, j, n in zip(seq_index, offsets, lengths)]
+            if not i2l_mode:
+                hits = hits[hits[self._query_column_pep].to_numpy() == queries[hits['Row'].to_numpy()]]
+        else:
+            hits[self._query_column_pep] = queries[query_index]
+
+        # the first position of the peptide in the sequence (as INSTR) and sequences in the order of the FASTA file
+        keys = ['Row', self._query_column_pep, 'Seq_index']
+        hits = hits.groupby(keys, sort=True)['Offset'].min().reset_index()
+        hits[self._sbjct_column_id] = (hits[self._query_column_pep] + '_' + (hits['Offset'] + 1).astype(str) + '/' +
+                                       self._store.lengths[hits['Seq_index'].to_numpy()].astype(str) + ':' +
+                                       self._store.ids[hits['Seq_index'].to_numpy()].astype(str))
+        hits = hits.drop_duplicates(subset=['Row', self._query_column_pep, self._sbjct_column_id])
+
+        q_data = hits.groupby(['Row', self._query_column_pep], sort=True)[self._sbjct_column_id].agg(','.join)
+        q_data = q_data.reset_index()
+        q_data[self._sbjct_column_seq] = data2search[self._query_column_seq].to_numpy()[q_data['Row'].to_numpy()]
+
+        return q_data[self._sbjct_columns]
+
+    # end of _kmer_search()
+
+    def _peptide_search(self, data2search, i2l_mode):
+        hits = self._peptide_map.search(data2search[self._query_column_pep], i2l_mode)
+        q_data = pd.DataFrame({
+            self._sbjct_column_seq: data2search[self._query_column_seq].to_numpy()[hits['Row'].to_numpy()],
+            self._sbjct_column_pep: hits.iloc[:, 1].to_numpy(),
+            self._sbjct_column_id: hits.iloc[:, 2].to_numpy()
+        })
+
+        return q_data
+
+    # end of _peptide_search()
+
     def db_search(self, data, query_column, new_column, i2l_mode=False):
         if isinstance(data, str):  # if the input is a file name
-            data = pd.read_csv(data, sep=CSV.get_delimiter(data), engine='python')
+            data = CSV.read(data)
 
         if query_column not in data.columns:
             raise ValueError('ERROR: there is no column {} in the input data'.format(query_column))
 
+        if self._true_match is None:
+            raise ValueError('ERROR: set database before using db_search() method!')
+
         data2search = data[[query_column]].rename(columns={query_column: self._query_column_seq})
+        data2search[self._query_column_pep] = data2search[self._query_column_seq]
+
+        q_data = []
+        if self._kmer_index is not None:  # peptides in the length range of the k-mer index
+            indexed = self._kmer_index.is_indexed(data2search[self._query_column_seq]).to_numpy()
+            kmer_data = data2search[indexed]
+            data2search = data2search[~indexed].copy()
+            if i2l_mode and not self._kmer_index.il_collapse:
+                kmer_data = kmer_data.assign(**{self._query_column_pep: kmer_data[self._query_column_seq].apply(
+                    lambda x: self.i2l(x))}).explode(self._query_column_pep, ignore_index=False)
+            q_data.append(self._kmer_search(kmer_data, i2l_mode))
+
+        if self._peptide_map is not None:  # exact match by the hash map
+            q_data.append(self._peptide_search(data2search, i2l_mode))
+            data2search = data2search.iloc[:0].copy()
+
         if i2l_mode:
             data2search[self._query_column_pep] = data2search[self._query_column_seq].apply(
                 lambda x: self.i2l(x)
             )
             data2search = data2search.explode(self._query_column_pep, ignore_index=False)
+
+        if self._bloom_filter is not None and len(data2search.index):  # definite misses are discarded
+            found = self._bloom_filter.contains(data2search[self._query_column_pep])
+            print('Bloom filter: {} of {} queries are discarded'.format(len(found) - found.sum(), len(found)))
+            data2search = data2search[found]
+
+        if len(data2search.index):
+            q_data.append(self._sql_search(data2search))
         else:
-            data2search[self._query_column_pep] = data2search[self._query_column_seq]
+            q_data.append(pd.DataFrame(columns=self._sbjct_columns))
+
+        q_data = pd.concat(q_data)
+        q_data = q_data[[self._sbjct_column_seq, self._sbjct_column_id]].groupby(self._sbjct_column_seq).agg(';'.join).reset_index()
+        q_data = q_data.rename(columns={self._query_column_seq: query_column, self._sbjct_column_id: new_column})
+        data = data.merge(q_data, on=[query_column], how='left')
+        data[new_column] = data[new_column].fillna('')
 
-        data2search.to_sql(name=self._query_name, con=self._conn, index=False)
+        return data
 
-        if self._true_match is None:
-            raise ValueError('ERROR: set database before using db_search() method!')
+    # end of db_search()
+
+    def _sql_search(self, data2search):
+        if not self._true_match and not self._fts5_created:
+            self._create_fts5()
+
+        data2search.to_sql(name=self._query_name, con=self._conn, index=False, if_exists='replace')
 
         if self._true_match:
             query = """SELECT {}, {}, (SELECT GROUP_CONCAT(DISTINCT {} || ":" || {}) 
@@ -168,32 +864,95 @@ class FastaSearch:
             )
 
         q_data = self._conn.execute(query).fetchall()
-        q_data = pd.DataFrame(q_data, columns=self._sbjct_columns)
-        q_data = q_data[[self._sbjct_column_seq, self._sbjct_column_id]].groupby(self._sbjct_column_seq).agg(';'.join).reset_index()
-        q_data = q_data.rename(columns={self._query_column_seq: query_column, self._sbjct_column_id: new_column})
-        data = data.merge(q_data, on=[query_column], how='left')
-        data[new_column] = data[new_column].fillna('')
 
-        return data
+        return pd.DataFrame(q_data, columns=self._sbjct_columns)
 
-    # end of db_search()
+    # end of _sql_search()
 
 # end of class FastaSearch
 
 
+DB_MODES = ['peptide', 'protein']  # exact match between peptides or search of protein substrings
+I2L_MODES = ['i2l', 'strict']  # search with or without the I2L replacement
+
+
+def search_database(queries, query_column, name, fasta_file, mode, i2l, kmer_len=None, il_collapse=False,
+                    bloom_fpr=None, bloom_k=8):
+    # the worker function: search of the query peptides in one database
+    search_engine = FastaSearch()
+    search_engine.set_db(fasta_file, mode == DB_MODES[0], kmer_len, il_collapse, bloom_fpr, bloom_k)
+    data = search_engine.db_search(queries, query_column, name, i2l == I2L_MODES[0])
+
+    return data[name].to_numpy()
+
+# end of search_database()
+
+
+def multi_search(data, query_column, databases, threads=None, kmer_len=None, il_collapse=False, bloom_fpr=None,
+                 bloom_k=8):
+    # databases: a list of (name, FASTA file, mode, I2L mode), the unique query peptides are searched
+    # in all databases concurrently and the results are added to the data as new columns in the order of databases
+    if isinstance(data, str):  # if the input is a file name
+        data = CSV.read(data)
+
+    if query_column not in data.columns:
+        raise ValueError('ERROR: there is no column {} in the input data'.format(query_column))
+
+    for name, fasta_file, mode, i2l in databases:
+        if mode not in DB_MODES or i2l not in I2L_MODES:
+            raise ValueError('ERROR: wrong database specification {} {} {} {}'.format(name, fasta_file, mode, i2l))
+
+    peptides = PeptideDict()
+    ids = peptides.intern(data[query_column])
+    queries = pd.DataFrame({query_column: peptides.get_sequences()})
+    threads = threads if threads else len(databases)
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(search_database, queries, query_column, *database, kmer_len, il_collapse,
+                                   bloom_fpr, bloom_k) for database in databases]
+        for database, future in zip(databases, futures):
+            queries[database[0]] = future.result()
+
+    # the results of unique peptides are expanded back by the peptide IDs
+    data = data.copy()
+    for database in databases:
+        data[database[0]] = queries[database[0]].to_numpy()[ids]
+        data.loc[ids == PeptideDict.unknown, database[0]] = np.nan
+
+    return data
+
+# end of multi_search()
+
+
 def main():
     parser = argparse.ArgumentParser(description='A script for peptide searching in FASTA files')
     parser.add_argument('-i', required=True, help='input CSV file with query sequences')
     parser.add_argument('-p', default='Sequence', required=False,
                         help='query column with peptide sequences in the input CSV file')
-    parser.add_argument('-n', required=True, help='a new column name to write the results of searching')
-    parser.add_argument('-f', required=True, help='the FASTA file to search in it')
+    parser.add_argument('-n', required=False, help='a new column name to write the results of searching')
+    parser.add_argument('-f', required=False, help='the FASTA file to search in it')
+    parser.add_argument('-d', nargs=4, action='append', required=False, metavar=('NAME', 'FASTA', 'MODE', 'I2L'),
+                        help='a database to search in it instead of -n/-f/-m/-i2l, it can be repeated: '
+                             'NAME is a new column name, MODE is peptide (direct match) or protein (substrings), '
+                             'I2L is i2l or strict; all databases are searched concurrently in one run')
+    parser.add_argument('-t', type=int, required=False,
+                        help='the number of processes for database searching with -d (default: one per database)')
     parser.add_argument('-m', action='store_true',
                         help='direct match between peptides (default: search protein substrings')
     parser.add_argument('-o', default='output.csv', required=False, help='output file')
     parser.add_argument('-i2l', action='store_true', help='search with the I2L replacement')
     parser.add_argument('-db', required=False,
                         help='database file (if not specified, the data will be stored in memory')
+    parser.add_argument('-k', nargs=2, type=int, required=False, metavar=('MIN', 'MAX'),
+                        help='search peptides of MIN-MAX length by the k-mer index of protein sequences '
+                             '(the index is saved next to the FASTA file), for example: -k 8 14')
+    parser.add_argument('-bloom', type=float, required=False, metavar='FPR',
+                        help='discard peptides absent in the FASTA file by the Bloom filter of its k-mers before '
+                             'the full-text search, FPR is the false-positive rate (the filter is saved next to '
+                             'the FASTA file), for example: -bloom 0.01')
+    parser.add_argument('-bloom_k', default=8, type=int, required=False,
+                        help='k-mer length of the Bloom filter (default: 8)')
+    parser.add_argument('-il', action='store_true',
+                        help='collapse I and L in the k-mer index (I2L variants are found by one query)')
 
     args = parser.parse_args()
     input_file = args.i
@@ -204,17 +963,36 @@ def main():
     output_file = args.o
     i2l_mode = args.i2l
     db_file = args.db
+    kmer_len = args.k
+    il_collapse = args.il
+    bloom_fpr = args.bloom
+    bloom_k = args.bloom_k
+    databases = args.d
+    threads = args.t
 
+    if not databases and not (new_column_name and fasta_file):
+        parser.error('either -d or both -n and -f must be specified')
+
+    RunReport.start('FastFastaSearch', output_file)
     try:
-        search_engine = FastaSearch(db_file)
-        print('creating database...')
-        search_engine.set_db(fasta_file, true_match)
-        print('searching...')
-        data = search_engine.db_search(input_file, seq_column_name, new_column_name, i2l_mode)
+        if databases:
+            print('searching...')
+            with RunReport.section('search'):  # the databases are indexed and searched in the worker processes
+                data = multi_search(input_file, seq_column_name, databases, threads, kmer_len, il_collapse, bloom_fpr,
+                                    bloom_k)
+        else:
+            search_engine = FastaSearch(db_file)
+            print('creating database...')
+            search_engine.set_db(fasta_file, true_match, kmer_len, il_collapse, bloom_fpr, bloom_k)
+            print('searching...')
+            with RunReport.section('search'):
+                data = search_engine.db_search(input_file, seq_column_name, new_column_name, i2l_mode)
         print('saving results...')
-        data.to_csv(output_file, sep='\t', index=False)
+        with RunReport.section('save'):
+            CSV.write(data, output_file)
     except Exception as err:
         print('Something went wrong: {}'.format(err))
+        RunReport.error(err)
     else:
         print('Search in FASTA: done')
 
@@ -32,8 +32,8 @@ sys.path.insert(0, './src')
 from src.peptides import peptides
 from src.NetMHCpan import netMHCpan
 from src.msms import msms
-from src.merge_tables import mergeTables
 from src.filter_tables import filterTables
+from RunReport import RunReport
 
 
 def is_valid_path(parser, arg):
@@ -48,26 +48,28 @@ def main(args):
     Main program to call the IMP pipeline
     """
 
+    RunReport.start('IMP', args.output_folder)
+
     print('calling peptide')
     # read peptide data and add I to L data and perform database search
-    pp = peptides(args)
+    with RunReport.section('peptides'):
+        pp = peptides(args)
 
     print('calling netMHCpan')
     # call NetMHCpan
-    nm = netMHCpan(args)
-    nm.parse_netMHCpan()
+    with RunReport.section('netMHCpan'):
+        nm = netMHCpan(args)
+        nm.parse_netMHCpan()
 
     print('calling msms')
     # read MS-MS data
-    ms = msms(args)
-
-    print('merging tables')
-    mt = mergeTables(args)
-    mt.merge_MQ_netMHCpan_tables()
+    with RunReport.section('msms'):
+        ms = msms(args)
 
-    print('filtering')
-    ft = filterTables(args)
-    ft.filter_MQ_netMHCpan_peptides()
+    print('merging and filtering tables')
+    with RunReport.section('filter tables'):
+        ft = filterTables(args)
+        ft.filter_MQ_netMHCpan_peptides()
     exit()
 
 
@@ -108,6 +110,8 @@ def make_parser():
 
     _output.add_argument('-o', '--output_folder', metavar='', type=is_valid, default="./output",
                          help="folder location for output files (default: %(default)s)")
+    _output.add_argument('--unfiltered', action='store_true',
+                         help="write also the unfiltered table IMP_unfiltered.csv")
 
     _netMHCpan = parser.add_argument_group('netMHCpan options')
 
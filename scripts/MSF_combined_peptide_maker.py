@@ -11,6 +11,8 @@ import argparse
 from glob import glob
 import pandas as pd
 from CSVtools import CSV
+from TableSchema import TableSchema
+from RunReport import RunReport
 
 
 columns = [
@@ -46,8 +48,11 @@ def main():
     output_file = args.o
     descr_file = args.s
 
-    data = pd.read_csv(input_file, sep=CSV.get_delimiter(input_file), engine='python')
-    sample_descr = pd.read_csv(descr_file, sep=CSV.get_delimiter(descr_file), engine='python')
+    RunReport.start('MSF_combined_peptide_maker', output_file)
+    data = CSV.read(input_file, usecols=columns)
+    sample_descr = CSV.read(descr_file)
+    TableSchema.apply(data, 'fragpipe_psm')
+    TableSchema.apply(sample_descr, 'sample_description')
     sample_name = sample_descr['Experiment'].iloc[0]
 
     data = data[columns]
@@ -67,7 +72,7 @@ def main():
     data = data.drop(columns=['Hyperscore'])
     data = pd.merge(data, data_spectral, on=['Peptide Sequence'], how='left')
 
-    data.to_csv(output_file, sep='\t', index=False)
+    CSV.write(data, output_file)
 
     print('MSF_combined_peptide_maker.py: done')
 
@@ -6,10 +6,15 @@ __author__ = "Dmitry Malko"
 
 
 import re
+import os
 import argparse
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import pandas as pd
 import xml.etree.ElementTree as ET
+from CSVtools import CSV
+from TableSchema import TableSchema
+from RunReport import RunReport
 
 
 class FragPipeCombiner:
@@ -35,6 +40,21 @@ class FragPipeCombiner:
         'PeptideProphet Probability': 'PeptideProphet'
     }
 
+    # psm.tsv columns which are used to make msms.txt
+    _psm_columns = [
+        'Spectrum',
+        'Spectrum File',
+        'Peptide',
+        'Peptide Length',
+        'Charge',
+        'Retention',
+        'Calculated Peptide Mass',
+        'Expectation',
+        'Hyperscore',
+        'Nextscore',
+        'PeptideProphet Probability'
+    ]
+
     # _dummy_column_peptide = ['Reverse', 'Leading razor protein', 'Potential contaminant']
     _dummy_column_peptide = []
     # _dummy_column_msms = ['Matches', 'Intensities']
@@ -48,6 +68,7 @@ class FragPipeCombiner:
     _summary = 'interact_summary'
     _query = 'spectrum_query'
     _hit = 'search_hit'
+    _score = 'search_score'
 
     def __init__(self, input_dir):
         self._input = re.sub(r'/$', '', input_dir)
@@ -56,7 +77,8 @@ class FragPipeCombiner:
 
     def make_pep(self, input_file):
         main_file_name = '/'.join([self._input, input_file])
-        self._pept_data = pd.read_csv(main_file_name, sep='\t', engine='python')
+        self._pept_data = CSV.read(main_file_name, sep='\t')
+        TableSchema.apply(self._pept_data, 'fragpipe_combined_peptide')
 
         if len(self._column2rename_peptide.keys()):
             self._pept_data = self._pept_data.rename(columns=self._column2rename_peptide)
@@ -73,23 +95,29 @@ class FragPipeCombiner:
 
         return self._pept_data
 
-    def make_msms(self):
-        psm_file_name = '/'.join([self._input, '**', self._psm_file])
+    def _read_psm(self, psm_file):
+        data_item = CSV.read(psm_file, sep='\t', usecols=lambda x: x in self._psm_columns)
+        TableSchema.apply(data_item, 'fragpipe_psm')
 
-        msms_data = []
-        for psm_file in glob(psm_file_name, recursive=True):
-            data_item = pd.read_csv(psm_file, sep='\t', engine='python')
+        # fit the data to MaxQuant output
+        data_item['Spectrum File'] = data_item['Spectrum File'].str.replace(r'.*[/\\]', '', regex=True)
+        data_item[['Raw file', 'Scan number']] = data_item['Spectrum'].str.extract(r'^([^.]*)\.([^.]*)', expand=True)
+        data_item['Delta score'] = data_item['Hyperscore'] - data_item['Nextscore']
+        # data_item['PEP'] = 1 - data_item['PeptideProphet Probability']
 
-            # fit the data to MaxQuant output
-            data_item['Spectrum File'] = data_item['Spectrum File'].apply(lambda x: re.sub(r'.*[/\\]', '', x))
-            data_item['Raw file'] = data_item['Spectrum'].apply(lambda x: (re.split(r'\.', x))[0])
-            data_item['Scan number'] = data_item['Spectrum'].apply(lambda x: (re.split(r'\.', x))[1])
-            data_item['Delta score'] = data_item.apply(lambda x: x['Hyperscore'] - x['Nextscore'], axis=1)
-            # data_item['PEP'] = data_item['PeptideProphet Probability'].apply(lambda x: 1 - x)
+        return data_item
 
-            msms_data.append(data_item)
+    def make_msms(self, threads=None):
+        psm_file_name = '/'.join([self._input, '**', self._psm_file])
+        psm_files = glob(psm_file_name, recursive=True)
+        if not len(psm_files):
+            raise ValueError('ERROR: there are no {} files in {}'.format(self._psm_file, self._input))
+
+        # psm.tsv files are loaded concurrently (the order of files is kept)
+        with ThreadPoolExecutor(max_workers=threads if threads else os.cpu_count()) as executor:
+            msms_data = list(executor.map(self._read_psm, psm_files))
 
-        self._msms_data = pd.concat(msms_data)
+        self._msms_data = pd.concat(msms_data, ignore_index=True)
 
         if len(self._column2rename_msms.keys()):
             self._msms_data = self._msms_data.rename(columns=self._column2rename_msms)
@@ -101,51 +129,84 @@ class FragPipeCombiner:
         if self._pept_data is None:
             raise ValueError('ERROR: there is no data to check the consistency, run make_pep() method before')
         n_before = len(self._msms_data['Sequence'].unique())
-        self._msms_data = pd.merge(self._msms_data, self._pept_data['Sequence'], on=['Sequence'], how='inner')
+        # semi-join: sequences which are absent in the peptide data become NaN in the categorical column
+        sequences = pd.CategoricalDtype(self._pept_data['Sequence'].dropna().unique())
+        self._msms_data['Sequence'] = self._msms_data['Sequence'].astype(sequences)
+        self._msms_data = self._msms_data[self._msms_data['Sequence'].notna()]
         n_after = len(self._msms_data['Sequence'].unique())
         if n_before - n_after > 0:
             print('{} unique peptides were removed from psm.tsv data'.format(n_before - n_after))
 
         return self._msms_data
 
-    def make_msms_xml(self):  # a method to parse XML output file
+    @classmethod
+    def iter_pep_xml(cls, xml_file):  # a streaming pepXML reader (processed elements are released)
+        xml_name = re.sub(r'.*/', '', xml_file)
+        stack = []
+        for event, elem in ET.iterparse(xml_file, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            if elem.tag.rpartition('}')[2] != cls._query:  # let's take into account XML NameSpace
+                continue
+
+            spec = elem.attrib.get('spectrumNativeID', '')
+            s = re.search(r'\sscan=(\d+)', spec)
+            record = {
+                'Spectrum File': xml_name,
+                'Spectrum Native ID': spec,
+                'Scan': int(s.group(1)) if s else int(elem.attrib.get('start_scan', 0)),
+                'Peptide': ''
+            }
+
+            for hit in elem.iter():  # only the top hit of the query
+                if hit.tag.rpartition('}')[2] == cls._hit:
+                    record['Peptide'] = hit.attrib['peptide']
+                    for score in hit.iter():
+                        if score.tag.rpartition('}')[2] == cls._score:
+                            record[score.attrib['name']] = float(score.attrib['value'])
+                    break
+
+            yield record
+
+            elem.clear()
+            if len(stack):
+                stack[-1].remove(elem)
+
+    @classmethod
+    def read_pep_xml(cls, xml_file):
+        xml_data = pd.DataFrame(cls.iter_pep_xml(xml_file))
+        if not len(xml_data.index):
+            xml_data = pd.DataFrame({'Spectrum File': [], 'Spectrum Native ID': [], 'Scan': [], 'Peptide': []})
+
+        return xml_data.astype({'Scan': int})
+
+    def make_msms_xml(self, threads=None):  # a method to parse XML output file
         psm_file_name = '/'.join([self._input, '**', self._psm_file])
-        file_name = re.sub(r'.*/', '', psm_file_name)
+
         msms_data = []
+        xml_files = []
         for psm_file in glob(psm_file_name, recursive=True):
             dir_path = re.sub(r'(.*)/.*', r'\1', psm_file)
-            data_item = pd.read_csv(psm_file, sep='\t', engine='python')
-            data_item['Spectrum File'] = data_item['Spectrum File'].apply(lambda x: re.sub(r'.*[/\\]', '', x))
-            xml_files = list(data_item['Spectrum File'].unique())
-            if len(xml_files) != 1:
+            data_item = self._read_psm(psm_file)
+            spectrum_files = list(data_item['Spectrum File'].unique())
+            if len(spectrum_files) != 1:
                 raise ValueError('ERROR: the file {} has no link to XML Spectrum File or multiple links'.format(psm_file))
 
-            xml_file = xml_files[0]
-            data_xml = ET.parse('/'.join([dir_path, xml_file]))
-            xml_root = data_xml.getroot()
-            # let's take into account XML NameSpace
-            s = re.search(r'{([^{}]+)}', xml_root.tag)
-            spectrum_query, xml_namespace = \
-                ('.//ns:' + self._query, {'ns': s.group(1)}) if s else ('.//' + self._query, {})
-
-            xml_data = []
-            for query in xml_root.iterfind(spectrum_query, xml_namespace):
-                spec = query.attrib['spectrumNativeID']
-                s = re.search(r'\sscan=(\d+)', spec)
-                scan = s.group(1) if s else 0
-                pseq = ''
-                search_hit = './/ns:' + self._hit if len(xml_namespace) else './/' + self._hit
-                for hit in query.iterfind(search_hit, xml_namespace):
-                    pseq = hit.attrib['peptide']
-                    break
+            data_item['Scan'] = pd.to_numeric(data_item['Scan number'])
+            msms_data.append(data_item)
+            xml_files.append('/'.join([dir_path, spectrum_files[0]]))
 
-                xml_data.append({'Spectrum File': xml_file,'Peptide': pseq, 'Scan': scan})
+        # pepXML files are parsed in parallel worker processes
+        with ProcessPoolExecutor(max_workers=threads if threads else os.cpu_count()) as executor:
+            xml_data = list(executor.map(self.read_pep_xml, xml_files))
 
-            xml_data = pd.DataFrame(xml_data, index=None)
-            data_item = pd.merge(data_item, xml_data, how='left', on=['Peptide'])
-            msms_data.append(data_item)
+        for i, data_item in enumerate(msms_data):
+            msms_data[i] = pd.merge(data_item, xml_data[i], how='left', on=['Spectrum File', 'Peptide', 'Scan'])
 
-        self._msms_data = pd.concat(msms_data)
+        self._msms_data = pd.concat(msms_data, ignore_index=True)
 
         return self._msms_data
 
@@ -154,10 +215,10 @@ class FragPipeCombiner:
         msms_file_name = '/'.join([self._input, self._output_msms_file])
 
         if len(self._pept_data.index):
-            self._pept_data.to_csv(peptide_file_name, sep='\t', index=False)
+            CSV.write(self._pept_data, peptide_file_name)
 
         if len(self._msms_data.index):
-            self._msms_data.to_csv(msms_file_name, sep='\t', index=False)
+            CSV.write(self._msms_data, msms_file_name)
 
         return peptide_file_name, msms_file_name
 
@@ -166,18 +227,26 @@ def main():
     parser = argparse.ArgumentParser(description='A script to organize FragPipe outputs')
     parser.add_argument('-d', required=True, help='the input directory')
     parser.add_argument('-c', required=True, help='the name of combined_peptide.tsv file after contamination cleaning')
+    parser.add_argument('-t', type=int, required=False, help='the number of threads to load psm.tsv files '
+                                                              '(default: the number of CPUs)')
 
     args = parser.parse_args()
     input_dir = args.d
     input_file = args.c
+    threads = args.t
 
+    RunReport.start('MSF_combiner', input_dir)  # the outputs are saved in the input directory
     try:
         fp = FragPipeCombiner(input_dir)
-        peptide_data = fp.make_pep(input_file)
-        msms_data = fp.make_msms()
-        peptide_file, msms_file = fp.save()
+        with RunReport.section('peptides'):
+            peptide_data = fp.make_pep(input_file)
+        with RunReport.section('msms'):
+            msms_data = fp.make_msms(threads)
+        with RunReport.section('save'):
+            peptide_file, msms_file = fp.save()
     except Exception as err:
         print('Something went wrong: {}'.format(err))
+        RunReport.error(err)
     else:
         print('{}, {} files are created'.format(peptide_file, msms_file))
         print('FragPipe file processing: done')
@@ -0,0 +1,53 @@
+"""PeptideDict.py: The dictionary of peptide sequences with integer IDs"""
+
+__author__ = "Dmitry Malko"
+
+
+import numpy as np
+import pandas as pd
+
+
+class PeptideDict:
+    # each distinct sequence is interned once and gets a compact integer ID (in the order of appearance):
+    # joins and groupings on the IDs are much cheaper than on strings, the sequences are needed only for the output
+    unknown = -1
+
+    def __init__(self):
+        self._sequences = pd.Index([], dtype=object)
+
+    # end of __init__()
+
+    def __len__(self):
+        return len(self._sequences)
+
+    # end of __len__()
+
+    def intern(self, sequences):
+        # adds new sequences to the dictionary, returns the IDs of all sequences (missing values are unknown)
+        sequences = pd.Series(sequences, dtype=object)
+        ids = self.get_ids(sequences)
+        new = sequences[(ids == self.unknown) & sequences.notna().to_numpy()]
+        if len(new.index):
+            self._sequences = self._sequences.append(pd.Index(pd.unique(new), dtype=object))
+            ids = self.get_ids(sequences)
+
+        return ids
+
+    # end of intern()
+
+    def get_ids(self, sequences):
+        # returns the IDs of sequences, without adding new ones
+        return self._sequences.get_indexer(pd.Series(sequences, dtype=object)).astype(np.int32)
+
+    # end of get_ids()
+
+    def get_sequences(self, ids=None):
+        # returns the sequences of IDs (all sequences by default)
+        if ids is None:
+            return self._sequences.to_numpy()
+
+        return self._sequences.to_numpy()[ids]
+
+    # end of get_sequences()
+
+# end of class PeptideDict
@@ -0,0 +1,251 @@
+"""RunReport.py: The run report of MetaPept scripts: time, memory, rows and file bytes of stages and hot sections"""
+
+__author__ = "Dmitry Malko"
+
+
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import shutil
+import socket
+import resource
+import cProfile
+import threading
+import subprocess
+from contextlib import contextmanager
+
+REPORT_SUFFIX = '.run_report.json'
+
+# the environment variables: METAPEPT_RUN_REPORT=0 switches the report off,
+# METAPEPT_PROGRESS sets the minimal interval between progress lines (seconds),
+# METAPEPT_PROFILE=cprofile writes cProfile stats (<report>.prof, see pstats or snakeviz),
+# METAPEPT_PROFILE=pyspy records the run by py-spy sampling profiler (<report>.speedscope.json)
+REPORT_ENABLED = os.environ.get('METAPEPT_RUN_REPORT', '1') != '0'
+PROGRESS_INTERVAL = float(os.environ.get('METAPEPT_PROGRESS', 10))
+PROFILER = os.environ.get('METAPEPT_PROFILE', '').lower()
+
+
+class RunReport:
+    # the stages of the script and the named hot sections inside them are nested records; the records with the same
+    # name and parent are accumulated (calls). Each record keeps the wall and CPU time, the peak resident memory
+    # and the rows and file bytes read and written (CSV.read() and CSV.write() count them for the open records).
+    # The sections are opened in the main thread, the counts can be added from any thread.
+    # The peak memory of a record is measured by resetting the peak RSS of the process (Linux),
+    # the memory of child processes (pools, netMHCpan) is reported for the whole run only
+    _lock = threading.RLock()
+    _root = None
+    _stack = []
+    _report_file = None
+    _profiler = None
+    _pyspy = None
+    _progress = {}
+    _saved = False
+
+    @staticmethod
+    def _new_record(name):
+        return {'name': name, 'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'max_rss_mb': 0.0, 'rows_in': 0,
+                'rows_out': 0, 'bytes_read': 0, 'bytes_written': 0, 'sections': {}}
+
+    @staticmethod
+    def _get_peak_rss():
+        # the peak resident memory (MB) since the last reset, the peak of the process without /proc
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # end of _get_peak_rss()
+
+    @staticmethod
+    def _update_peak_rss(reset=False):
+        # the current peak is added to all open records before the reset
+        peak = RunReport._get_peak_rss()
+        for record in RunReport._stack:
+            record['max_rss_mb'] = max(record['max_rss_mb'], peak)
+        if reset:
+            try:
+                with open('/proc/self/clear_refs', 'w') as f:
+                    f.write('5')
+            except OSError:
+                pass
+
+    # end of _update_peak_rss()
+
+    @staticmethod
+    def start(script, output_path=None):
+        # the report is written next to the output:
+        # <output file>.run_report.json or <output dir>/<script>.run_report.json
+        if not REPORT_ENABLED:
+            return None
+
+        if output_path and (os.path.isdir(output_path) or output_path.endswith('/')):
+            report_file = os.path.join(output_path, script + REPORT_SUFFIX)
+        else:
+            report_file = (output_path if output_path else script) + REPORT_SUFFIX
+
+        with RunReport._lock:
+            RunReport._root = RunReport._new_record(script)
+            RunReport._root.update({'calls': 1, 'status': 'ok', 'error': None, 'argv': sys.argv, 'pid': os.getpid(),
+                                    'host': socket.gethostname(), 'python': sys.version.split()[0],
+                                    'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'profile': None,
+                                    '_wall': time.perf_counter(), '_cpu': time.process_time()})
+            RunReport._stack = [RunReport._root]
+            RunReport._report_file = report_file
+            RunReport._saved = False
+            RunReport._update_peak_rss(reset=True)
+
+        profile_file = report_file[:-len(REPORT_SUFFIX)]
+        if PROFILER == 'cprofile':
+            RunReport._profiler = cProfile.Profile()
+            RunReport._profiler.enable()
+            RunReport._root['profile'] = profile_file + '.prof'
+        elif PROFILER == 'pyspy':
+            if shutil.which('py-spy'):
+                RunReport._root['profile'] = profile_file + '.speedscope.json'
+                RunReport._pyspy = subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--subprocesses',
+                                                     '--format', 'speedscope', '--output', RunReport._root['profile']],
+                                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                print('WARNING: py-spy is not found, the run is not profiled')
+
+        atexit.register(RunReport.save)
+
+        return report_file
+
+    # end of start()
+
+    @staticmethod
+    @contextmanager
+    def section(name):
+        # a stage of the script or a hot section of the code, the sections can be nested
+        if RunReport._root is None:
+            yield None
+            return
+
+        with RunReport._lock:
+            parent = RunReport._stack[-1]
+            record = parent['sections'].setdefault(name, RunReport._new_record(name))
+            RunReport._update_peak_rss(reset=True)
+            RunReport._stack.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            with RunReport._lock:
+                record['calls'] += 1
+                record['wall_s'] += time.perf_counter() - wall
+                record['cpu_s'] += time.process_time() - cpu
+                RunReport._update_peak_rss()
+                if record in RunReport._stack:
+                    RunReport._stack.remove(record)
+
+    # end of section()
+
+    @staticmethod
+    def count(rows_in=0, rows_out=0, bytes_read=0, bytes_written=0):
+        # the counts are added to all open records (the counts of a record include its sections)
+        if RunReport._root is None:
+            return None
+
+        with RunReport._lock:
+            for record in RunReport._stack:
+                record['rows_in'] += rows_in
+                record['rows_out'] += rows_out
+                record['bytes_read'] += bytes_read
+                record['bytes_written'] += bytes_written
+
+    # end of count()
+
+    @staticmethod
+    def progress(label, done, total=None):
+        # a progress line not more often than once per PROGRESS_INTERVAL seconds for each label,
+        # the last line of a long loop is printed when it is done
+        now = time.perf_counter()
+        with RunReport._lock:
+            state = RunReport._progress.setdefault(label, {'start': now, 'last': now, 'printed': False})
+            finished = total is not None and done >= total
+            if now - state['last'] < PROGRESS_INTERVAL and not (finished and state['printed']):
+                if finished:
+                    del RunReport._progress[label]
+                return None
+            state.update(last=now, printed=True)
+            if finished:
+                del RunReport._progress[label]
+
+        elapsed = now - state['start']
+        if total:
+            eta = elapsed * (total - done) / done if done else 0
+            print('{}: {}/{} ({:.0f}%), {:.0f} s, ETA {:.0f} s'.format(label, done, total, 100 * done / total, elapsed,
+                                                                        eta), flush=True)
+        else:
+            print('{}: {}, {:.0f} s'.format(label, done, elapsed), flush=True)
+
+    # end of progress()
+
+    @staticmethod
+    def error(err):
+        # the run is reported as failed (the scripts catch their errors and print them)
+        if RunReport._root is not None:
+            RunReport._root.update(status='failed', error=str(err))
+
+    # end of error()
+
+    @staticmethod
+    def _export(record):
+        data = {key: value for key, value in record.items() if not key.startswith('_') and key != 'sections'}
+        for key in ['wall_s', 'cpu_s', 'max_rss_mb']:
+            data[key] = round(data[key], 3)
+        data['sections' if record is not RunReport._root else 'stages'] = \
+            [RunReport._export(section) for section in record['sections'].values()]
+
+        return data
+
+    # end of _export()
+
+    @staticmethod
+    def save():
+        # the report is saved once at the end of the run (it is called at the exit),
+        # an uncaught exception fails the run
+        if RunReport._root is None or RunReport._saved:
+            return None
+        RunReport._saved = True
+
+        if RunReport._profiler:
+            RunReport._profiler.disable()
+            RunReport._profiler.dump_stats(RunReport._root['profile'])
+        if RunReport._pyspy:  # py-spy writes the profile on SIGINT
+            RunReport._pyspy.send_signal(signal.SIGINT)
+            RunReport._pyspy.wait(timeout=60)
+
+        root = RunReport._root
+        with RunReport._lock:
+            root['wall_s'] = time.perf_counter() - root['_wall']
+            root['cpu_s'] = time.process_time() - root['_cpu']
+            RunReport._update_peak_rss()
+        last_exception = getattr(sys, 'last_value', None)
+        if last_exception is not None and root['status'] == 'ok':
+            root.update(status='failed', error=repr(last_exception))
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        root['children_cpu_s'] = round(children.ru_utime + children.ru_stime, 3)
+        root['children_max_rss_mb'] = round(children.ru_maxrss / 1024, 3)
+        root['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+        try:
+            with open(RunReport._report_file, 'w') as f:
+                json.dump(RunReport._export(root), f, indent=2)
+        except OSError as err:
+            print('WARNING: the run report is not saved: {}'.format(err))
+
+        return RunReport._report_file
+
+    # end of save()
+
+# end of class RunReport
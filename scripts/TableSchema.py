@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""TableSchema.py: The registry of compact column types for MetaPept tables"""
+
+__author__ = "Dmitry Malko"
+
+
+import argparse
+import pandas as pd
+import numpy as np
+from CSVtools import CSV
+
+try:  # Arrow strings are optional, object strings are kept without pyarrow
+    import pyarrow
+    STRING = 'string[pyarrow]'
+except ImportError:
+    STRING = None
+
+CATEGORY = 'category'
+
+# the known columns of input and intermediate tables:
+# low-cardinality labels are categorical, sequences and free text are strings, integers are downcast
+# (float metrics are kept as float64 because they are written back to the output files)
+SCHEMAS = {
+    'maxquant_msms': {  # msms.txt (MaxQuant and MSF_combiner.py)
+        'Raw file': CATEGORY, 'Sequence': STRING, 'Modified sequence': STRING, 'Proteins': STRING,
+        'Matches': STRING, 'Intensities': STRING, 'Fragmentation': CATEGORY, 'Mass analyzer': CATEGORY,
+        'Type': CATEGORY, 'Reverse': CATEGORY, 'Scan number': 'int32', 'Length': 'int16', 'Charge': 'int8',
+        'Missed cleavages': 'int8'
+    },
+    'maxquant_peptides': {  # peptides.txt (MaxQuant and MSF_combiner.py)
+        'Sequence': STRING, 'Proteins': STRING, 'Leading razor protein': STRING, 'Gene names': STRING,
+        'Reverse': CATEGORY, 'Potential contaminant': CATEGORY, 'Contaminant': CATEGORY, 'Charges': CATEGORY,
+        'Amino acid before': CATEGORY, 'First amino acid': CATEGORY, 'Last amino acid': CATEGORY,
+        'Amino acid after': CATEGORY, 'Length': 'int16', 'Missed cleavages': 'int8'
+    },
+    'fragpipe_psm': {  # psm.tsv (FragPipe)
+        'Spectrum': STRING, 'Spectrum File': CATEGORY, 'Peptide': STRING, 'Modified Peptide': STRING,
+        'Prev AA': CATEGORY, 'Next AA': CATEGORY, 'Assigned Modifications': STRING, 'Protein': STRING,
+        'Protein ID': STRING, 'Entry Name': STRING, 'Gene': STRING, 'Mapped Genes': STRING,
+        'Mapped Proteins': STRING, 'Charge': 'int8', 'Peptide Length': 'int16', 'Protein Start': 'int32',
+        'Protein End': 'int32', 'Number of Missed Cleavages': 'int8'
+    },
+    'fragpipe_combined_peptide': {  # combined_peptide.tsv (FragPipe and MSF_combined_peptide_maker.py)
+        'Peptide Sequence': STRING, 'Prev AA': CATEGORY, 'Next AA': CATEGORY, 'Charges': CATEGORY,
+        'Protein': STRING, 'Protein ID': STRING, 'Entry Name': STRING, 'Gene': STRING, 'Mapped Genes': STRING,
+        'Mapped Proteins': STRING, 'Peptide Length': 'int16', 'Start': 'int32', 'End': 'int32'
+    },
+    'prism_annotated': {  # *.pep.annotated.csv.gz (PEAKS/PRISM) after normalization of column names
+        'Source_File': CATEGORY, 'Sequence': STRING, 'Feature': STRING, 'Genome': CATEGORY, 'Location': STRING,
+        'Gene': STRING, 'Symbol': STRING, 'ORF_location': STRING, 'Category': CATEGORY, 'Decoy': CATEGORY,
+        'HLA_allele': CATEGORY, 'Databases_PRISM': CATEGORY, 'Scan': 'int32', 'Length': 'int16',
+        'Location_count': 'int32', 'Top_location_count': 'int32', 'Top_location_count_no_decoy': 'int32'
+    },
+    'sample_description': {  # sample_description.csv
+        'Source_File': CATEGORY, 'Sample_Name': CATEGORY, 'Sample_Replica': 'int16', 'Sample_Type': CATEGORY,
+        'Group': CATEGORY, 'Experiment': CATEGORY
+    },
+    'imp_output': {  # IMP_filtered.csv and the combined IMP table (scan_combiner.py) after normalization
+        'Sequence': STRING, 'Sequence_Permutations': STRING, 'Permutation_Index': 'int16', 'hits': 'int8',
+        'CDS': STRING, 'nuORFs': STRING, 'HLA_Allele': CATEGORY, 'HLA_affinity': CATEGORY, 'Length': 'int16',
+        'Experiment': CATEGORY, 'IMP_Status_over_sequence': CATEGORY, 'BestHit_MSFsample': CATEGORY
+    },
+    'integration_output': {  # outputs of pipeline_integrator.py and integration_filter.py
+        'Sequence': STRING, 'Source_File': CATEGORY, 'Best_PRISM_Replica': CATEGORY, 'Sample_Name': CATEGORY,
+        'Sample_Type': CATEGORY, 'Group': CATEGORY, 'Categories': CATEGORY, 'Databases_PRISM': CATEGORY,
+        'Status_over_sequence': CATEGORY, 'HLA_allele': CATEGORY, 'HLA_Allele': CATEGORY,
+        'Filtered_HLA_allele': CATEGORY, 'Decoy': CATEGORY, 'Integration': CATEGORY, 'Genome': CATEGORY,
+        'Scan': 'int32', 'Length': 'int16'
+    }
+}
+
+
+class TableSchema:
+    @staticmethod
+    def get(table):
+        if table not in SCHEMAS:
+            raise ValueError('ERROR: unknown table schema {}'.format(table))
+
+        return SCHEMAS[table]
+
+    # end of get()
+
+    @staticmethod
+    def apply(data, table):
+        # compact types for the known columns of the table, the other columns are not changed;
+        # integers are downcast only if there are no missing values and all values fit the type
+        for column, dtype in TableSchema.get(table).items():
+            if column not in data.columns or dtype is None:
+                continue
+
+            values = data[column]
+            if dtype in [CATEGORY, STRING]:
+                if pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+                    data[column] = values.astype(dtype)
+            elif pd.api.types.is_integer_dtype(values) and len(values.index):
+                limits = np.iinfo(dtype)
+                if limits.min <= values.min() and values.max() <= limits.max:
+                    data[column] = values.astype(dtype)
+
+        return data
+
+    # end of apply()
+
+    @staticmethod
+    def memory_report(data, table):
+        # memory usage of the columns (MB) before and after applying the schema
+        before = data.memory_usage(index=False, deep=True)
+        compact = TableSchema.apply(data.copy(), table)
+        after = compact.memory_usage(index=False, deep=True)
+        report = pd.DataFrame({
+            'Type': data.dtypes.astype(str),
+            'Compact_type': compact.dtypes.astype(str),
+            'MB': before / 2 ** 20,
+            'Compact_MB': after / 2 ** 20
+        })
+        report.loc['TOTAL'] = ['', '', report['MB'].sum(), report['Compact_MB'].sum()]
+
+        return report
+
+    # end of memory_report()
+
+# end of class TableSchema
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A script to report the memory usage of a table '
+                                                 'with the inferred and compact column types')
+    parser.add_argument('-i', required=True, help='CSV/TSV file (it can be gzipped)')
+    parser.add_argument('-t', required=True, choices=list(SCHEMAS.keys()), help='table schema')
+    parser.add_argument('-o', required=False, help='output file for the report (default: stdout)')
+
+    args = parser.parse_args()
+    input_file = args.i
+    table = args.t
+    output_file = args.o
+
+    try:
+        data = CSV.read(input_file)
+        report = TableSchema.memory_report(data, table)
+        if output_file:
+            CSV.write(report, output_file, sep='\t', index=True, float_format='%.3f')
+        else:
+            with pd.option_context('display.max_rows', None, 'display.width', 200):
+                print(report.round(3))
+            print('memory usage: {:.1f} MB -> {:.1f} MB'.format(report.at['TOTAL', 'MB'],
+                                                                report.at['TOTAL', 'Compact_MB']))
+    except Exception as err:
+        print('Something went wrong: {}'.format(err))
+
+    return None
+
+# end of main()
+
+
+if __name__ == '__main__':
+    main()
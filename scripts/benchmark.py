@@ -0,0 +1,728 @@
+#!/usr/bin/env python3
+
+"""benchmark.py: A benchmark suite for MetaPept scripts on synthetic data of several sizes"""
+
+__author__ = "Dmitry Malko"
+
+
+import os
+import re
+import sys
+import time
+import gzip
+import shutil
+import hashlib
+import argparse
+import subprocess
+import importlib.util
+import numpy as np
+import pandas as pd
+import CSVtools
+from CSVtools import CSV
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+NETMHC_DUMMY = os.path.join(SCRIPTS_DIR, '..', 'tools', 'netMHCdummy')
+
+AMINO_ACIDS = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+NUCLEOTIDES = np.array(list('ACGT'))
+ALLELES = ['HLA-A*02:01', 'HLA-B*07:02', 'HLA-C*07:02']  # PRISM notation, IMP notation is HLA-A02:01
+PRISM_CATS = ['frameshift', 'prio2']
+ORIGINS = ['CDS', 'nuORFs', 'Extra', 'none']  # the sources of synthetic peptides
+ORIGIN_SHARES = [0.6, 0.2, 0.1, 0.1]
+PRISM_CATEGORIES = {'CDS': ['CDS'], 'nuORFs': ['UTR5', 'OffFrame', 'ncRNA'], 'Extra': ['Extra'], 'none': ['Intergenic']}
+IMP_RUNS = {'Canonical': ['CDS'], 'Aeffect': ['CDS', 'nuORFs', 'none'], 'Peffect': ['CDS', 'Extra', 'none']}
+RSS_LAUNCHER = ('import sys, resource, subprocess; code = subprocess.call(sys.argv[2:]); '
+                'open(sys.argv[1], "w").write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)); '
+                'sys.exit(code)')
+STAGES = ['IMP', 'MSF_combiner', 'scan_validation', 'scan_combiner', 'prism_combiner', 'pipeline_integrator',
+          'integration_filter', 'FastFastaSearch', 'integration_filter.exp']
+
+
+class SyntheticData:
+    # the synthetic inputs of MetaPept scripts: all tables are drawn from the same peptide-spectrum matches (PSMs),
+    # so MaxQuant, FragPipe, PRISM and IMP tables share the scans of the raw files as in a real project.
+    # size is the number of distinct peptides, the numbers of PSMs and proteins are proportional to it
+    def __init__(self, output_dir, size, raw_files=4, seed=0):
+        self._output = output_dir
+        self._size = size
+        self._n_raw = raw_files
+        self._rng = np.random.default_rng(seed)
+        self._proteins = {}
+        self._peptides = None
+        self._psms = None
+        self._description = None
+
+    def _random_strings(self, alphabet, lengths):
+        letters = self._rng.choice(alphabet, int(np.sum(lengths)))
+        ends = np.cumsum(lengths)
+
+        return [''.join(letters[end - n:end]) for n, end in zip(lengths, ends)]
+
+    def _get_categories(self, origins):
+        categories = np.empty(len(origins), dtype=object)
+        for origin, names in PRISM_CATEGORIES.items():
+            rows = origins == origin
+            categories[rows] = self._rng.choice(names, rows.sum())
+
+        return categories
+
+    def _path(self, *names):
+        path = os.path.join(self._output, *names)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        return path
+
+    def _write_fasta(self, file_name, headers, sequences):
+        with open(self._path('proteome', file_name), 'w') as f:
+            for header, sequence in zip(headers, sequences):
+                f.write('>{}\n{}\n'.format(header, sequence))
+
+    def make_proteome(self):
+        # CDS and nuORF proteins; Extra proteins have PRISM-like headers with the off-frame tail of the sequence
+        n_proteins = max(50, self._size // 20)
+        for name, n in [('CDS', n_proteins), ('nuORFs', n_proteins // 2), ('Extra', n_proteins // 4)]:
+            sequences = self._random_strings(AMINO_ACIDS, self._rng.integers(100, 800, n))
+            if name == 'CDS':
+                headers = ['CDS_{}'.format(i) for i in range(n)]
+            elif name == 'nuORFs':
+                headers = ['nuORF_{}'.format(i) for i in range(n)]
+            else:
+                tails = self._rng.integers(15, 40, n)
+                patterns = self._random_strings(NUCLEOTIDES, np.full(n, 10))
+                sites = self._rng.choice(['P1_emptyA', 'P1_Asite', 'P1_Psite'], n)
+                headers = ['{}_count{}_F{}_ENST{:011d}.1_GENE{}_{}_{}'.format(site, i % 5 + 1, i, i, i, seq[-tail:],
+                                                                              pattern)
+                           for i, (site, seq, tail, pattern) in enumerate(zip(sites, sequences, tails, patterns))]
+            self._proteins[name] = (headers, sequences)
+
+        self._write_fasta('CDS.fasta', *self._proteins['CDS'])
+        self._write_fasta('nuORFdb.fasta', *self._proteins['nuORFs'])
+        self._write_fasta('Extra.fasta', *self._proteins['Extra'])
+
+    def make_peptides(self):
+        # peptides of 8-14 amino acids are cut from the proteins (the random ones are not in any database)
+        n = self._size * 2  # the duplicates are dropped
+        origins = self._rng.choice(ORIGINS, n, p=ORIGIN_SHARES)
+        lengths = self._rng.integers(8, 15, n)
+        records = []
+        for origin in ORIGINS:
+            rows = np.flatnonzero(origins == origin)
+            if origin == 'none':
+                records.append(pd.DataFrame({'Row': rows, 'Sequence': self._random_strings(AMINO_ACIDS, lengths[rows]),
+                                             'Origin': origin, 'Hit': None}))
+                continue
+
+            headers, sequences = self._proteins[origin]
+            proteins = self._rng.integers(0, len(sequences), len(rows))
+            protein_lengths = np.array([len(sequence) for sequence in sequences])[proteins]
+            starts = (self._rng.random(len(rows)) * (protein_lengths - lengths[rows] + 1)).astype(int)
+            peptides = [sequences[i][start:start + length] for i, start, length in zip(proteins, starts, lengths[rows])]
+            # the hit in the format of FastFastaSearch.py: peptide_position/protein_length:header
+            hits = ['{}_{}/{}:{}'.format(peptide, start + 1, length, headers[i])
+                    for peptide, start, length, i in zip(peptides, starts, protein_lengths, proteins)]
+            records.append(pd.DataFrame({'Row': rows, 'Sequence': peptides, 'Origin': origin, 'Hit': hits}))
+
+        peptides = pd.concat(records).sort_values('Row').drop(columns=['Row'])
+        self._peptides = peptides.drop_duplicates(subset=['Sequence']).head(self._size).reset_index(drop=True)
+
+        # a part of the known peptides is in the peptide database (HLA ligand atlas)
+        atlas = self._peptides['Sequence'].sample(frac=0.3, random_state=self._rng.integers(2 ** 31))
+        self._write_fasta('HLA_atlas.fasta', ['ligand_{}'.format(i) for i in range(len(atlas))], atlas)
+
+    def make_description(self):
+        raw = np.arange(self._n_raw)
+        self._description = pd.DataFrame({
+            'Source_File': ['raw_{}.raw'.format(i) for i in raw],
+            'Sample_Name': ['S{}'.format(i // 2 + 1) for i in raw],
+            'Sample_Replica': raw % 2 + 1,
+            'Sample_Type': np.where(raw // 2 % 2, 'ko', 'wt'),
+            'Group': 'G1',
+        })
+        self._description['Experiment'] = self._description['Sample_Name'] + ' ' + \
+            self._description['Sample_Replica'].astype(str) + ' HLA-I'
+        CSV.write(self._description, self._path('sample_description.csv'))
+        with open(self._path('hla_alleles.csv'), 'w') as f:
+            f.write('\n'.join([allele.replace('*', '') for allele in ALLELES]) + '\n')
+
+    def make_psms(self):
+        # 1-3 PSMs of each peptide, the scan numbers are unique in each raw file
+        n_psms = self._rng.integers(1, 4, len(self._peptides.index))
+        psms = self._peptides.loc[np.repeat(self._peptides.index, n_psms)].reset_index(drop=True)
+        n = len(psms.index)
+        psms['Raw'] = self._rng.integers(0, self._n_raw, n)
+        psms['Scan'] = 0
+        for raw, rows in psms.groupby('Raw').indices.items():
+            psms.loc[rows, 'Scan'] = self._rng.choice(len(rows) * 3, len(rows), replace=False) + 1
+        psms['Charge'] = self._rng.integers(1, 5, n)
+        psms['Mass'] = np.round(self._rng.random(n) * 1000 + 800, 4)
+        psms['RT'] = np.round(self._rng.random(n) * 120, 3)
+        psms['PEP'] = np.round(self._rng.random(n) * 0.05, 6)
+        psms['Score'] = np.round(self._rng.random(n) * 200, 3)
+        psms['Delta'] = np.round(psms['Score'] * self._rng.random(n), 3)
+        psms['Intensity'] = np.round(self._rng.random(n) * 1e7, 1)
+        self._psms = psms
+
+    def make_maxquant(self):
+        psms = self._psms
+        n = len(psms.index)
+        ions = np.array(['y1', 'y2', 'y3', 'y4', 'b2', 'b3', 'b4', 'a2', 'y4-H2O', 'b5'])
+        msms = pd.DataFrame({
+            'Raw file': 'raw_' + psms['Raw'].astype(str),
+            'Scan number': psms['Scan'],
+            'Sequence': psms['Sequence'],
+            'Length': psms['Sequence'].str.len(),
+            'Missed cleavages': self._rng.integers(0, 3, n),
+            'Proteins': self._rng.choice(['P{}'.format(i) for i in range(100)], n),
+            'Charge': psms['Charge'],
+            'Mass': psms['Mass'],
+            'Retention time': psms['RT'],
+            'PEP': psms['PEP'],
+            'Score': psms['Score'],
+            'Delta score': psms['Delta'],
+            'Matches': [';'.join(x) for x in self._rng.choice(ions, (n, 5))],
+            'Intensities': [';'.join(x) for x in self._rng.integers(1, 999, (n, 5)).astype(str)],
+        })
+        CSV.write(msms, self._path('maxquant', 'msms.txt'))
+
+        peptides = self._peptides
+        n = len(peptides.index)
+        intensity = psms.groupby('Sequence', sort=False)['Intensity'].sum()
+        CSV.write(pd.DataFrame({
+            'Sequence': peptides['Sequence'],
+            'N-term cleavage window': 'X',
+            'Amino acid before': self._rng.choice(['K', 'R'], n),
+            'First amino acid': peptides['Sequence'].str[0],
+            'Length': peptides['Sequence'].str.len(),
+            'Missed cleavages': self._rng.integers(0, 3, n),
+            'Proteins': self._rng.choice(['P{}'.format(i) for i in range(100)], n),
+            'Leading razor protein': self._rng.choice(['P{}'.format(i) for i in range(100)], n),
+            'Charges': self._rng.choice(['2', '2;3', '3'], n),
+            'PEP': np.round(self._rng.random(n) * 0.05, 6),
+            'Score': np.round(self._rng.random(n) * 200, 3),
+            'Intensity': peptides['Sequence'].map(intensity).to_numpy(),
+            'Contaminant': np.where(self._rng.random(n) < 0.02, '+', ''),
+            'MS/MS Count': peptides['Sequence'].map(psms['Sequence'].value_counts()).to_numpy(),
+        }), self._path('maxquant', 'peptides.txt'))
+
+    def make_fragpipe(self):
+        # psm.tsv of each raw file and combined_peptide.tsv of the run
+        psms = self._psms
+        experiments = self._description['Experiment']
+        for raw, rows in psms.groupby('Raw'):
+            n = len(rows.index)
+            name = 'raw_{}'.format(raw)
+            CSV.write(pd.DataFrame({
+                'Spectrum': ['{}.{:05d}.{:05d}.{}'.format(name, scan, scan, charge)
+                             for scan, charge in zip(rows['Scan'], rows['Charge'])],
+                'Spectrum File': '/data/{}/interact-{}.pep.xml'.format(name, name),
+                'Peptide': rows['Sequence'],
+                'Modified Peptide': '',
+                'Prev AA': self._rng.choice(AMINO_ACIDS, n),
+                'Next AA': self._rng.choice(AMINO_ACIDS, n),
+                'Peptide Length': rows['Sequence'].str.len(),
+                'Charge': rows['Charge'],
+                'Retention': rows['RT'],
+                'Calculated Peptide Mass': rows['Mass'],
+                'Expectation': rows['PEP'],
+                'Hyperscore': np.round(rows['Score'] / 5, 3),
+                'Nextscore': np.round((rows['Score'] - rows['Delta']) / 5, 3),
+                'PeptideProphet Probability': np.round(1 - rows['PEP'], 6),
+                'Intensity': rows['Intensity'],
+                'Protein': 'sp|P1|PROT1_HUMAN',
+            }), self._path('fragpipe', name, 'psm.tsv'))
+
+        peptides = self._peptides
+        n = len(peptides.index)
+        combined = pd.DataFrame({
+            'Peptide Sequence': peptides['Sequence'],
+            'Prev AA': self._rng.choice(AMINO_ACIDS, n),
+            'Next AA': self._rng.choice(AMINO_ACIDS, n),
+            'Start': self._rng.integers(1, 500, n),
+            'Peptide Length': peptides['Sequence'].str.len(),
+            'Charges': self._rng.choice(['2', '2,3', '3'], n),
+            'Protein': 'sp|P1|PROT1_HUMAN',
+        })
+        counts = psms.groupby(['Sequence', 'Raw']).size().unstack(fill_value=0)
+        intensities = psms.groupby(['Sequence', 'Raw'])['Intensity'].sum().unstack()
+        for raw, experiment in enumerate(experiments):
+            combined[experiment + ' Spectral Count'] = peptides['Sequence'].map(counts.get(raw)).fillna(0).astype(int)
+            combined[experiment + ' Intensity'] = peptides['Sequence'].map(intensities.get(raw)).to_numpy()
+            combined[experiment + ' MaxLFQ Intensity'] = combined[experiment + ' Intensity']
+            combined[experiment + ' Match Type'] = np.where(combined[experiment + ' Spectral Count'] > 0, 'MS/MS', '')
+        CSV.write(combined, self._path('fragpipe', 'combined_peptide.tsv'))
+
+    def make_prism(self):
+        # *.pep.annotated.csv.gz files of each category and raw file: most of the PSMs are found de novo,
+        # the rest are random sequences and decoys; the files are gzipped without the block index as PRISM output
+        for raw, rows in self._psms.groupby('Raw'):
+            description = self._description.iloc[raw]
+            for cat in PRISM_CATS:
+                found = rows.sample(frac=0.7, random_state=self._rng.integers(2 ** 31))
+                n_noise = len(found.index) // 3
+                noise = self._random_strings(AMINO_ACIDS, self._rng.integers(8, 15, n_noise))
+                sequences = pd.concat([found['Sequence'], pd.Series(noise)])
+                origins = pd.concat([found['Origin'], pd.Series(['none'] * n_noise)])
+                n = len(sequences.index)
+                ranks = np.round(self._rng.random((n, len(ALLELES))) * 4, 3)
+                data = pd.DataFrame({
+                    'Source File': description['Source_File'],
+                    'Feature': ['F{}'.format(i) for i in range(n)],
+                    'Scan': np.concatenate([found['Scan'], self._rng.integers(1, len(rows.index) * 3, n_noise)]),
+                    'ALC (%)': self._rng.integers(50, 100, n),
+                    'Length': sequences.str.len().to_numpy(),
+                    'RT': np.round(self._rng.random(n) * 120, 3),
+                    'Mass': np.round(self._rng.random(n) * 1000 + 800, 4),
+                    'ppm': np.round(self._rng.random(n) * 10 - 5, 2),
+                    'ID': self._rng.integers(0, 9, n),
+                    'Location count': self._rng.integers(1, 3, n),
+                    'Genome': 'hs',
+                    'Location': self._rng.choice(['chr1:100', 'chr2:200', '-'], n),
+                    'Sequence': sequences.to_numpy(),
+                    'Top location count': 1,
+                    'Top location count (no decoy)': 1,
+                    'Q': np.round(self._rng.random(n) * 0.2, 4),
+                    'Gene': self._rng.choice(['G1', 'G2', '-'], n),
+                    'Symbol': self._rng.choice(['S1', 'S2'], n),
+                    'ORF location': self._rng.choice(['o1', 'o2'], n),
+                    'Category': self._get_categories(origins.to_numpy()),
+                    'Decoy': np.where(self._rng.random(n) < 0.1, 'D', ''),
+                    'Intensity': np.where(self._rng.random(n) < 0.1, np.nan, np.round(self._rng.random(n) * 1e6, 1)),
+                    'Denovo score': 1,
+                    'Predict RT': 1,
+                    'HLA allele': np.array(ALLELES)[ranks.argmin(axis=1)],
+                    'netMHC % rank': ranks.min(axis=1),
+                })
+                for i, allele in enumerate(ALLELES):
+                    data[allele] = ranks[:, i]
+
+                file_name = '{}.{}_{}.csv.gz.pep.annotated.csv.gz'.format(cat, description['Sample_Name'],
+                                                                         description['Sample_Replica'])
+                file_path = CSV.write(data, self._path('prism', file_name), sep=',')
+                os.remove(file_path + '.idx')
+
+    def make_imp(self):
+        # IMP_filtered.csv tables of a canonical and two experimental runs (the inputs of scan_validation.py):
+        # the experimental runs reassign a part of the canonical scans to their own peptides
+        alleles = [allele.replace('*', '') for allele in ALLELES]
+        experiments = self._description['Experiment']
+        cds_psms = self._psms[self._psms['Origin'] == 'CDS']
+        for run, origins in IMP_RUNS.items():
+            psms = self._psms[self._psms['Origin'].isin(origins)].copy()
+            if run != 'Canonical':
+                conflicts = psms.index[(psms['Origin'] != 'CDS') & (self._rng.random(len(psms.index)) < 0.1)]
+                donors = cds_psms.sample(len(conflicts), replace=True, random_state=self._rng.integers(2 ** 31))
+                psms.loc[conflicts, ['Raw', 'Scan']] = donors[['Raw', 'Scan']].to_numpy()
+            psms['Coverage'] = np.round(self._rng.random(len(psms.index)) * 100, 1)
+            psms = psms.sort_values('Score', ascending=False, kind='stable').drop_duplicates(subset=['Sequence', 'Raw'])
+
+            pivot = psms.set_index(['Sequence', 'Raw'])[['Scan', 'Score', 'Delta', 'PEP', 'Charge', 'Mass', 'RT',
+                                                         'Coverage']].unstack('Raw')
+            pivot.columns = ['{} {}'.format(metric, experiments.iloc[raw]) for metric, raw in pivot.columns]
+            metrics = {'Scan': 'Scan number', 'Delta': 'Delta score', 'RT': 'Retention time', 'Coverage': 'coverage'}
+            pivot = pivot.rename(columns=lambda x: re.sub(r'^(\w+)', lambda m: metrics.get(m.group(1), m.group(1)), x))
+            pivot = pivot[['{} {}'.format(metric, experiment)
+                           for metric in ['Scan number', 'Score', 'Delta score', 'PEP', 'Charge', 'Mass',
+                                          'Retention time', 'coverage']
+                           for experiment in experiments if '{} {}'.format(metric, experiment) in pivot.columns]]
+
+            peptides = self._peptides[self._peptides['Sequence'].isin(pivot.index)].reset_index(drop=True)
+            n = len(peptides.index)
+            ranks = np.round(self._rng.random((n, len(alleles))) * 2, 3)
+            data = pd.DataFrame({
+                'Sequence': peptides['Sequence'],
+                'Sequence_Permutations': peptides['Sequence'],
+                'Permutation_Index': 0,
+                'CDS': peptides['Hit'].where(peptides['Origin'] == 'CDS'),
+                'nuORFs': peptides['Hit'].where(peptides['Origin'].isin(['nuORFs', 'Extra'])),
+                'hits': peptides['Origin'].map({'CDS': -5, 'nuORFs': -3, 'Extra': -3, 'none': -1}),
+                'N-term cleavage window': 'X',
+                'Length': peptides['Sequence'].str.len(),
+                'Missed cleavages': self._rng.integers(0, 3, n),
+                'Proteins': self._rng.choice(['P{}'.format(i) for i in range(100)], n),
+                'Leading razor protein': self._rng.choice(['P{}'.format(i) for i in range(100)], n),
+                'Charges': self._rng.choice(['2', '2;3', '3'], n),
+                'PEP': np.round(self._rng.random(n) * 0.05, 6),
+                'Score': np.round(self._rng.random(n) * 200, 3),
+                'Intensity': np.round(self._rng.random(n) * 1e7, 1),
+                'Contaminant': np.nan,
+                'ssrc_hydrophobicity': np.round(peptides['Sequence'].str.len() * 1.5, 1),
+                'Peptide': peptides['Sequence'],
+            })
+            for i, allele in enumerate(alleles):
+                data[allele + ' EL_Rank'] = ranks[:, i]
+            data['HLA rank'] = ranks.min(axis=1)
+            data['HLA Allele'] = np.array(alleles)[ranks.argmin(axis=1)]
+            data['HLA affinity'] = np.where(data['HLA rank'] < 0.5, 'SB', 'WB')
+            for i, allele in enumerate(alleles):
+                data[allele + ' Aff(nM)'] = np.round(50000 ** (1 - ranks[:, i] / 3), 2)
+            data = data.merge(pivot, left_on='Sequence', right_index=True, how='left')
+
+            CSV.write(data, self._path('imp', run, 'IMP_filtered.csv'), sep=',')
+
+    def make(self):
+        self.make_proteome()
+        self.make_peptides()
+        self.make_description()
+        self.make_psms()
+        self.make_maxquant()
+        self.make_fragpipe()
+        self.make_prism()
+        self.make_imp()
+
+        return self._output
+
+# end of class SyntheticData
+
+
+def get_stages(data_dir, output_dir):
+    # the stages in the pipeline order: command, output files, upstream stages and python modules they need;
+    # the stages downstream of IMP start from the generated IMP tables (IMP needs R and netMHCpan)
+    data = lambda *names: os.path.join(data_dir, *names)
+    out = lambda *names: os.path.join(output_dir, *names)
+    description = data('sample_description.csv')
+    python = sys.executable
+
+    stages = [
+        {'name': 'IMP', 'after': [], 'modules': ['rpy2'], 'dirs': [out('IMP')],
+         'command': [python, 'IMP.py', '--dummy', '--unfiltered', '-b', NETMHC_DUMMY, '-d', data('proteome'),
+                     '-c', 'CDS.fasta', '-n', 'nuORFdb.fasta', '-s', description, '-a', data('hla_alleles.csv'),
+                     '-i', data('maxquant'), '-o', out('IMP')],
+         'outputs': [out('IMP', 'IMP_filtered.csv'), out('IMP', 'IMP_unfiltered.csv')]},
+        {'name': 'MSF_combiner', 'after': [], 'modules': [], 'copy': (data('fragpipe'), out('fragpipe')),
+         'command': [python, 'MSF_combiner.py', '-d', out('fragpipe'), '-c', 'combined_peptide.tsv'],
+         'outputs': [out('fragpipe', 'peptides.txt'), out('fragpipe', 'msms.txt')]},
+        {'name': 'scan_validation', 'after': [], 'modules': [], 'dirs': [out('Aeffect'), out('Peffect')],
+         'command': [python, 'scan_validation.py', '-a', data('imp', 'Aeffect', 'IMP_filtered.csv'),
+                     data('imp', 'Peffect', 'IMP_filtered.csv'), '-b', data('imp', 'Canonical', 'IMP_filtered.csv'),
+                     '-o', out('Aeffect'), out('Peffect')],
+         'outputs': [out('Aeffect', 'IMP_scan_validation.csv'), out('Peffect', 'IMP_scan_validation.csv')]},
+        {'name': 'scan_combiner', 'after': ['scan_validation'], 'modules': [],
+         'command': [python, 'scan_combiner.py', '-s', description, '-i', out('Aeffect', 'IMP_scan_validation.csv'),
+                     out('Peffect', 'IMP_scan_validation.csv'), '-n', 'A_effect', 'P_effect',
+                     '-o', out('mq_combined.csv'), '-db', out('mq_combined.db')],
+         'outputs': [out('mq_combined.csv')]},
+        {'name': 'prism_combiner', 'after': [], 'modules': [],
+         'command': [python, 'prism_combiner.py', '-s', description, '-cat'] + PRISM_CATS +
+                    ['-i', data('prism'), '-r', '2.0', '-o', out('prism_combined.binders.csv'),
+                     '-decoy_o', out('prism_combined.decoy.csv')],
+         'outputs': [out('prism_combined.binders.csv'), out('prism_combined.decoy.csv')]},
+        {'name': 'pipeline_integrator', 'after': ['scan_combiner', 'prism_combiner'], 'modules': ['Levenshtein'],
+         'command': [python, 'pipeline_integrator.py', '-s', description, '-imp', out('mq_combined.csv'),
+                     '-denovo', out('prism_combined.binders.csv'), '-o', out('scan_integration.csv')],
+         'outputs': [out('combined_scan_integration.csv'), out('denovo_unique_scan_integration.csv'),
+                     out('imp_unique_scan_integration.csv')]},
+        {'name': 'integration_filter', 'after': ['pipeline_integrator'], 'modules': [],
+         'command': [python, 'integration_filter.py', '-com', out('combined_scan_integration.csv'),
+                     '-denovo', out('denovo_unique_scan_integration.csv'), '-o', out('scan_integration.filtered.csv')],
+         'outputs': [out('scan_integration.filtered.csv')]},
+        {'name': 'FastFastaSearch', 'after': ['integration_filter'], 'modules': [],
+         'command': [python, 'FastFastaSearch.py', '-i', out('scan_integration.filtered.csv'), '-p', 'Sequence',
+                     '-k', '8', '14', '-bloom', '0.01',
+                     '-d', 'Canonical', data('proteome', 'CDS.fasta'), 'protein', 'i2l',
+                     '-d', 'HLA_atlas_WEB', data('proteome', 'HLA_atlas.fasta'), 'peptide', 'i2l',
+                     '-d', 'Extra', data('proteome', 'Extra.fasta'), 'protein', 'i2l',
+                     '-o', out('scan_integration.filtered.databases.csv')],
+         'outputs': [out('scan_integration.filtered.databases.csv')]},
+        {'name': 'integration_filter.exp', 'after': ['FastFastaSearch'], 'modules': [],
+         'command': [python, 'integration_filter.exp.py', '-i', out('scan_integration.filtered.databases.csv'),
+                     '-o', out('scan_integration.experimental.csv')],
+         'outputs': [out('scan_integration.experimental.csv')]},
+    ]
+
+    return stages
+
+# end of get_stages()
+
+
+def get_checksum(file_path):
+    # MD5 of the decompressed content: the checksum does not depend on the compression of the output
+    md5 = hashlib.md5()
+    opener = gzip.open if CSV.get_compression(file_path) == 'gzip' else open
+    with opener(file_path, 'rb') as f:
+        for piece in iter(lambda: f.read(2 ** 20), b''):
+            md5.update(piece)
+
+    return md5.hexdigest()
+
+# end of get_checksum()
+
+
+def run_command(command, log_file, scripts_dir):
+    # wall time, CPU time (s) and peak resident memory (MB) of the command. The peak memory of a forked child
+    # includes the memory of the parent at the fork, so the command is started by a small python process
+    # which reports the peak memory of its child (the CPU time of wait4 includes the waited descendants)
+    usage_file = log_file + '.rss'
+    start = time.perf_counter()
+    with open(log_file, 'w') as log:
+        process = subprocess.Popen([sys.executable, '-c', RSS_LAUNCHER, usage_file] + command, cwd=scripts_dir,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        pid, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    with open(usage_file) as f:
+        max_rss = int(f.read()) / 1024
+    os.remove(usage_file)
+
+    return process.returncode, wall_time, usage.ru_utime + usage.ru_stime, max_rss
+
+# end of run_command()
+
+
+def run_stage(stage, status, output_dir, scripts_dir):
+    record = {'Stage': stage['name'], 'Status': 'skipped', 'Time_s': None, 'CPU_s': None, 'Max_RSS_MB': None,
+              'Note': ''}
+
+    missing = [module for module in stage['modules'] if importlib.util.find_spec(module) is None]
+    failed = [name for name in stage['after'] if status.get(name) != 'ok']
+    if missing:
+        record['Note'] = 'no python module {}'.format(', '.join(missing))
+        return record, []
+    if failed:
+        record['Note'] = 'no output of {}'.format(', '.join(failed))
+        return record, []
+
+    for dir_path in stage.get('dirs', []):
+        os.makedirs(dir_path, exist_ok=True)
+    if 'copy' in stage:  # the stage writes the output into its input directory
+        shutil.copytree(*stage['copy'])
+
+    log_file = os.path.join(output_dir, 'logs', stage['name'] + '.log')
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    code, wall_time, cpu_time, max_rss = run_command(stage['command'], log_file, scripts_dir)
+    record.update({'Time_s': round(wall_time, 3), 'CPU_s': round(cpu_time, 3), 'Max_RSS_MB': round(max_rss, 1)})
+
+    # the scripts catch their errors, so the log and the outputs are checked as well as the exit code
+    with open(log_file, 'rt', errors='replace') as f:
+        error = re.search(r'Something went wrong: (.*)|(\w+Error: .*)', f.read())
+    missing_outputs = [file_path for file_path in stage['outputs'] if not os.path.exists(file_path)]
+    if code or error or missing_outputs:
+        record['Status'] = 'failed'
+        record['Note'] = error.group(0) if error else 'exit code {}'.format(code) if code else \
+            'no output {}'.format(os.path.basename(missing_outputs[0]))
+        return record, []
+
+    record['Status'] = 'ok'
+    checksums = [(os.path.relpath(file_path, output_dir), get_checksum(file_path)) for file_path in stage['outputs']]
+
+    return record, checksums
+
+# end of run_stage()
+
+
+def fit_scaling(report):
+    # the exponent of the time growth (time ~ size^k) by the least squares fit in log-log scale
+    rows = []
+    data = report[(report['Status'] == 'ok') & (report['Time_s'] > 0)]
+    for stage, records in data.groupby('Stage', sort=False):
+        row = {'Stage': stage}
+        for record in records.itertuples():
+            row['Time_s_{}'.format(record.Size)] = record.Time_s
+        if records['Size'].nunique() > 1:
+            row['Exponent'] = round(np.polyfit(np.log(records['Size']), np.log(records['Time_s']), 1)[0], 2)
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+# end of fit_scaling()
+
+
+def compare_golden(checksums, golden_file):
+    # the checksums are compared with the golden ones of the same size and seed
+    if not golden_file or not os.path.exists(golden_file):
+        checksums['Golden'] = 'new'
+        return checksums
+
+    golden = CSV.read(golden_file, dtype={'MD5': str})
+    checksums = checksums.merge(golden.rename(columns={'MD5': 'Golden_MD5'}), on=['Size', 'Seed', 'Stage', 'File'],
+                                how='left')
+    checksums['Golden'] = np.where(checksums['Golden_MD5'].isna(), 'new',
+                                   np.where(checksums['MD5'] == checksums['Golden_MD5'], 'ok', 'changed'))
+
+    return checksums.drop(columns=['Golden_MD5'])
+
+# end of compare_golden()
+
+
+def benchmark(work_dir, sizes, stages, raw_files, seed, scripts_dir):
+    records = []
+    checksums = []
+    for size in sizes:
+        size_dir = os.path.join(work_dir, str(size))
+        shutil.rmtree(size_dir, ignore_errors=True)  # FASTA indexes of the previous run must not be reused
+        data_dir = os.path.join(size_dir, 'data')
+        output_dir = os.path.join(size_dir, 'output')
+        os.makedirs(output_dir)
+
+        print('size {}: generating data ...'.format(size), end='', flush=True)
+        start = time.perf_counter()
+        SyntheticData(data_dir, size, raw_files, seed).make()
+        print('OK ({:.1f} s)'.format(time.perf_counter() - start))
+
+        status = {}
+        for stage in get_stages(data_dir, output_dir):
+            if stage['name'] not in stages:
+                continue
+            record, stage_checksums = run_stage(stage, status, output_dir, scripts_dir)
+            status[stage['name']] = record['Status']
+            records.append(dict(Size=size, **record))
+            checksums += [(size, seed, stage['name'], file_name, md5) for file_name, md5 in stage_checksums]
+            print('  {:24s} {:8s} {}'.format(stage['name'], record['Status'],
+                                             '{:.2f} s, {:.0f} MB'.format(record['Time_s'], record['Max_RSS_MB'])
+                                             if record['Status'] == 'ok' else record['Note']))
+
+    report = pd.DataFrame(records, columns=['Size', 'Stage', 'Status', 'Time_s', 'CPU_s', 'Max_RSS_MB', 'Note'])
+    checksums = pd.DataFrame(checksums, columns=['Size', 'Seed', 'Stage', 'File', 'MD5'])
+
+    return report, checksums
+
+# end of benchmark()
+
+
+def make_io_table(n_rows, seed):
+    # an msms.txt-like table: strings, integers, floats with all digits of the repr and missing values
+    rng = np.random.default_rng(seed)
+    index = pd.Series(np.arange(n_rows)).astype(str)
+    data = pd.DataFrame({'Raw file': 'raw_' + pd.Series(rng.integers(0, 4, n_rows)).astype(str),
+                         'Scan number': rng.integers(1, 100000, n_rows), 'Sequence': 'PEPTIDE' + index + 'K',
+                         'Proteins': np.where(rng.random(n_rows) < 0.5, 'sp|P0|G0;sp|P1|G1', 'tr|Q0|G2'),
+                         'Charge': rng.integers(1, 5, n_rows), 'Mass': rng.random(n_rows) * 2000 + 500,
+                         'Score': rng.random(n_rows) * 200, 'PEP': rng.random(n_rows) ** 5,
+                         'Intensity': np.where(rng.random(n_rows) < 0.3, np.nan, np.round(rng.random(n_rows) * 1e7))})
+
+    return data
+
+# end of make_io_table()
+
+
+def benchmark_io(work_dir, n_rows, seed):
+    # the time (s) of CSVtools reads and writes on the C and pyarrow paths and of the pandas calls they replaced:
+    # engine='python' for msms.txt, the default C parser for gzip tables, to_csv() with gzip level 9
+    io_dir = os.path.join(work_dir, 'io')
+    os.makedirs(io_dir, exist_ok=True)
+    data = make_io_table(n_rows, seed)
+    txt_file, gz_file, csv_file = [os.path.join(io_dir, name) for name in ['msms.txt', 'table.csv.gz', 'table.csv']]
+    data.to_csv(txt_file, sep='\t', index=False)
+    CSV.write(data, gz_file)
+
+    def timed(function):
+        start = time.perf_counter()
+        result = function()
+        return round(time.perf_counter() - start, 2), result
+
+    engines = {'C': None, 'pyarrow': CSVtools.ENGINE}
+    operations = [
+        ('read msms.txt', lambda: pd.read_csv(txt_file, sep='\t', engine='python'), lambda: CSV.read(txt_file)),
+        ('read annotated .csv.gz', lambda: pd.read_csv(gz_file, sep='\t'), lambda: CSV.read(gz_file)),
+        ('write output .csv.gz', lambda: data.to_csv(os.path.join(io_dir, 'before.csv.gz'), sep='\t', index=False),
+         lambda: CSV.write(data, os.path.join(io_dir, 'after.csv.gz'))),
+        ('write plain .csv', lambda: data.to_csv(csv_file, sep='\t', index=False), lambda: CSV.write(data, csv_file))
+    ]
+
+    records = []
+    for name, before, after in operations:
+        record = {'Operation': name, 'Before_s': timed(before)[0]}
+        results = []
+        for engine_name, engine in engines.items():
+            if engine_name == 'pyarrow' and engine is None:
+                record[engine_name + '_s'] = None
+                continue
+            CSVtools.ENGINE = engine  # the parser of CSV.read() is switched for the measurement
+            try:
+                record[engine_name + '_s'], result = timed(after)
+            finally:
+                CSVtools.ENGINE = engines['pyarrow']
+            results.append(result)
+        if name.startswith('read'):  # the float policy: both parsers give the same frame
+            record['Same_output'] = len(results) < 2 or results[0].equals(results[1])
+        records.append(record)
+        print('  {:24s} {}'.format(name, ', '.join(['{} {}'.format(key, value) for key, value in record.items()
+                                                    if key != 'Operation'])))
+
+    shutil.rmtree(io_dir, ignore_errors=True)
+
+    return pd.DataFrame(records, columns=['Operation', 'Before_s', 'C_s', 'pyarrow_s', 'Same_output'])
+
+# end of benchmark_io()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A benchmark of MetaPept scripts on synthetic data: the stages are '
+                                                 'timed with the peak memory at several data sizes, the scaling '
+                                                 'of time and the checksums of outputs are reported')
+    parser.add_argument('-o', default='benchmark', required=False, help='working directory (default: benchmark)')
+    parser.add_argument('-sizes', nargs='+', type=int, default=[1000, 10000, 100000], required=False,
+                        help='data sizes: the numbers of distinct peptides (default: 1000 10000 100000)')
+    parser.add_argument('-stages', nargs='+', choices=STAGES, default=STAGES, required=False,
+                        help='stages to run (default: all)')
+    parser.add_argument('-raw', type=int, default=4, required=False, help='the number of raw files (default: 4)')
+    parser.add_argument('-seed', type=int, default=0, required=False, help='random seed of the data (default: 0)')
+    parser.add_argument('-scripts', default=SCRIPTS_DIR, required=False,
+                        help='directory of the scripts to benchmark, for example another version of MetaPept '
+                             '(default: the directory of this script)')
+    parser.add_argument('-golden', required=False,
+                        help='file with the golden checksums of outputs to compare with (Size, Seed, Stage, File, MD5)')
+    parser.add_argument('-save_golden', action='store_true', help='save the checksums as the golden ones')
+    parser.add_argument('-io', type=int, required=False,
+                        help='the number of rows of the CSVtools I/O benchmark which is run instead of the stages')
+
+    args = parser.parse_args()
+    work_dir = os.path.abspath(args.o)
+    sizes = sorted(set(args.sizes))
+    stages = args.stages
+    raw_files = args.raw
+    seed = args.seed
+    scripts_dir = os.path.abspath(args.scripts)
+    golden_file = args.golden
+    save_golden = args.save_golden
+    io_rows = args.io
+
+    if save_golden and not golden_file:
+        parser.error('-save_golden needs the golden file (-golden)')
+
+    if io_rows:
+        try:
+            print('I/O of {} rows (seed {}):'.format(io_rows, seed))
+            report = benchmark_io(work_dir, io_rows, seed)
+            CSV.write(report, os.path.join(work_dir, 'benchmark.io.tsv'))
+        except Exception as err:
+            print('Something went wrong: {}'.format(err))
+        print('Benchmark: done')
+        return None
+
+    try:
+        report, checksums = benchmark(work_dir, sizes, stages, raw_files, seed, scripts_dir)
+        scaling = fit_scaling(report)
+        checksums = compare_golden(checksums, None if save_golden else golden_file)
+
+        CSV.write(report, os.path.join(work_dir, 'benchmark.tsv'))
+        CSV.write(scaling, os.path.join(work_dir, 'benchmark.scaling.tsv'))
+        CSV.write(checksums, os.path.join(work_dir, 'benchmark.checksums.tsv'))
+        if save_golden:  # the checksums of other sizes and seeds are kept
+            golden = checksums.drop(columns=['Golden'])
+            if os.path.exists(golden_file):
+                golden = pd.concat([CSV.read(golden_file, dtype={'MD5': str}), golden])
+                golden = golden.drop_duplicates(subset=['Size', 'Seed', 'Stage', 'File'], keep='last')
+            CSV.write(golden.sort_values(['Size', 'Seed', 'Stage', 'File']), golden_file)
+
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print('\nscaling (time ~ size^Exponent):')
+            print(scaling.to_string(index=False) if len(scaling.index) else 'no successful stages')
+        print('\nchecksums: ' + (', '.join(['{} {}'.format(n, status) for status, n in
+                                             checksums['Golden'].value_counts().items()]) or 'no outputs'))
+        changed = checksums[checksums['Golden'] == 'changed']
+        if len(changed.index):
+            print('WARNING: the outputs differ from the golden checksums!')
+            print(changed.to_string(index=False))
+    except Exception as err:
+        print('Something went wrong: {}'.format(err))
+
+    print('Benchmark: done')
+
+    return None
+
+# end of main()
+
+
+if __name__ == '__main__':
+    main()
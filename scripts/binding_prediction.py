@@ -7,6 +7,9 @@ import pandas as pd
 from glob import glob
 import shutil
 from typing import Callable
+from CSVtools import CSV
+from PeptideDict import PeptideDict
+from RunReport import RunReport
 
 
 list_of_tools = ['Dummy', 'netMHCpan', 'netMHCIIpan']
@@ -94,26 +97,29 @@ class BindingPredictor:
         tool = tool_class()
 
         if allele_file:
-            alleles = pd.read_csv(allele_file, header=None)
+            alleles = CSV.read(allele_file, sep=',', header=None)
             alleles = alleles.iloc[:, 0].values
             tool.set(alleles)
 
-        peptides = set()  # the full set of unique peptides
+        peptides = PeptideDict()  # the full set of unique peptides
         for file in self._files:
-            data = pd.read_csv(file, compression='gzip', sep=',', header=0)
-            pept = list(data['Sequence'])
-            peptides.update(pept)
+            data = CSV.read(file, sep=',', usecols=['Sequence'])
+            peptides.intern(data['Sequence'])
 
-        prediction = tool.predict(peptides)
+        with RunReport.section('binding prediction'):
+            prediction = tool.predict(peptides.get_sequences())
+        prediction.insert(0, 'Peptide_ID', peptides.get_ids(prediction.pop('Sequence')))
 
         upd_files = []
         for file in self._files:
-            data = pd.read_csv(file, compression='gzip', sep=',', header=0)
-            data = pd.merge(data, prediction, on=['Sequence'], how='left')
-            data.to_csv(file, compression='gzip', sep=',')
+            data = CSV.read(file, sep=',')
+            data['Peptide_ID'] = peptides.get_ids(data['Sequence'])
+            data = pd.merge(data, prediction, on=['Peptide_ID'], how='left').drop(columns=['Peptide_ID'])
+            CSV.write(data, file, sep=',', index=True, compression='gzip')
 
             print('{} is updated'.format(re.sub(r'.*/', '', file)))
             upd_files.append(file)
+            RunReport.progress('Updating annotated files', len(upd_files), len(self._files))
 
         return upd_files
 
@@ -134,11 +140,13 @@ def main():
     tool = args.t
     allele_file = args.a
 
+    RunReport.start('binding_prediction', input_dir)  # the annotated files are updated in place
     try:
         bp = BindingPredictor(input_dir)
         bp.run(tool, allele_file)
     except Exception as err:
         print("Something went wrong:", err)
+        RunReport.error(err)
 
     print('...done')
 
@@ -7,8 +7,10 @@ import sys
 import gzip
 import pandas as pd
 import numpy as np
+from functools import lru_cache
 from difflib import SequenceMatcher
 from CSVtools import CSV
+from RunReport import RunReport
 
 
 COLUMNS_SET1 = ['^Seq$', '^Chimera$', '^Out_Frame$', '^Pattern$', '^DB$', 'Source_db$', '^Source_File$',
@@ -23,6 +25,14 @@ COLUMNS_SET2 = ['^Gene_ID$', '^Gene_Name$', '^nuORFs$', '^Hits$', '^Proteins$',
            '^BestHit_Hyperscore$', '^BestHit_Deltascore$', '^Integration$',
            '^HLA_atlas_WEB$', '^HLA_atlas_PRISM$', '^IEDB$', '^iREAD$', '^GATK$', '^Extra$']
 
+# the fields of a FASTA header record in Extra column
+HEADER_FIELDS = ['peptide', 'pos', 'pseq_len', 'site_type', 'db', 'source_db', 'pattern', 'in_frame', 'out_frame',
+                 'gene_id', 'gene_name']
+
+# new columns based on the header records of the peptide itself
+EXTRA_FIELDS = {'Gene_ID': 'gene_id', 'Gene_Name': 'gene_name', 'Pattern': 'pattern', 'Out_Frame': 'out_frame',
+                'DB': 'db', 'Source_db': 'source_db'}
+
 
 def get_samples(data):
     samples = []
@@ -38,66 +48,54 @@ def get_samples(data):
 # end of get_samples()
 
 
-def walk_across_samples(row, sample, update_column):
-    num_replicas = 0
-    for column in list(row.index):
-        if re.search(r'Scan_number_{}_.*_(?:HLA|MHC)_.*'.format(sample), column):
-            if not np.isnan(row[column]):
-                num_replicas += 1
+def count_replicas(data, sample):
+    # how many replicas of the sample have a scan number for the peptide
+    columns = data.filter(regex=r'Scan_number_{}_.*_(?:HLA|MHC)_.*'.format(sample))
+
+    return columns.notna().sum(axis=1)
 
-    row[update_column] = num_replicas
-    return row
+# end of count_replicas()
 
-# end of walk_across_samples()
 
+@lru_cache(maxsize=None)
+def parse_header_item(item):  # to parse one record of Extra column (the same headers are repeated across rows)
+    peptide, header = re.split(':', item)
+    peptide, pos = re.split('_', peptide)
+    pos, pseq_len = re.split('/', pos)
+
+    # FORMAT (DEFAULT): AAAAGALPR_8/17:P1_emptyA_count3_F487_ENST00000611612.2_TTC34_LPRP_GGCCTTTGCC
+    # FORMAT (OOF): QATTVLHIL_132/180:P1_Asite_count1_F52_ENST00000629496.3_DDX3X_PPHLRNREATKGF_TIKTVQGGVLAKIR_AGGTTTCTAC
+    site_type, rest = re.split('_count', header)
+    items = re.split('_', rest)
+    if len(items) == 6:  # FORMAT DEFAULT
+        count, f_num, gene_id, gene_name, out_frame, pattern = items
+        in_frame = None
+    elif len(items) == 7:  # FORMAT OOF
+        count, f_num, gene_id, gene_name, in_frame, out_frame, pattern = items
+    else:
+        raise ValueError('ERROR: wrong FASTA header')
+
+    source_db = None
+    if re.search('emptyA', site_type):
+        source_db = 'Aeffect'
+    elif re.search('Psite|Asite', site_type):
+        source_db = 'Peffect'
 
-def parse_header(body):  # to parse Extra column
-    records = {}
-    if not pd.isnull(body):
-        num = 0
+    return peptide, pos, pseq_len, site_type, site_type, source_db, pattern, in_frame, out_frame, gene_id, gene_name
+
+# end of parse_header_item()
+
+
+def explode_headers(extra):
+    # one row per FASTA header record for each distinct value of Extra column
+    records = []
+    for body in pd.unique(extra.dropna()):
         for item in re.split(',', body):
-            peptide, header = re.split(':', item)
-            peptide, pos = re.split('_', peptide)
-            pos, pseq_len = re.split('/', pos)
-
-            # FORMAT (DEFAULT): AAAAGALPR_8/17:P1_emptyA_count3_F487_ENST00000611612.2_TTC34_LPRP_GGCCTTTGCC
-            # FORMAT (OOF): QATTVLHIL_132/180:P1_Asite_count1_F52_ENST00000629496.3_DDX3X_PPHLRNREATKGF_TIKTVQGGVLAKIR_AGGTTTCTAC
-            site_type, rest = re.split('_count', header)
-            items = re.split('_', rest)
-            if len(items) == 6:  # FORMAT DEFAULT
-                count, f_num, gene_id, gene_name, out_frame, pattern = items
-                in_frame = None
-            elif len(items) == 7:  # FORMAT OOF
-                count, f_num, gene_id, gene_name, in_frame, out_frame, pattern = items
-            else:
-                raise ValueError('ERROR: wrong FASTA header')
-
-            if peptide not in records:
-                records[peptide] = []
-
-            source_db = None
-            if re.search('emptyA', site_type):
-                source_db = 'Aeffect'
-            elif re.search('Psite|Asite', site_type):
-                source_db = 'Peffect'
-
-            records[peptide].append({
-                'num': num + 1,
-                'pos': pos,
-                'pseq_len': pseq_len,
-                'site_type': site_type,
-                'db': site_type,
-                'source_db': source_db,
-                'pattern': pattern,
-                'in_frame': in_frame,
-                'out_frame': out_frame,
-                'gene_id': gene_id,
-                'gene_name': gene_name
-            })
-
-    return records
-
-# end of parse_header()
+            records.append((body,) + parse_header_item(item))
+
+    return pd.DataFrame(records, columns=['Extra'] + HEADER_FIELDS)
+
+# end of explode_headers()
 
 
 def matching(string1, string2):
@@ -152,65 +150,71 @@ def overlap(peptide, pos, pseq_len, off_frame, in_frame=None):
 # end of matching()
 
 
-def multi_matching(pseq, extra, unique=False):
-    # Wrap-up function for overlap()
+def join_unique(records, keys, field, casefold=False):
+    # comma-separated sorted set of the field values for each key
+    values = records[keys + [field]].dropna().drop_duplicates()
+    values = values.sort_values(field, key=lambda x: x.str.casefold() if casefold else x, kind='stable')
 
-    matches = []
-    if pd.notna(pseq) and pd.notna(extra):
-        header_data = parse_header(extra)
-        if pseq not in header_data:
-            raise ValueError('ERROR: can not find the peptide sequence ({}) in the FASTA file header'.format(pseq))
+    return values.groupby(keys, sort=False)[field].agg(','.join)
 
-        for peptide in header_data:
-            for rec in header_data[peptide]:
-                matches.append(overlap(peptide, int(rec['pos']), int(rec['pseq_len']), rec['out_frame'], rec['in_frame']))
+# end of join_unique()
 
-        if unique:
-            matches = sorted(set(matches))
 
-    return ','.join(matches) if len(matches) else None
+def annotate_from_extra(data):
+    # to create new columns based on Extra column information (each FASTA header is parsed only once)
+    keys = ['Sequence', 'Extra']
+    pairs = data[keys].dropna().drop_duplicates()
+    headers = explode_headers(pairs['Extra'])
 
-# end of multi_matching()
+    # chimeric sequences are computed once per distinct header record
+    chimeras = {}
+    sequences = []
+    for rec in headers[['peptide', 'pos', 'pseq_len', 'out_frame', 'in_frame']].itertuples(index=False, name=None):
+        if rec not in chimeras:
+            peptide, pos, pseq_len, out_frame, in_frame = rec
+            chimeras[rec] = overlap(peptide, int(pos), int(pseq_len), out_frame, in_frame)
+        sequences.append(chimeras[rec])
+    headers['Seq'] = sequences
 
+    records = pairs.merge(headers, on='Extra', how='inner')
+    own_records = records[records['peptide'] == records['Sequence']]
 
-def set_from_extra(pseq, body, category, field, unique=False):
-    # to create new columns based on Extra column information
+    found = pairs.merge(own_records[keys].drop_duplicates(), on=keys, how='left', indicator=True)
+    missing = found.loc[found['_merge'] == 'left_only', 'Sequence']
+    if len(missing):
+        raise ValueError('ERROR: can not find the peptide sequence ({}) in the FASTA file header'.format(missing.iloc[0]))
 
-    records = parse_header(body)
-    patterns = []
-    if re.search('Extra', str(category)):  # only `Extra` category will be treated
-        if pseq in records:
-            for item in records[pseq]:
-                patterns.append(item[field])
-        else:
-            return None
+    annotation = pd.DataFrame({'Seq': join_unique(records, keys, 'Seq')})
+    for column, field in EXTRA_FIELDS.items():
+        annotation[column] = join_unique(own_records, keys, field, casefold=True)
 
-        if unique:
-            patterns = sorted(set(patterns), key=str.casefold)
+    data = data.drop(columns=['Seq'] + list(EXTRA_FIELDS.keys()), errors='ignore')
+    data = data.merge(annotation.reset_index(), on=keys, how='left')
 
-        return ','.join(patterns) if len(patterns) else None
+    # only `Extra` category will be treated
+    not_extra = ~data['Categories'].astype(str).str.contains('Extra')
+    data.loc[not_extra, list(EXTRA_FIELDS.keys())] = None
 
-    return None
+    return data
 
-# end of set_from_extra()
+# end of annotate_from_extra()
 
 
 def make_table(file_name, sb_threshold, wb_threshold, all_data=False):
     csv.field_size_limit(sys.maxsize)
-    data = pd.read_csv(file_name, sep=CSV.get_delimiter(file_name), engine='python')
+    data = CSV.read(file_name)
     # remove canonical to mitigate Denovo (PRISM) annotation errors
     data = data[data['Canonical'].isna()]
 
     # column set
-    column_names = COLUMNS_SET1
+    column_names = list(COLUMNS_SET1)
 
     # combine MQ sample information for each peptide: how many replicas have exposed the peptide
     mq_column_names = []
     for sample in get_samples(data):
         mq_column_name = 'IMP_' + sample
-        data = data.assign(mq_column_name=0)
+        data[mq_column_name] = count_replicas(data, sample)
         mq_column_names.append('^' + mq_column_name + '$')
-        data = data.apply(walk_across_samples, args=(sample, mq_column_name), axis=1)
         data.rename(columns={sample: 'DENOVO_' + sample}, inplace=True)
         column_names.append('^DENOVO_' + sample + '$')
 
@@ -221,31 +225,10 @@ def make_table(file_name, sb_threshold, wb_threshold, all_data=False):
         data = data[data['Categories'].str.contains('Extra') & data['Extra'].notna()]
 
     # extract data from Leading razor protein (Extra column)
-    data['HLA_affinity'] = data.apply(
-        lambda x: 'SB' if x['HLA_rank'] < sb_threshold else ('WB' if x['HLA_rank'] < wb_threshold else None), axis=1)
-    data['Gene_ID'] = data.apply(
-        lambda x: set_from_extra(x['Sequence'], x['Extra'], x['Categories'], 'gene_id', unique=True),
-        axis=1)
-    data['Gene_Name'] = data.apply(
-        lambda x: set_from_extra(x['Sequence'], x['Extra'], x['Categories'], 'gene_name', unique=True),
-        axis=1)
-    data['Pattern'] = data.apply(
-        lambda x: set_from_extra(x['Sequence'], x['Extra'], x['Categories'], 'pattern', unique=True),
-        axis=1)
-    data['Out_Frame'] = data.apply(
-        lambda x: set_from_extra(x['Sequence'], x['Extra'], x['Categories'], 'out_frame', unique=True),
-        axis=1)
-    data['DB'] = data.apply(
-        lambda x: set_from_extra(x['Sequence'], x['Extra'], x['Categories'], 'db', unique=True),
-        axis=1)
-    data['Source_db'] = data.apply(
-        lambda x: set_from_extra(x['Sequence'], x['Extra'], x['Categories'], 'source_db', unique=True),
-        axis=1)
-    data['Seq'] = data.apply(
-        lambda x: multi_matching(x['Sequence'], x['Extra'], unique=True),
-        axis=1)
-    data['Chimera'] = data.apply(
-        lambda x: 'y' if pd.notna(x['Seq']) and re.search(r'[A-Z][a-z]', x['Seq']) else 'n', axis=1)
+    data['HLA_affinity'] = np.select([data['HLA_rank'] < sb_threshold, data['HLA_rank'] < wb_threshold],
+                                     ['SB', 'WB'], default=None)
+    data = annotate_from_extra(data)
+    data['Chimera'] = np.where(data['Seq'].str.contains(r'[A-Z][a-z]', na=False), 'y', 'n')
 
     column_set = []
     for name in column_names:
@@ -273,11 +256,15 @@ def main():
     sb_threshold = args.sb
     wb_threshold = args.wb
 
+    RunReport.start('integration_filter.exp', output_file)
     try:
-        data = make_table(input_file, sb_threshold, wb_threshold, all_data)
-        data.to_csv(output_file, sep='\t', index=False)
+        with RunReport.section('make table'):
+            data = make_table(input_file, sb_threshold, wb_threshold, all_data)
+        with RunReport.section('write'):
+            CSV.write(data, output_file)
     except Exception as err:
         print("Something went wrong: {}".format(err))
+        RunReport.error(err)
 
     print('Extended integration filter: done')
 
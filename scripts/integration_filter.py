@@ -4,6 +4,8 @@ import argparse
 import re
 import pandas as pd
 from CSVtools import CSV
+from TableSchema import TableSchema
+from RunReport import RunReport
 
 # DEFAULT FILTERING VALUES
 
@@ -34,7 +36,8 @@ def get_best_delta(row):
 
 
 def combined_filter(input_file, ALC_combined_sufficient, ALC_combined, Coverage, Delta, Hyperscore, Deltascore):
-    data = pd.read_csv(input_file, sep=CSV.get_delimiter(input_file), engine='python')
+    data = CSV.read(input_file)
+    TableSchema.apply(data, 'integration_output')
     data['Best_coverage'] = data.apply(get_best_coverage, axis=1)
     data['Best_delta_score'] = data.apply(get_best_delta, axis=1)
 
@@ -71,7 +74,8 @@ def combined_filter(input_file, ALC_combined_sufficient, ALC_combined, Coverage,
 
 
 def denovo_filter(input_file, ALC_denovo, Q_denovo, HLA_rank):
-    data = pd.read_csv(input_file, sep=CSV.get_delimiter(input_file), engine='python')
+    data = CSV.read(input_file)
+    TableSchema.apply(data, 'integration_output')
     data = data.loc[(data['Best_ALC'] >= ALC_denovo) & (data['Best_Q'] <= Q_denovo)]
     data = data.loc[data['netMHC_rank'] < HLA_rank]
 
@@ -90,7 +94,8 @@ def msf_filter(input_file, hyperscore, deltascore):
     if input_file is None:
         return pd.DataFrame()
 
-    data = pd.read_csv(input_file, sep=CSV.get_delimiter(input_file), engine='python')
+    data = CSV.read(input_file)
+    TableSchema.apply(data, 'integration_output')
     data['CDS'] = data['CDS'].astype(str)
     data['nuORFs'] = data['nuORFs'].astype(str)
 
@@ -119,7 +124,7 @@ def make_output(output_file, com_data, denovo_data, imp_data):
     col_seq = data.pop('Sequence')
 
     data.insert(0, col_seq.name, col_seq)
-    data.to_csv(output_file, sep='\t', index=False)
+    CSV.write(data, output_file)
     return data
 
 # end of make_output()
@@ -159,13 +164,17 @@ def main():
     hyper_msf = args.hyper_msf
     delta_msf = args.delta_msf
 
+    RunReport.start('integration_filter', output_file)
     try:
-        denovo_data = denovo_filter(denovo_file, alc_denovo, q_denovo, rank_denovo)
-        com_data = combined_filter(combined_file, alc_suff, alc_comb, cov_comb, delta_comb, hyper_msf, delta_msf)
-        imp_data = msf_filter(imp_file, hyper_msf, delta_msf)
-        make_output(output_file, com_data, denovo_data, imp_data)
+        with RunReport.section('filter'):
+            denovo_data = denovo_filter(denovo_file, alc_denovo, q_denovo, rank_denovo)
+            com_data = combined_filter(combined_file, alc_suff, alc_comb, cov_comb, delta_comb, hyper_msf, delta_msf)
+            imp_data = msf_filter(imp_file, hyper_msf, delta_msf)
+        with RunReport.section('write'):
+            make_output(output_file, com_data, denovo_data, imp_data)
     except Exception as err:
         print("Something went wrong: {}".format(err))
+        RunReport.error(err)
 
     print('Integration filter: done')
 
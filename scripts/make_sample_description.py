@@ -4,6 +4,8 @@ import re
 import argparse
 import glob
 import pandas as pd
+from CSVtools import CSV
+from RunReport import RunReport
 
 
 def description(input_dir, output_file):
@@ -17,7 +19,7 @@ def description(input_dir, output_file):
                 continue
 
             print('file processing: {} '.format(name), end='')
-            data = pd.read_csv(full_name, compression='gzip', sep=',', quotechar='"', low_memory=False)
+            data = CSV.read(full_name, sep=',', usecols=['Source File'])
             source_files.update(data['Source File'])
             print('...OK')
     else:
@@ -25,7 +27,7 @@ def description(input_dir, output_file):
         for full_name in file_names:
             name = re.sub(r'.*/(.*/)', r'\1', full_name)
             print('file processing: {} '.format(name), end='')
-            data = pd.read_csv(full_name, sep=',', quotechar='"', low_memory=False)
+            data = CSV.read(full_name, sep=',', usecols=['Source File'])
             source_files.update(data['Source File'])
             print('...OK')
 
@@ -36,7 +38,7 @@ def description(input_dir, output_file):
     desc['Group'] = ''
     desc['Experiment'] = ''
 
-    desc.to_csv(output_file, sep='\t', index=False)
+    CSV.write(desc, output_file)
 
     return desc['Source_File'].to_list
 
@@ -54,6 +56,7 @@ def main():
     in_dir = args.i
     out_file = args.o
 
+    RunReport.start('make_sample_description', out_file)
     description(in_dir, out_file)
 
     print('...done')
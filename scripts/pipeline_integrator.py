@@ -2,10 +2,14 @@
 
 import argparse
 import re
+import numpy as np
 import pandas as pd
 import warnings
 import Levenshtein
 from CSVtools import CSV
+from PeptideDict import PeptideDict
+from TableSchema import TableSchema
+from RunReport import RunReport
 
 MQ_COLUMNS2REMOVE = [r'^Charge_.*', r'^Mass_.*', r'term_cleavage_window']
 PRISM_COLUMNS2REMOVE = [r'^Location_count$', r'^Genome$', r'^Top_location_count_no_decoy$',
@@ -14,9 +18,9 @@ PRISM_COLUMNS2REMOVE = [r'^Location_count$', r'^Genome$', r'^Top_location_count_
 
 def normalize_column_names(dataframe):
     warnings.simplefilter(action='ignore', category=FutureWarning)  # to suppress FutureWarning
-    dataframe.columns = dataframe.columns.str.replace('[%()/*:]', '')
-    dataframe.columns = dataframe.columns.str.strip().str.replace('[ .-]', '_')
-    dataframe.columns = dataframe.columns.str.strip().str.replace('_+', '_')
+    dataframe.columns = dataframe.columns.str.replace('[%()/*:]', '', regex=True)
+    dataframe.columns = dataframe.columns.str.strip().str.replace('[ .-]', '_', regex=True)
+    dataframe.columns = dataframe.columns.str.strip().str.replace('_+', '_', regex=True)
 
     return dataframe
 
@@ -96,14 +100,19 @@ def get_filenames(prefix_set, name):
 
 def combine(description_file, mq_file, prism_file, output_file, strict_mode=False):
     try:
-        mq = pd.read_csv(mq_file, sep=CSV.get_delimiter(mq_file), engine='python')
-        prism = pd.read_csv(prism_file, sep=CSV.get_delimiter(prism_file), engine='python')
-        description = pd.read_csv(description_file, sep=CSV.get_delimiter(description_file), engine='python')
+        with RunReport.section('read'):
+            mq = CSV.read(mq_file)
+            prism = CSV.read(prism_file)
+            description = CSV.read(description_file)
     except Exception as err:
         print(err)
+        RunReport.error(err)
     else:
         normalize_column_names(mq)
         normalize_column_names(prism)
+        TableSchema.apply(mq, 'imp_output')
+        TableSchema.apply(prism, 'prism_annotated')
+        TableSchema.apply(description, 'sample_description')
         mq4unique = mq.copy()  # to keep the original data structure for MQ-unique
         delete_columns(MQ_COLUMNS2REMOVE, mq)
         description['Sample_Replica'] = description['Sample_Replica'].astype(str)
@@ -125,49 +134,58 @@ def combine(description_file, mq_file, prism_file, output_file, strict_mode=Fals
         # to delete columns from IMP table with the same name in PRISM table
         column_intersection = set(prism.columns).intersection(mq.columns)
 
+        # IMP rows of each peptide by the peptide IDs
+        peptide_dict = PeptideDict()
+        mq_ids = peptide_dict.intern(mq['Sequence'])
+        prism_ids = peptide_dict.get_ids(prism['Sequence'])
+        mq_rows = pd.Series(mq_ids).groupby(mq_ids).indices
+        mq_rows.pop(PeptideDict.unknown, None)
+        no_rows = np.array([], dtype=int)
+
         shared_rows = []
+        shared_ids = set()
         prism_unique_rows = []
         # debug_n = 0
-        for prism_index, prism_row in prism.iterrows():
-            prism_peptide = prism_row['Sequence']
-            prism_scan_number = prism_row['Scan']
-            if prism_row['Source_File'] in raw2replica and raw2replica[prism_row['Source_File']] in replica2column_name:
-                replica = raw2replica[prism_row['Source_File']]
-                md_scan_colum = replica2column_name[replica]
-                if strict_mode:
-                    # IMP and DENOVO have the same scan number for the peptide in the replica
-                    mq_pept_rows = mq.loc[(mq['Sequence'] == prism_peptide) & (mq[md_scan_colum] == prism_scan_number)]
-                else:
-                    # IMP and DENOVO can have different scan numbers for the peptide in the replica
-                    mq_pept_rows = mq.loc[(mq['Sequence'] == prism_peptide) & (mq[md_scan_colum] > 0)]
-                if len(mq_pept_rows.index):
-                    delete_columns(PRISM_COLUMNS2REMOVE, prism_row)
-                    for mq_index, mq_pept_row in mq_pept_rows.iterrows():
-                        concat = pd.concat([prism_row, mq_pept_row.drop(labels=column_intersection)])
-                        shared_rows.append(pd.Series([replica], index=['Best_PRISM_Replica']).append(concat))
-
+        with RunReport.section('integrate'):
+            for prism_pos, (prism_index, prism_row) in enumerate(prism.iterrows()):
+                RunReport.progress('Integrating DENOVO rows', prism_pos + 1, len(prism.index))
+                prism_scan_number = prism_row['Scan']
+                if prism_row['Source_File'] in raw2replica and \
+                        raw2replica[prism_row['Source_File']] in replica2column_name:
+                    replica = raw2replica[prism_row['Source_File']]
+                    md_scan_colum = replica2column_name[replica]
+                    mq_pept_rows = mq.iloc[mq_rows.get(prism_ids[prism_pos], no_rows)]
+                    if strict_mode:
+                        # IMP and DENOVO have the same scan number for the peptide in the replica
+                        mq_pept_rows = mq_pept_rows.loc[mq_pept_rows[md_scan_colum] == prism_scan_number]
+                    else:
+                        # IMP and DENOVO can have different scan numbers for the peptide in the replica
+                        mq_pept_rows = mq_pept_rows.loc[mq_pept_rows[md_scan_colum] > 0]
+                    if len(mq_pept_rows.index):
+                        shared_ids.add(prism_ids[prism_pos])
+                        delete_columns(PRISM_COLUMNS2REMOVE, prism_row)
+                        for mq_index, mq_pept_row in mq_pept_rows.iterrows():
+                            concat = pd.concat([prism_row, mq_pept_row.drop(labels=column_intersection)])
+                            shared_rows.append(pd.concat([pd.Series([replica], index=['Best_PRISM_Replica']), concat]))
+
+                    else:
+                        prism_unique_rows.append(prism_row)
                 else:
-                    prism_unique_rows.append(prism_row)
-            else:
-                raise ValueError("Can not find DENOVO's sample name in IMP table")
+                    raise ValueError("Can not find DENOVO's sample name in IMP table")
 
         shared_data_output = pd.DataFrame(shared_rows)
         prism_unique_data_output = pd.DataFrame(prism_unique_rows)
 
-        shared_sequences = list(shared_data_output['Sequence'])
-        mq_unique_data_output = mq4unique[~mq4unique['Sequence'].isin(shared_sequences)].copy()
+        mq_unique_data_output = mq4unique[~np.isin(mq_ids, list(shared_ids))].copy()
         delete_columns(MQ_COLUMNS2REMOVE, mq_unique_data_output)
 
         combined_output_file, prism_unique_output_file, mq_unique_output_file = get_filenames(
             ['combined', 'denovo_unique', 'imp_unique'], output_file)
-        if re.search(r'\.gz$', output_file):
-            shared_data_output.to_csv(combined_output_file, compression='gzip', sep='\t', index=False)
-            prism_unique_data_output.to_csv(prism_unique_output_file, compression='gzip', sep='\t', index=False)
-            mq_unique_data_output.to_csv(mq_unique_output_file, compression='gzip', sep='\t', index=False)
-        else:
-            shared_data_output.to_csv(combined_output_file, sep='\t', index=False)
-            prism_unique_data_output.to_csv(prism_unique_output_file, sep='\t', index=False)
-            mq_unique_data_output.to_csv(mq_unique_output_file, sep='\t', index=False)
+        # the outputs are gzipped if the output file name ends with `.gz`
+        with RunReport.section('write'):
+            CSV.write(shared_data_output, combined_output_file)
+            CSV.write(prism_unique_data_output, prism_unique_output_file)
+            CSV.write(mq_unique_data_output, mq_unique_output_file)
 
     return None
 
@@ -191,10 +209,12 @@ def main():
     output_file = args.o
     strict = args.strict
 
+    RunReport.start('pipeline_integrator', output_file)
     try:
         combine(description_file, imp_file, denovo_file, output_file, strict)
     except Exception as err:
         print("Something went wrong:", err)
+        RunReport.error(err)
 
     print('Integration: done')
 
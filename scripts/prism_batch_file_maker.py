@@ -3,10 +3,11 @@
 import re
 import os
 import argparse
-import gzip
 import glob
 import shutil
 import pathlib
+from CSVtools import CSV
+from RunReport import RunReport
 
 LSF_MODULES = ['R/4.1.2.rstudio-foss-2021b', 'jre/8.121']  # TODO: add a command line option to set arbitrary modules
 PRISM_VERSION = 'tools/Peptide-PRISM/Prism_2023-01-16'
@@ -114,6 +115,7 @@ def main():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    RunReport.start('prism_batch_file_maker', output_dir + '/')
     dir_list = os.listdir(input_dir)
 
     with open(batch_file, 'w') as run:
@@ -133,19 +135,16 @@ def main():
                             shutil.copy(hla_files[0], new_hla_file)
                         else:
                             print("No HLA file!")
+                            RunReport.error('no HLA file in {}'.format(name))
                             exit(1)
 
                     all_candidates_file = '/'.join([input_dir, name, ALL_CANDIDATES])
                     new_all_candidates_file = output_dir + '/' + cat + '.' + name + '.csv.gz'
-                    with gzip.open(new_all_candidates_file, 'wb') as fo:
-                        with open(all_candidates_file, 'rb') as fi:
-                            fo.write(fi.read())
-
                     de_novo_pept_file = '/'.join([input_dir, name, DE_NOVO_PEPTIDES])
                     new_de_novo_pept_file = output_dir + '/i' + cat + '.' + name + '.csv.gz'
-                    with gzip.open(new_de_novo_pept_file, 'wb') as fo:
-                        with open(de_novo_pept_file, 'rb') as fi:
-                            fo.write(fi.read())
+                    with RunReport.section('compress'):
+                        CSV.compress(all_candidates_file, new_all_candidates_file)  # BGZF with the block index
+                        CSV.compress(de_novo_pept_file, new_de_novo_pept_file)
 
                     prism_output = output_dir + '/' + cat + '.' + name + '.out'
                     prism_error = output_dir + '/' + cat + '.' + name + '.err'
@@ -162,6 +161,7 @@ def main():
                             extra = ' -extra {}'.format(extra_file)
                         else:
                             print('Error: you use Extra category without extra file!')
+                            RunReport.error('Extra category without extra file')
                             exit(1)
                     command = prism + extra + category + ' -in ' + new_all_candidates_file + ' > ' + prism_output + ' 2> ' + prism_error
                     print(command, file=run)
@@ -4,11 +4,14 @@ import re
 import os
 import argparse
 import pandas as pd
-import sqlite3
-import warnings
+import numpy as np
 import glob
-import csv
-import gzip
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from CSVtools import CSV
+from TableSchema import TableSchema
+from RunReport import RunReport
 
 # INFO: some peptides in PEAKS output files have no Intensity value!
 # In that case you can find a non-zero replica count but zero for all Replica Intensities and zero for Intensity Sum.
@@ -31,25 +34,9 @@ import gzip
 # the pattern for human and mouse HLA allele variants (type I and type II)
 HLA_pattern = r'HLA[-_][ABCEG]\d|D[PQR][AB]\d+[-_]|H[-_]?2[-_][DKLQI]'
 
-
-def get_delimiter(file_path):
-    sniffer = csv.Sniffer()
-    if re.search(r'.gz$', file_path):
-        with gzip.open(file_path, "rt") as f:
-            header = f.readline()
-    else:
-        with open(file_path, "rt") as f:
-            header = f.readline()
-
-    delimiter = sniffer.sniff(header).delimiter
-
-    if delimiter not in ['\t', ',']:
-        file_name = re.sub(r'.*/', '', file_path)
-        raise ValueError('Can not determine CSV delimiter for {} file'.format(file_name))
-
-    return delimiter
-
-# end of get_delimiter()
+# large annotated files with the block index (BGZF files written by binding_prediction.py)
+# are parsed by row ranges of this size in parallel
+PART_ROWS = 500000
 
 
 def counter():  # just for debug
@@ -81,6 +68,29 @@ def get_category(file_path, cat_aliases):
 # end of get_category()
 
 
+def get_categories(file_paths, cat_aliases, decoy_cat_aliases=None):
+    # the category of each file and the peptides kept from it (decoy argument of read_annotated()):
+    # with separate decoy aliases the files of target categories only give target peptides
+    # and the files of decoy categories only give decoy peptides
+    if decoy_cat_aliases is None:
+        return [(get_category(file_path, cat_aliases), None) for file_path in file_paths]
+
+    categories = []
+    for file_path in file_paths:
+        target_cat, decoy_cat = [get_category(file_path, aliases) if any([file_path.find(cat) > -1 for cat in aliases])
+                                 else None for aliases in [cat_aliases, decoy_cat_aliases]]
+        if not target_cat and not decoy_cat:
+            get_category(file_path, cat_aliases)  # no category error
+        if target_cat and decoy_cat and target_cat != decoy_cat:
+            raise ValueError("ERROR: incorrect category in the file name or path {}".format(file_path))
+        decoy = None if target_cat and decoy_cat else not target_cat  # both, decoy or target peptides
+        categories.append((target_cat if target_cat else decoy_cat, decoy))
+
+    return categories
+
+# end of get_categories()
+
+
 def drop_columns(dataframe, column_list):
     for col in column_list:
         if col in dataframe.columns:
@@ -91,11 +101,17 @@ def drop_columns(dataframe, column_list):
 # end of drop_columns()
 
 
+def normalize_column_name(name):
+    name = re.sub(r'[%()/*:]', '', name).strip()
+    name = re.sub(r'[ .-]', '_', name).strip()
+
+    return re.sub(r'_+', '_', name)
+
+# end of normalize_column_name()
+
+
 def normalize_column_names(dataframe):
-    warnings.simplefilter(action='ignore', category=FutureWarning)  # to suppress FutureWarning
-    dataframe.columns = dataframe.columns.str.replace('[%()/*:]', '')
-    dataframe.columns = dataframe.columns.str.strip().str.replace('[ .-]', '_')
-    dataframe.columns = dataframe.columns.str.strip().str.replace('_+', '_')
+    dataframe.columns = [normalize_column_name(col) for col in dataframe.columns]
 
     return dataframe
 
@@ -103,10 +119,9 @@ def normalize_column_names(dataframe):
 
 
 def normalize_allele_names(dataframe):
-    warnings.simplefilter(action='ignore', category=FutureWarning)  # to suppress FutureWarning
-    dataframe['HLA_allele'] = dataframe['HLA_allele'].str.replace('^.$', '')
-    dataframe['HLA_allele'] = dataframe['HLA_allele'].str.replace('[*:]', '')
-    dataframe['HLA_allele'] = dataframe['HLA_allele'].str.replace('-', '_')
+    dataframe['HLA_allele'] = dataframe['HLA_allele'].str.replace('^.$', '', regex=True)
+    dataframe['HLA_allele'] = dataframe['HLA_allele'].str.replace('[*:]', '', regex=True)
+    dataframe['HLA_allele'] = dataframe['HLA_allele'].str.replace('-', '_', regex=False)
 
     return dataframe
 
@@ -128,15 +143,16 @@ def transform_allele_columns(dataframe):
 # end of transform_allele_columns()
 
 
-def check_allele_consistency(dataframe):
+def check_allele_consistency(alleles):
+    # alleles: distinct values of HLA_allele_{n} columns of a group (Field, Value)
     allele_names = []
-    for col in dataframe.columns:
-        if re.search(r'HLA_allele_.*\d', col):
-            hla_alleles = list(dataframe[col].unique())
-            if len(hla_alleles) == 1:
-                allele_names.append(hla_alleles[0])
-            else:
-                return []
+    fields = sorted(alleles['Field'].unique(), key=lambda x: int(re.sub(r'.*_', '', x)))
+    for field in fields:
+        hla_alleles = list(alleles.loc[alleles['Field'] == field, 'Value'].unique())
+        if len(hla_alleles) == 1:
+            allele_names.append(hla_alleles[0])
+        else:
+            return []
 
     return allele_names
 
@@ -162,74 +178,223 @@ def replace_hla_column_names(column_names, dataframe):
 # end of replace_hla_column_names()
 
 
-def combine(input_dir, sample_file, db_file, q_threshold, alc_threshold, rank_threshold, output_file, decoy, cat_aliases):
-    print('Data preparing ...', end='', flush=True)
-    all_data = []
-    for file_path in glob.glob(input_dir + '/**/*.pep.annotated.csv.gz', recursive=True):
-        category = get_category(file_path, cat_aliases)
-        data = pd.read_csv(file_path, compression='gzip', sep=get_delimiter(file_path), engine='python')
-
-        normalize_column_names(data)
-        normalize_allele_names(data)
-        drop_columns(data, ['Denovo_score', 'Predict_RT'])  # drop some columns because of the different file formats
+def read_annotated(file_path, category, decoy, rows=None):
+    # the worker function: decompression, parsing and normalization of one annotated file or its row range
+    data = CSV.read(file_path, rows=rows, threads=1)  # files and row ranges are already read in parallel
+    if rows:  # the same row labels as for the whole file
+        data.index += rows[0]
+
+    normalize_column_names(data)
+    normalize_allele_names(data)
+    drop_columns(data, ['Denovo_score', 'Predict_RT'])  # drop some columns because of the different file formats
+    if decoy is not None:  # both decoy and target peptides are kept if decoy is None
         data = data[data['Decoy'] == 'D'] if decoy else data[data['Decoy'] != 'D']
-        data.insert(len(data.columns), 'Databases_PRISM', category)
-        transform_allele_columns(data)  # it needs to unify table for samples with different HLA alleles
-        all_data.append(data)
+    data.insert(len(data.columns), 'Databases_PRISM', category)
+    transform_allele_columns(data)  # it needs to unify table for samples with different HLA alleles
+    TableSchema.apply(data, 'prism_annotated')
 
-    if not len(all_data):
-        raise ValueError('ERROR: no valid files in the input directory!')
-    all_data = pd.concat(all_data)
+    return data
 
-    if db_file:
-        if os.path.exists(db_file):
-            os.remove(db_file)
-        connector = sqlite3.connect(db_file)
-    else:
-        connector = sqlite3.connect(':memory:')
+# end of read_annotated()
 
-    sample_description = pd.read_csv(sample_file, sep=get_delimiter(sample_file), quotechar='"', low_memory=False)
-    sample_description.to_sql(name='description', con=connector, index=False)
 
-    all_data.index += 1  # to start the index with 1, but not zero
-    all_data.index.name = 'Rec_ID'
+def get_row_ranges(file_path):
+    n_rows = CSV.get_row_count(file_path)
+    if n_rows is None or n_rows <= PART_ROWS:
+        return [None]  # the whole file
 
-#   print(list(all_data.columns))  # for debug
-    all_data.to_sql(name='data', con=connector)
+    return [(start, min(start + PART_ROWS, n_rows)) for start in range(0, n_rows, PART_ROWS)]
 
-    cur = connector.cursor()
-    sql = 'CREATE INDEX source_file_index ON description(Source_File);'
-    cur.execute(sql)
+# end of get_row_ranges()
 
-    sql = 'CREATE TABLE ext_data AS SELECT * FROM data INNER JOIN description USING(Source_File);'
-    cur.execute(sql)
-    connector.commit()
 
-    sql = 'CREATE INDEX group_index ON ext_data("Group");'
-    cur.execute(sql)
+def join_parts(futures):
+    if len(futures) == 1:
+        return futures[0].result()
+
+    # categorical columns of the parts have different categories
+    return TableSchema.apply(pd.concat([future.result() for future in futures]), 'prism_annotated')
+
+# end of join_parts()
 
-    sql = 'SELECT COUNT(*) AS n FROM ext_data;'
-    n_rec_ext_data = pd.read_sql(sql, connector).iloc[0]['n']
-    sql = 'SELECT COUNT(*) AS n FROM data;'
-    n_rec_data = pd.read_sql(sql, connector).iloc[0]['n']
 
-    print('OK')
-    print('Combining groups:')
+def ingest(file_paths, cat_aliases, decoy, threads=None, decoy_cat_aliases=None):
+    # annotated files (or row ranges of large files) are parsed concurrently, the results are yielded
+    # in the order of files and only a limited number of parsed parts is kept in memory
+    categories = get_categories(file_paths, cat_aliases, decoy_cat_aliases)
+    threads = threads if threads else os.cpu_count()
+
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        futures = deque()
+        n_parts = 0
+        for file_path, (category, file_decoy) in zip(file_paths, categories):
+            file_decoy = decoy if file_decoy is None else file_decoy
+            futures.append([executor.submit(read_annotated, file_path, category, file_decoy, rows)
+                            for rows in get_row_ranges(file_path)])
+            n_parts += len(futures[-1])
+            while n_parts >= 2 * threads:
+                n_parts -= len(futures[0])
+                yield join_parts(futures.popleft())
+
+        while len(futures):
+            yield join_parts(futures.popleft())
+
+# end of ingest()
+
+
+class Partitions:
+    # ingested rows are distributed into partitions by Group and hash of Sequence,
+    # the partitions are kept in memory or spilled to disk when the memory limit is exceeded
+
+    def __init__(self, n_buckets=1, mem_limit=None, tmp_dir=None):
+        self._n_buckets = n_buckets
+        self._mem_limit = mem_limit
+        self._tmp_dir = tmp_dir
+        self._buffers = {}
+        self._buffer_size = 0
+        self._spilled = {}
+        self._n_files = 0
+
+    def add(self, data):
+        buckets = pd.util.hash_pandas_object(data['Sequence'], index=False) % self._n_buckets
+        for key, part in data.groupby([data['Group'], buckets], sort=False, observed=True):
+            self._buffers.setdefault(key, []).append(part)
+            self._buffer_size += part.memory_usage(deep=True).sum()
+
+        if self._mem_limit and self._buffer_size > self._mem_limit / 2:
+            self.spill()
+
+    def spill(self):
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        for key, parts in self._buffers.items():
+            self._n_files += 1
+            file_name = os.path.join(self._tmp_dir, 'partition.{}.pkl'.format(self._n_files))
+            pd.concat(parts).to_pickle(file_name)
+            self._spilled.setdefault(key, []).append(file_name)
+
+        self._buffers = {}
+        self._buffer_size = 0
+
+    def groups(self):
+        return sorted(set([key[0] for key in list(self._buffers.keys()) + list(self._spilled.keys())]), key=str)
+
+    def get(self, group):  # partitions of the group one by one, the buffered parts are released
+        for bucket in range(self._n_buckets):
+            parts = self._buffers.pop((group, bucket), [])
+            self._buffer_size -= sum([part.memory_usage(deep=True).sum() for part in parts])
+            parts = parts + [pd.read_pickle(file_name) for file_name in self._spilled.get((group, bucket), [])]
+            if len(parts):
+                yield pd.concat(parts)
 
-    if n_rec_ext_data != n_rec_data:
-        print("You probably have an incorrect file with the description of the samples")
-        sql = 'SELECT DISTINCT Source_File AS Files FROM data;'
-        data_files = '\n'.join(pd.read_sql(sql, connector)['Files'].tolist())
-        print('\nfiles in the data:')
-        print(data_files)
+    def clear(self):
+        for file_names in self._spilled.values():
+            for file_name in file_names:
+                os.remove(file_name)
+        if len(self._spilled) and not len(os.listdir(self._tmp_dir)):
+            os.rmdir(self._tmp_dir)
 
-        sql = 'SELECT DISTINCT Source_File AS Files FROM description;'
-        desc_files = pd.read_sql(sql, connector)['Files'].tolist()
-        print('\nfiles in the description:')
-        print(desc_files)
+        self._buffers = {}
+        self._spilled = {}
 
-        exit(1)
+# end of class Partitions
+
+
+# The fields which are reported as distinct values over all records of a sequence
+CONCAT_FIELDS = {  # in the order of appearance
+    'Categories': 'Category',
+    'Status_over_sequence': 'Sample_Type',
+    'Location': 'Location',
+    'Gene': 'Gene',
+    'Symbol': 'Symbol',
+    'ORF_location': 'ORF_location'
+}
+SORTED_FIELDS = {  # in sorted order
+    'Databases_PRISM': 'Databases_PRISM',
+    'Samples': 'Sample_Name'
+}
+
+
+def reduce_rows(rows):
+    # partial aggregates of records by Group and Sequence, they can be merged with merge_partials()
+    keys = ['Group', 'Sequence']
+
+    # the best record has the minimal Q and netMHC_rank (NULL first as in SQL)
+    best = (rows
+            .sort_values(keys + ['Q', 'netMHC_rank', 'Rec_ID'], na_position='first', kind='stable')
+            .drop_duplicates(keys, keep='first')
+            .drop(columns=['Best_ALC'], errors='ignore')
+            .merge(rows.groupby(keys, sort=False, observed=True)['ALC'].max().rename('Best_ALC').reset_index(), on=keys))
+
+    fields = list(CONCAT_FIELDS.values()) + list(SORTED_FIELDS.values())
+    values = (rows[keys + ['Rec_ID'] + fields]
+              .melt(id_vars=keys + ['Rec_ID'], var_name='Field', value_name='Value')
+              .dropna(subset=['Value'])
+              .groupby(keys + ['Field', 'Value'], sort=False, observed=True)['Rec_ID'].min()
+              .reset_index())
+
+    scans = rows[keys + ['Sample_Name', 'Sample_Replica', 'Scan', 'Rec_ID']].dropna()
+    scans = (scans
+             .assign(Scan=scans['Sample_Name'].astype(str) + '/' + scans['Sample_Replica'].astype(str) + '=' +
+                     scans['Scan'].astype(str))
+             .groupby(keys + ['Sample_Name', 'Sample_Replica', 'Scan'], sort=False, observed=True)['Rec_ID'].min()
+             .reset_index())
 
+    intensity = (rows
+                 .groupby(keys + ['Sample_Name', 'Sample_Replica'], sort=False, observed=True)['Intensity'].max()
+                 .reset_index())
+
+    allele_fields = [col for col in rows.columns if re.search(r'HLA_allele_.*\d', col)]
+    alleles = (rows[['Group'] + allele_fields]
+               .melt(id_vars=['Group'], var_name='Field', value_name='Value')
+               .drop_duplicates())
+
+    return {'best': best, 'values': values, 'scans': scans, 'intensity': intensity, 'alleles': alleles}
+
+# end of reduce_rows()
+
+
+def merge_partials(partials):
+    keys = ['Group', 'Sequence']
+    partials = [partial for partial in partials if partial is not None]
+    if not len(partials):
+        return None
+
+    best = pd.concat([partial['best'] for partial in partials])
+    best_alc = best.groupby(keys, sort=False, observed=True)['Best_ALC'].max().reset_index()
+    best = (best
+            .sort_values(keys + ['Q', 'netMHC_rank', 'Rec_ID'], na_position='first', kind='stable')
+            .drop_duplicates(keys, keep='first')
+            .drop(columns=['Best_ALC'])
+            .merge(best_alc, on=keys))
+
+    values = (pd.concat([partial['values'] for partial in partials])
+              .groupby(keys + ['Field', 'Value'], sort=False, observed=True)['Rec_ID'].min()
+              .reset_index())
+
+    scans = (pd.concat([partial['scans'] for partial in partials])
+             .groupby(keys + ['Sample_Name', 'Sample_Replica', 'Scan'], sort=False, observed=True)['Rec_ID'].min()
+             .reset_index())
+
+    intensity = (pd.concat([partial['intensity'] for partial in partials])
+                 .groupby(keys + ['Sample_Name', 'Sample_Replica'], sort=False, observed=True)['Intensity'].max()
+                 .reset_index())
+
+    alleles = pd.concat([partial['alleles'] for partial in partials]).drop_duplicates()
+
+    return {'best': best, 'values': values, 'scans': scans, 'intensity': intensity, 'alleles': alleles}
+
+# end of merge_partials()
+
+
+def join_values(values, order):
+    values = values.sort_values(order, kind='stable')
+
+    return values.groupby('Sequence', sort=False, observed=True)['Value'].agg(lambda x: ','.join(map(str, x)))
+
+# end of join_values()
+
+
+def finalize_group(partial, group, description, q_threshold, alc_threshold, rank_threshold):
     # FROM Andreas's emails:
     # I typically filter by Q (e.g. Q<0.01 = 1%FDR) and by NetMHC predictions (e.g. rank<2%).
     # I generate this column in Spotfire. Best Q is the lowest Q value for a peptide sequence among all merged samples.
@@ -240,189 +405,314 @@ def combine(input_dir, sample_file, db_file, q_threshold, alc_threshold, rank_th
     # If you compare "best ALC" and "best Q" you will see that the values correlate.
     # Typically, the sequence with the best ALC will have the lowest best Q value. However, there can be exceptions.
 
-    sql = 'SELECT DISTINCT "Group" FROM ext_data;'  # DON'T REMOVE DOUBLE QUOTES AROUND "Group"!!!
-    groups = pd.read_sql(sql, connector)
-    group_number = len(groups['Group'])
-    for group in groups['Group']:
-        sql = 'DROP TABLE IF EXISTS tmp_data;'
-        cur.execute(sql)
-        connector.commit()
-
-        sql = 'SELECT * FROM ext_data WHERE "Group" = "{}";'.format(group)
-        group_data = pd.read_sql(sql, connector)
-        hla_allele_names = check_allele_consistency(group_data)
-        if not len(hla_allele_names):
-            raise ValueError('ERROR: the group {} has inconsistent set of alleles'.format(group))
-
-        if not replace_hla_column_names(hla_allele_names, group_data):
-            raise ValueError('ERROR: column names were not replaced for the group {}'.format(group))
-
-        group_data.to_sql(name='tmp_data', con=connector)
-        sql = 'CREATE INDEX sequence_index ON tmp_data(Sequence);'
-        cur.execute(sql)
-        connector.commit()
-
-        sql = 'SELECT DISTINCT Sequence FROM tmp_data;'
-        peptides = pd.read_sql(sql, connector)
-        data_output = []
-        # n_debug = counter()  # for debug
-        for peptide in peptides['Sequence']:
-            # if n_debug() > 10:  # for debug
-            #     break
-
-            print('group {}  {}'.format(group, peptide) + ' ' * 40, end="\r")
-            sql = 'SELECT * FROM tmp_data WHERE Sequence = "{}" ORDER BY Q, netMHC_rank LIMIT 1;'.format(peptide)
-            best_peptide_rec = pd.read_sql(sql, connector)
-
-            if len(best_peptide_rec.index) and best_peptide_rec.iloc[0]['Q'] < q_threshold:
-                best_q = best_peptide_rec.iloc[0]['Q']  # minimum false discovery rate (FDR)
-                best_sample = best_peptide_rec.iloc[0]['Sample_Name']
-                best_replica = best_peptide_rec.iloc[0]['Sample_Replica']
-
-                sql = 'SELECT ALC FROM tmp_data WHERE Sequence = "{}" ORDER BY ALC DESC LIMIT 1;'.format(peptide)
-                best_alc_rec = pd.read_sql(sql, connector)
-                best_alc = best_alc_rec.iloc[0]['ALC']  # average local confidence (ALC)
-
-                # this is the legacy code for rank filtering, the data cleanup step was added below
-                best_hla = best_peptide_rec.iloc[0]['HLA_allele']
-                filtered_hla = best_hla if re.search(HLA_pattern, best_hla) and \
-                                           best_hla in best_peptide_rec.columns and \
-                                           best_peptide_rec.iloc[0][best_hla] < rank_threshold else ''
-
-                sql = 'SELECT group_concat(DISTINCT Category) AS Categories FROM tmp_data WHERE Sequence = "{}";'.format(peptide)
-                categories_rec = pd.read_sql(sql, connector)
-                categories = categories_rec.iloc[0]['Categories']
-
-                sql = 'SELECT group_concat(DISTINCT Sample_Type) AS Types FROM tmp_data ' \
-                      'WHERE Sequence = "{}";'.format(peptide)
-                status_rec = pd.read_sql(sql, connector)
-                status = status_rec.iloc[0]['Types']
-
-                sql = 'SELECT group_concat(DISTINCT Location) AS Location FROM tmp_data ' \
-                      'WHERE Sequence = "{}";'.format(peptide)
-                status_rec = pd.read_sql(sql, connector)
-                location = status_rec.iloc[0]['Location']
-
-                sql = 'SELECT group_concat(DISTINCT Gene) AS Gene FROM tmp_data ' \
-                      'WHERE Sequence = "{}";'.format(peptide)
-                status_rec = pd.read_sql(sql, connector)
-                gene = status_rec.iloc[0]['Gene']
-
-                sql = 'SELECT group_concat(DISTINCT Symbol) AS Symbol FROM tmp_data ' \
-                      'WHERE Sequence = "{}";'.format(peptide)
-                status_rec = pd.read_sql(sql, connector)
-                symbol = status_rec.iloc[0]['Symbol']
-
-                sql = 'SELECT group_concat(DISTINCT ORF_location) AS ORF_location FROM tmp_data ' \
-                      'WHERE Sequence = "{}";'.format(peptide)
-                status_rec = pd.read_sql(sql, connector)
-                orf_location = status_rec.iloc[0]['ORF_location']
-
-                sql = 'SELECT group_concat(Databases_PRISM) AS Databases_PRISMs FROM ' \
-                      '(SELECT DISTINCT Databases_PRISM FROM tmp_data WHERE Sequence = "{}" ORDER BY Databases_PRISM);'.format(peptide)
-                db_prism_rec = pd.read_sql(sql, connector)
-                db_prism = db_prism_rec.iloc[0]['Databases_PRISMs']
-
-                sql = 'SELECT group_concat(Sample_Name) AS Sample_Names FROM ' \
-                      '(SELECT DISTINCT Sample_Name FROM tmp_data WHERE Sequence = "{}" ORDER BY Sample_Name);'.format(peptide)
-                sample_rec = pd.read_sql(sql, connector)
-                samples = sample_rec.iloc[0]['Sample_Names']
-
-                sql = 'SELECT group_concat(scan) AS Scans FROM ' \
-                      '(SELECT DISTINCT Sample_Name || "/" || Sample_Replica || "=" || Scan AS scan ' \
-                      'FROM tmp_data WHERE Sequence = "{}" ' \
-                      'ORDER BY Sample_Name, Sample_Replica);'.format(peptide)
-                scans_rec = pd.read_sql(sql, connector)
-                all_scans = scans_rec.iloc[0]['Scans']
-
-                sql = 'SELECT DISTINCT Sample_Name FROM description WHERE "Group" = "{}" ' \
-                      'ORDER BY Sample_Name;'.format(group)
-                samples_rec = pd.read_sql(sql, connector)
-                intensity_sum = 0
-                intensities = []
-                replica_counts = []
-                for sam_index, sam_row in samples_rec.iterrows():
-                    sample_name = sam_row['Sample_Name']
-                    sql = 'SELECT DISTINCT Sample_Replica FROM tmp_data ' \
-                          'WHERE Sequence = "{}" AND Sample_Name = "{}";'.format(peptide, sample_name)
-                    replica_count_rec = pd.read_sql(sql, connector)
-                    replica_counts.append({'sample': sample_name,
-                                           'rep_count': len(replica_count_rec['Sample_Replica'].values)
-                                           })
-
-                    sql = 'SELECT DISTINCT Sample_Replica FROM description ' \
-                          'WHERE Sample_Name = "{}" ORDER BY Sample_Replica;'.format(sample_name)
-                    replica_rec = pd.read_sql(sql, connector)
-                    for rep_index, rep_row in replica_rec.iterrows():
-                        sample_replica = rep_row['Sample_Replica']
-                        sql = 'SELECT Intensity FROM tmp_data ' \
-                              'WHERE Sequence = "{}" AND Sample_Name = "{}" AND Sample_Replica = "{}" ' \
-                              'ORDER BY Intensity DESC LIMIT 1;'.format(peptide, sample_name, sample_replica)
-                        intensity_rec = pd.read_sql(sql, connector)
-                        intensity = intensity_rec.iloc[0]['Intensity'] \
-                            if len(intensity_rec.index) and intensity_rec.iloc[0]['Intensity'] else 0
-
-                        intensities.append({'replica': '_'.join([str(sample_name), str(sample_replica)]),
-                                            'intensity': intensity})
-                        intensity_sum += intensity
-
-                hla_columns = [col for col in best_peptide_rec.columns if re.match(HLA_pattern, col)]
-                base_columns = ['Source_File', 'Feature', 'Scan', 'ALC', 'Length', 'RT', 'Mass', 'ppm', 'ID',
-                                'Location_count', 'Genome', 'Location', 'Sequence', 'Top_location_count',
-                                'Top_location_count_no_decoy', 'Q', 'Gene', 'Symbol', 'ORF_location', 'HLA_allele',
-                                'netMHC_rank']
-                data_output_rec = best_peptide_rec[base_columns + hla_columns]
-                data_output_rec = data_output_rec.assign(
-                    Filtered_HLA_allele=filtered_hla,
-                    Best_Q=best_q,
-                    Best_ALC=best_alc,
-                    Best_Q_replica='/'.join([str(best_sample), str(best_replica)]),
-                    Categories=categories,
-                    Status_over_sequence=status,
-                    Databases_PRISM=db_prism,
-                    Samples=samples,
-                    All_scans=all_scans
-                )
-
-                # Updates for some fields to integrate all found entries
-                data_output_rec.loc[0, 'Location'] = location
-                data_output_rec.loc[0, 'Gene'] = gene
-                data_output_rec.loc[0, 'Symbol'] = symbol
-                data_output_rec.loc[0, 'ORF_location'] = orf_location
-
-                replica_report = pd.DataFrame(
-                    [[item['rep_count'] for item in replica_counts]],
-                    columns=[item['sample'] for item in replica_counts]
-                )
-                normalize_column_names(replica_report)
-                data_output_rec = pd.concat([data_output_rec, replica_report], axis=1)
-
-                data_output_rec.insert(len(data_output_rec.columns), 'Intensity_Sum', intensity_sum)
-
-                intensity_report = pd.DataFrame(
-                    [[item['intensity'] for item in intensities]],
-                    columns=['Intensity_' + item['replica'] for item in intensities]
-                )
-                normalize_column_names(intensity_report)
-                data_output_rec = pd.concat([data_output_rec, intensity_report], axis=1)
-                data_output.append(data_output_rec)
-
-        data_output = pd.concat(data_output)
-        data_output = data_output.replace(['-'], '')
-        path = re.split(r'/', output_file)
-        if group_number > 1:  # if there is only one group the output file name won't be modified
-            path[-1] = group + '_' + path[-1]
-        group_output_file = '/'.join(path)
-
-        data_output = data_output[data_output['Best_ALC'] >= alc_threshold]
-        data_output = data_output[data_output['netMHC_rank'] < rank_threshold]
-
-        if re.search(r'\.gz$', group_output_file):
-            data_output.to_csv(group_output_file, compression='gzip', sep='\t', index=False)
-        else:
-            data_output.to_csv(group_output_file, sep='\t', index=False)
+    hla_allele_names = check_allele_consistency(partial['alleles'])
+    if not len(hla_allele_names):
+        raise ValueError('ERROR: the group {} has inconsistent set of alleles'.format(group))
+
+    best = partial['best']
+    best = best[best['Q'] < q_threshold].sort_values('Sequence').set_index('Sequence', drop=False)
+    best.index.name = None
+    if not replace_hla_column_names(hla_allele_names, best):
+        raise ValueError('ERROR: column names were not replaced for the group {}'.format(group))
+
+    # this is the legacy code for rank filtering, the data cleanup step was added below
+    filtered_hla = pd.Series('', index=best.index)
+    for allele in set(hla_allele_names):
+        if isinstance(allele, str) and re.search(HLA_pattern, allele) and allele in best.columns:
+            filtered_hla[(best['HLA_allele'] == allele) & (best[allele] < rank_threshold)] = allele
+
+    hla_columns = [col for col in best.columns if re.match(HLA_pattern, col)]
+    base_columns = ['Source_File', 'Feature', 'Scan', 'ALC', 'Length', 'RT', 'Mass', 'ppm', 'ID',
+                    'Location_count', 'Genome', 'Location', 'Sequence', 'Top_location_count',
+                    'Top_location_count_no_decoy', 'Q', 'Gene', 'Symbol', 'ORF_location', 'HLA_allele',
+                    'netMHC_rank']
+
+    values = partial['values'][partial['values']['Sequence'].isin(best.index)]
+    concat_values = {}
+    for column, field in CONCAT_FIELDS.items():
+        concat_values[column] = join_values(values[values['Field'] == field], ['Rec_ID'])
+    for column, field in SORTED_FIELDS.items():
+        concat_values[column] = join_values(values[values['Field'] == field], ['Value'])
+
+    scans = partial['scans'][partial['scans']['Sequence'].isin(best.index)].rename(columns={'Scan': 'Value'})
+    all_scans = join_values(scans, ['Sample_Name', 'Sample_Replica', 'Rec_ID'])
+
+    data_output = best[base_columns + hla_columns].assign(
+        Filtered_HLA_allele=filtered_hla,
+        Best_Q=best['Q'],
+        Best_ALC=best['Best_ALC'],
+        Best_Q_replica=best['Sample_Name'].astype(str) + '/' + best['Sample_Replica'].astype(str),
+        Categories=concat_values['Categories'],
+        Status_over_sequence=concat_values['Status_over_sequence'],
+        Databases_PRISM=concat_values['Databases_PRISM'],
+        Samples=concat_values['Samples'],
+        All_scans=all_scans
+    )
+
+    # Updates for some fields to integrate all found entries
+    for column in ['Location', 'Gene', 'Symbol', 'ORF_location']:
+        data_output[column] = concat_values[column]
+
+    # replica counts and the best intensities for the samples of the group
+    samples = sorted(description.loc[description['Group'] == group, 'Sample_Name'].dropna().unique())
+    replicas = [(sample, replica) for sample in samples for replica in
+                sorted(description.loc[description['Sample_Name'] == sample, 'Sample_Replica'].dropna().unique())]
+
+    intensity = partial['intensity'][partial['intensity']['Sequence'].isin(best.index)]
+    replica_report = (intensity
+                      .groupby(['Sequence', 'Sample_Name'], observed=True)['Sample_Replica'].nunique()
+                      .unstack()
+                      .reindex(index=best.index, columns=samples)
+                      .fillna(0)
+                      .astype(int))
+    replica_report.columns = [str(col) for col in replica_report.columns]
+    normalize_column_names(replica_report)
+
+    intensity_report = (intensity
+                        .set_index(['Sequence', 'Sample_Name', 'Sample_Replica'])['Intensity']
+                        .unstack(['Sample_Name', 'Sample_Replica'])
+                        .reindex(index=best.index, columns=pd.MultiIndex.from_tuples(replicas))
+                        .fillna(0))
+    intensity_report.columns = ['Intensity_' + '_'.join([str(sample), str(replica)]) for sample, replica in replicas]
+    normalize_column_names(intensity_report)
+
+    data_output = pd.concat([data_output, replica_report], axis=1)
+    data_output.insert(len(data_output.columns), 'Intensity_Sum', intensity_report.sum(axis=1))
+    data_output = pd.concat([data_output, intensity_report], axis=1)
+
+    data_output = data_output.replace(['-'], '')
+    data_output = data_output[data_output['Best_ALC'] >= alc_threshold]
+    data_output = data_output[data_output['netMHC_rank'] < rank_threshold]
+
+    return data_output
+
+# end of finalize_group()
+
+
+def write_output(data_output, group, group_number, output_file):
+    path = re.split(r'/', output_file)
+    if group_number > 1:  # if there is only one group the output file name won't be modified
+        path[-1] = str(group) + '_' + path[-1]
+    group_output_file = '/'.join(path)
+
+    CSV.write(data_output, group_output_file)  # it is gzipped if the file name ends with `.gz`
+
+    return group_output_file
+
+# end of write_output()
+
+
+def report_description_mismatch(data_files, sample_description):
+    print("You probably have an incorrect file with the description of the samples")
+    print('\nfiles in the data:')
+    print('\n'.join(sorted(data_files)))
+
+    print('\nfiles in the description:')
+    print(sample_description['Source_File'].drop_duplicates().tolist())
+
+# end of report_description_mismatch()
+
+
+def write_group(partial, group, group_number, label, output_file, q, alc, rank, sample_description):
+    if partial is None:
+        print('group {}{} ...no data'.format(group, label))
+        return None
+
+    data_output = finalize_group(partial, group, sample_description, q, alc, rank)
+    write_output(data_output, group, group_number, output_file)
+    print('group {}{} ...Ok'.format(group, label))
+
+# end of write_group()
+
+
+def get_file_digest(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+# end of get_file_digest()
+
+
+def update_state(file_paths, sample_file, sample_description, cat_aliases, state_dir, update, threads=None,
+                 decoy_cat_aliases=None):
+    # partial aggregates of each annotated file are kept by group in the state directory,
+    # only new or changed files are processed in the update mode.
+    # min/max aggregates can't be subtracted, so the state is stored per file and merged for the output
+    index_file = os.path.join(state_dir, 'index.pkl')
+    description_digest = get_file_digest(sample_file)
+
+    # the categories of files and the kept peptides depend on the category aliases
+    aliases = {'target': list(cat_aliases), 'decoy': list(decoy_cat_aliases) if decoy_cat_aliases else None}
+    index = {'description': description_digest, 'cat_aliases': aliases, 'files': {}, 'n_states': 0}
+    reset = not update  # the state is rebuilt from scratch without the update mode
+    if os.path.exists(index_file):
+        index_stored = pd.read_pickle(index_file)
+        index['n_states'] = index_stored['n_states']
+        index['files'] = index_stored['files']
+        if update and index_stored['description'] != description_digest:
+            print('the sample description was changed, all files will be processed ...', end='', flush=True)
+            reset = True
+        elif update and index_stored.get('cat_aliases') != aliases:
+            print('the category aliases were changed, all files will be processed ...', end='', flush=True)
+            reset = True
+
+    # removed and changed files are dropped from the state
+    for file_path in list(index['files'].keys()):
+        entry = index['files'][file_path]
+        if reset or file_path not in file_paths or \
+                (entry['mtime'], entry['size']) != (os.path.getmtime(file_path), os.path.getsize(file_path)):
+            for state_file in entry['groups'].values():
+                os.remove(os.path.join(state_dir, state_file))
+            del index['files'][file_path]
+
+    os.makedirs(state_dir, exist_ok=True)
+    pd.to_pickle(index, index_file)
+
+    new_files = [file_path for file_path in file_paths if file_path not in index['files']]
+    for i, (file_path, data) in enumerate(zip(new_files, ingest(new_files, cat_aliases, None, threads,
+                                                                        decoy_cat_aliases))):
+        n_rec = len(data.index)
+        # the files are parsed in the worker processes, the rows and bytes are counted here
+        RunReport.count(rows_in=n_rec, bytes_read=os.path.getsize(file_path))
+        RunReport.progress('Reading annotated files', i + 1, len(new_files))
+        data.insert(0, 'Rec_ID', range(1, n_rec + 1))  # the offset of the file is added on merging
+        data_files = data['Source_File'].unique()
+
+        data = data.merge(sample_description, on='Source_File', how='inner')
+        if len(data.index) != n_rec:
+            report_description_mismatch(data_files, sample_description)
+            RunReport.error('the sample description does not match the data')
+            exit(1)
+
+        entry = {'mtime': os.path.getmtime(file_path), 'size': os.path.getsize(file_path), 'n_rec': n_rec,
+                 'groups': {}}
+        for group, rows in data.groupby('Group', sort=False, observed=True):
+            index['n_states'] += 1
+            state_file = 'state.{}.pkl'.format(index['n_states'])
+            targets = rows[rows['Decoy'] != 'D']
+            decoys = rows[rows['Decoy'] == 'D']
+            pd.to_pickle({'target': reduce_rows(targets) if len(targets.index) else None,
+                          'decoy': reduce_rows(decoys) if len(decoys.index) else None},
+                         os.path.join(state_dir, state_file))
+            entry['groups'][group] = state_file
+
+        index['files'][file_path] = entry
+        pd.to_pickle(index, index_file)
+
+    print('{} new or changed files ...'.format(len(new_files)), end='', flush=True)
+
+    return index
+
+# end of update_state()
+
+
+def read_state(index, state_dir, file_paths, group, kind):
+    # Rec_ID of each file is shifted by the number of records in the preceding files
+    offset = 0
+    for file_path in file_paths:
+        entry = index['files'][file_path]
+        if group in entry['groups']:
+            partial = pd.read_pickle(os.path.join(state_dir, entry['groups'][group]))[kind]
+            if partial is not None:
+                for table in ['best', 'values', 'scans']:
+                    partial[table]['Rec_ID'] += offset
+                yield partial
+        offset += entry['n_rec']
+
+# end of read_state()
+
+
+def combine(input_dir, sample_file, q_threshold, alc_threshold, rank_threshold, output_file, decoy, cat_aliases,
+            threads=None, decoy_output_file=None, decoy_q_threshold=100, decoy_alc_threshold=-100,
+            decoy_rank_threshold=2.0, mem_limit=None, tmp_dir=None, state_dir=None, update=False,
+            decoy_cat_aliases=None):
+    # decoy and target peptides are ingested once if both outputs are requested,
+    # the decoy peptides are taken from the files of decoy categories (the same categories by default)
+    print('Data preparing ...', end='', flush=True)
+    file_paths = sorted(glob.glob(input_dir + '/**/*.pep.annotated.csv.gz', recursive=True))
+    if not len(file_paths):
+        raise ValueError('ERROR: no valid files in the input directory!')
+
+    sample_description = CSV.read(sample_file)
+    TableSchema.apply(sample_description, 'sample_description')
+
+    if not decoy_output_file:
+        decoy_cat_aliases = None
+
+    outputs = []
+    if output_file:
+        outputs.append(('', output_file, q_threshold, alc_threshold, rank_threshold, False))
+    if decoy_output_file:
+        outputs.append((' (decoy peptides)', decoy_output_file, decoy_q_threshold, decoy_alc_threshold,
+                        decoy_rank_threshold, True))
+
+    if state_dir:  # the aggregate state is stored and updated
+        with RunReport.section('ingest'):
+            index = update_state(file_paths, sample_file, sample_description, cat_aliases, state_dir, update, threads,
+                                 decoy_cat_aliases)
+        print('OK')
+
+        groups = sorted(set([group for entry in index['files'].values() for group in entry['groups']]), key=str)
+        with RunReport.section('combine'):
+            for group in groups:
+                with RunReport.section('combine group'):
+                    for label, file_name, q, alc, rank, is_decoy in outputs:
+                        partial = merge_partials(list(read_state(index, state_dir, file_paths, group,
+                                                                 'decoy' if is_decoy or decoy else 'target')))
+                        write_group(partial, group, len(groups), label, file_name, q, alc, rank, sample_description)
+
+        return None
+
+    # the number of partitions for each group is estimated from the size of the compressed input
+    n_buckets = 1
+    if mem_limit:
+        n_buckets = max(1, int(np.ceil(20 * sum([os.path.getsize(x) for x in file_paths]) / mem_limit)))
+    partitions = Partitions(n_buckets, mem_limit, tmp_dir if tmp_dir else output_file + '.partitions')
+
+    n_rec = 0
+    n_rec_ext_data = 0
+    data_files = set()
+    with RunReport.section('ingest'):
+        data_parts = ingest(file_paths, cat_aliases, None if decoy_output_file else decoy, threads, decoy_cat_aliases)
+        for i, (file_path, data) in enumerate(zip(file_paths, data_parts)):
+            # the files are parsed in the worker processes, the rows and bytes are counted here
+            RunReport.count(rows_in=len(data.index), bytes_read=os.path.getsize(file_path))
+            RunReport.progress('Reading annotated files', i + 1, len(file_paths))
+            data.insert(0, 'Rec_ID', range(n_rec + 1, n_rec + len(data.index) + 1))  # to start with 1, but not 0
+            n_rec += len(data.index)
+            data_files.update(data['Source_File'].unique())
+
+            data = data.merge(sample_description, on='Source_File', how='inner')
+            n_rec_ext_data += len(data.index)
+            partitions.add(data)
+
+    if n_rec_ext_data != n_rec:
+        report_description_mismatch(data_files, sample_description)
+        partitions.clear()
+        RunReport.error('the sample description does not match the data')
+        exit(1)
 
-        print('group {} ...Ok'.format(group) + ' ' * 50)
+    print('OK')
+
+    groups = partitions.groups()
+    with RunReport.section('combine'):
+        for group in groups:
+            with RunReport.section('combine group'):
+                # each partition of the group is reduced independently, partial results are merged
+                partials = {output[1]: [] for output in outputs}
+                for rows in partitions.get(group):
+                    for label, file_name, q, alc, rank, is_decoy in outputs:
+                        if decoy_output_file:
+                            rows_selected = rows[rows['Decoy'] == 'D'] if is_decoy else rows[rows['Decoy'] != 'D']
+                        else:
+                            rows_selected = rows
+                        if len(rows_selected.index):
+                            partials[file_name].append(reduce_rows(rows_selected))
+
+                for label, file_name, q, alc, rank, is_decoy in outputs:
+                    write_group(merge_partials(partials[file_name]), group, len(groups), label, file_name, q, alc,
+                                rank, sample_description)
+
+    partitions.clear()
 
 # end of combine()
 
@@ -436,28 +726,63 @@ def main():
     parser.add_argument('-s', default='sample_description.csv', required=True,
                         help='tab delimited file with the description of samples: '
                              'Source_File	Sample_Name	Sample_Replica	Sample_Type Group')
-    parser.add_argument('-db', required=False,
-                        help='database file (if not specified, the data will be stored in memory)')
     parser.add_argument('-q', default=100, type=float, required=False, help='Q threshold: 0.1 = 10%%FDR (default: no filtering)')  # don't remove double "%"
     parser.add_argument('-best_alc', default=-100, type=float, required=False, help='Best ALC threshold (default: no filtering)')
     parser.add_argument('-r', default=2.0, type=float, required=False, help='Rank threshold: SB < 0.5; WB < 2.0 (default: 2.0)')
     parser.add_argument('-o', default='combined_results.csv.gz', required=False, help='output file with results')
     parser.add_argument('-cat', default=['frameshift', 'prio1', 'prio2', 'prio3'], nargs='+', required=False, help='category aliases for running PRISM')
     parser.add_argument('-D', action='store_true', help='combine decoy peptides')
+    parser.add_argument('-decoy_o', required=False,
+                        help='output file with decoy peptides: targets (-o) and decoys are combined in one run')
+    parser.add_argument('-decoy_cat', nargs='+', required=False,
+                        help='category aliases for decoy peptides with -decoy_o (default: the same as -cat)')
+    parser.add_argument('-decoy_q', default=100, type=float, required=False,
+                        help='Q threshold for decoy peptides (default: no filtering)')
+    parser.add_argument('-decoy_best_alc', default=-100, type=float, required=False,
+                        help='Best ALC threshold for decoy peptides (default: no filtering)')
+    parser.add_argument('-decoy_r', default=2.0, type=float, required=False,
+                        help='Rank threshold for decoy peptides (default: 2.0)')
+    parser.add_argument('-t', type=int, required=False,
+                        help='the number of processes to read annotated files (default: the number of CPUs)')
+    parser.add_argument('-mem', type=float, required=False,
+                        help='memory limit in MB: the data are spilled to disk partitions by Group and Sequence hash '
+                             '(default: the data are kept in memory)')
+    parser.add_argument('-tmp', required=False,
+                        help='the directory for disk partitions (default: {output file}.partitions)')
+    parser.add_argument('-state', required=False,
+                        help='the directory for the aggregate state of annotated files (default: {output file}.state '
+                             'with --update)')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='process only new or changed annotated files and merge them into the stored state')
 
     args = parser.parse_args()
 
     input_dir = re.sub(r'/$', '', args.i)
     sample_file = args.s
-    db_file = args.db
     q_threshold = args.q
     alc_threshold = args.best_alc
     rank_threshold = args.r
     output_file = args.o
     decoy = args.D
     cat_aliases = args.cat
-
-    combine(input_dir, sample_file, db_file, q_threshold, alc_threshold, rank_threshold, output_file, decoy, cat_aliases)
+    threads = args.t
+    decoy_output_file = args.decoy_o
+    decoy_cat_aliases = args.decoy_cat
+    decoy_q_threshold = args.decoy_q
+    decoy_alc_threshold = args.decoy_best_alc
+    decoy_rank_threshold = args.decoy_r
+    mem_limit = args.mem * 1024 * 1024 if args.mem else None
+    tmp_dir = args.tmp
+    update = args.update
+    state_dir = args.state if args.state else (output_file + '.state' if update else None)
+
+    if decoy and decoy_output_file:
+        raise ValueError('ERROR: -D and -decoy_o options can not be used together')
+
+    RunReport.start('prism_combiner', output_file if output_file else decoy_output_file)
+    combine(input_dir, sample_file, q_threshold, alc_threshold, rank_threshold, output_file, decoy, cat_aliases,
+            threads, decoy_output_file, decoy_q_threshold, decoy_alc_threshold, decoy_rank_threshold, mem_limit, tmp_dir,
+            state_dir, update, decoy_cat_aliases)
 
     print("PRISM combiner: done")
 
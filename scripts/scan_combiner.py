@@ -8,13 +8,15 @@ import re
 import os
 from itertools import islice
 from CSVtools import CSV
+from TableSchema import TableSchema
+from RunReport import RunReport
 
 
 def normalize_column_names(dataframe):
     warnings.simplefilter(action='ignore', category=FutureWarning)  # to suppress FutureWarning
-    dataframe.columns = dataframe.columns.str.replace('[%()/*:]', '')
-    dataframe.columns = dataframe.columns.str.strip().str.replace('[ .-]', '_')
-    dataframe.columns = dataframe.columns.str.strip().str.replace('_+', '_')
+    dataframe.columns = dataframe.columns.str.replace('[%()/*:]', '', regex=True)
+    dataframe.columns = dataframe.columns.str.strip().str.replace('[ .-]', '_', regex=True)
+    dataframe.columns = dataframe.columns.str.strip().str.replace('_+', '_', regex=True)
 
     return dataframe
 
@@ -37,106 +39,165 @@ def seq_status(row, description):
 # end of seq_status()
 
 
-def combine(files, names, description_file, output, db_file=None):
-    if len(files) != len(names):
-        raise ValueError("The number of files must correspond to the number of experiment names")
+def best_hyperscore(row):
+    best_score = -1
+    best_delta = None
+    best_sample = None
+    for col in row.index.to_list():
+        if re.match('Hyperscore', col):
+            if row[col] > best_score:
+                best_score = row[col]
+                best_sample = re.sub('^Hyperscore[ _]*', '', col)
+                best_delta = row.filter(regex='^Delta[ _]+score[ _]*' + best_sample).iloc[0]
 
-    data_set = []
-    col_names = ''
-    delimiter = ','
-    for i, file_name in enumerate(files):
-        data = pd.read_csv(file_name, sep=CSV.get_delimiter(file_name), engine="python")
-        normalize_column_names(data)
+    row['BestHit_Hyperscore'] = best_score
+    row['BestHit_Deltascore'] = best_delta
+    row['BestHit_MSFsample'] = best_sample
 
-        if len(col_names):
-            if col_names != ','.join(data.columns):
-                raise ValueError("Combined files have different columns")
-        else:
-            col_names = ','.join(data.columns)
+    return row
 
-        data.insert(0, 'Exp', names[i])
-        data_set.append(data)
+# end of best_hyperscore()
 
-    concat_data = pd.concat(data_set)
 
+def open_store(db_file=None, update=False):
+    # the combined store keeps the first-wins rows with their experiment priorities (table combine),
+    # the experiments of each sequence (table sequences) and the list of added experiments (table experiments)
     if db_file:
-        if os.path.exists(db_file):
+        if os.path.exists(db_file) and not update:
             os.remove(db_file)
         connector = sqlite3.connect(db_file)
     else:
+        if update:
+            raise ValueError("The database file must be specified to update the combined data")
         connector = sqlite3.connect(':memory:')
 
-    concat_data.to_sql(name='data', con=connector, index=False)
     cur = connector.cursor()
-
-    sql = 'CREATE INDEX sequence_index ON data(Sequence);'
-    cur.execute(sql)
+    cur.execute('CREATE TABLE IF NOT EXISTS experiments (Exp TEXT, Priority REAL, File TEXT);')
+    cur.execute('CREATE TABLE IF NOT EXISTS sequences (Sequence TEXT, Exp TEXT);')
+    cur.execute('CREATE INDEX IF NOT EXISTS sequences_index ON sequences(Sequence);')
     connector.commit()
 
-    sql = 'CREATE TABLE ext_data AS SELECT t1.*, ' \
-          '(SELECT GROUP_CONCAT(Exp) FROM (SELECT DISTINCT t2.Exp FROM data AS t2 ' \
-          'WHERE t2.Sequence = t1.Sequence ORDER BY t2.Exp) AS t3) AS Experiment FROM data AS t1'
-    cur.execute(sql)
-    connector.commit()
+    return connector
 
-    sql = 'CREATE INDEX ext_sequence_index ON ext_data(Sequence);'
-    cur.execute(sql)
-    connector.commit()
+# end of open_store()
 
-    db_created = False
-    for name in names:
-        if db_created:
-            sql = 'INSERT OR IGNORE INTO combine SELECT * FROM ext_data WHERE Exp = "{}"'.format(name)
-            cur.execute(sql)
-        else:
-            sql = 'CREATE TABLE combine AS SELECT * FROM ext_data WHERE Exp = "{}"'.format(name)
-            cur.execute(sql)
-            sql = 'CREATE UNIQUE INDEX combine_sequence_index ON combine(Sequence);'
-            cur.execute(sql)
-            db_created = True
+
+def get_records(data):
+    # the rows as tuples of python values for sqlite (missing values are NULL)
+    values = data.astype(object)
+
+    return list(values.where(data.notna(), None).itertuples(index=False, name=None))
+
+# end of get_records()
+
+
+def add_experiment(connector, file_name, name, priority, desc_data):
+    # only the sequences of the new file are affected: their rows are replaced if the new experiment has
+    # a higher priority (a lower number) and the list of experiments is updated.
+    # All rows are prepared before the store is changed, the changes are made in one transaction,
+    # so a failed experiment leaves the store as it was
+    cur = connector.cursor()
+    if len(cur.execute('SELECT Exp FROM experiments WHERE Exp = ?', (name,)).fetchall()):
+        raise ValueError("The experiment {} is already in the combined data".format(name))
+
+    data = CSV.read(file_name)
+    normalize_column_names(data)
+    TableSchema.apply(data, 'imp_output')
+
+    store_exists = len(cur.execute('SELECT name FROM sqlite_master WHERE type = "table" AND name = "combine"').fetchall())
+    if store_exists:
+        col_names = [col[1] for col in cur.execute('PRAGMA table_info(combine)').fetchall()]
+        expected_names = ['Exp', 'Priority', 'Row_ID'] + list(data.columns) + ['Experiment']
+        if col_names[:len(expected_names)] != expected_names:
+            raise ValueError("Combined files have different columns")
+
+    sequences = data['Sequence'].drop_duplicates()
+
+    # the first row of a sequence wins within the experiment
+    data = data.drop_duplicates(subset=['Sequence'], keep='first')
+    experiments = sequences.to_frame().assign(Exp=name)
+    if store_exists:
+        # the sequences of the file are kept in the temporary table (it is not a part of the store)
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS affected (Sequence TEXT)')
+        cur.execute('DELETE FROM temp.affected')
+        cur.executemany('INSERT INTO temp.affected VALUES (?)', [(seq,) for seq in sequences])
         connector.commit()
+        current = pd.read_sql('SELECT t1.Sequence, t1.Priority FROM combine AS t1 '
+                              'INNER JOIN temp.affected AS t2 ON t1.Sequence = t2.Sequence', connector)
+        replaced = current.loc[current['Priority'] > priority, 'Sequence']
+        data = data[~data['Sequence'].isin(current['Sequence']) | data['Sequence'].isin(replaced)]
+        row_id = cur.execute('SELECT MAX(Row_ID) FROM combine').fetchone()[0]
+        row_id = row_id if row_id else 0
+        experiments = pd.concat([pd.read_sql('SELECT t1.Sequence, t1.Exp FROM sequences AS t1 '
+                                             'INNER JOIN temp.affected AS t2 ON t1.Sequence = t2.Sequence', connector),
+                                 experiments])
+    else:
+        row_id = 0
+
+    data.insert(0, 'Exp', name)
+    data.insert(1, 'Priority', priority)
+    data.insert(2, 'Row_ID', range(row_id + 1, row_id + len(data.index) + 1))
+    data.insert(len(data.columns), 'Experiment', None)  # updated below for all affected sequences
+    if len(data.index):
+        data['IMP_Status_over_sequence'] = data.apply(seq_status, description=desc_data, axis=1)
+    else:
+        data['IMP_Status_over_sequence'] = None
 
-    '''  # for future demands 
-    sql = 'UPDATE combine AS t1 SET nuORFs = (SELECT GROUP_CONCAT(DISTINCT nuORFs) ' \
-          'FROM ext_data AS t2 WHERE t2.Sequence = t1.Sequence)'
-    cur.execute(sql)
-    
-    sql = 'UPDATE combine AS t1 SET CDS = (SELECT GROUP_CONCAT(DISTINCT CDS) ' \
-          'FROM ext_data AS t2 WHERE t2.Sequence = t1.Sequence)'
-    cur.execute(sql)
-    '''
+    if True in data.columns.str.contains('Hyperscore'):  # finding Best Hyperscores in MSFragger data
+        columns = list(data.columns) + ['BestHit_Hyperscore', 'BestHit_Deltascore', 'BestHit_MSFsample']
+        data = data.reindex(columns=columns)
+        if len(data.index):
+            data = data.apply(best_hyperscore, axis=1)
 
-    sql = 'SELECT * FROM combine'
-    combined_data = pd.read_sql(sql, connector)
-    combined_data.drop(columns=['Exp'], inplace=True)
+    experiments = experiments.drop_duplicates().sort_values(['Sequence', 'Exp']).groupby('Sequence')['Exp'].agg(','.join)
 
-    desc_data = pd.read_csv(description_file, sep=CSV.get_delimiter(description_file), engine='python')
-    combined_data['IMP_Status_over_sequence'] = combined_data.apply(seq_status, description=desc_data, axis=1)
+    with connector:  # commit or rollback of all changes
+        cur.execute('INSERT INTO experiments VALUES (?, ?, ?)', (name, priority, file_name))
+        cur.executemany('INSERT INTO sequences (Sequence, Exp) VALUES (?, ?)', [(seq, name) for seq in sequences])
+        if store_exists:
+            cur.executemany('DELETE FROM combine WHERE Sequence = ?', [(seq,) for seq in replaced])
+        else:
+            cur.execute(pd.io.sql.get_schema(data, 'combine', con=connector))
+            cur.execute('CREATE UNIQUE INDEX combine_sequence_index ON combine(Sequence);')
+        cur.executemany('INSERT INTO combine VALUES ({})'.format(', '.join(['?'] * len(data.columns))),
+                        get_records(data))
+        cur.executemany('UPDATE combine SET Experiment = ? WHERE Sequence = ?', zip(experiments, experiments.index))
+
+# end of add_experiment()
 
-    if True in combined_data.columns.str.contains('Hyperscore'):  # finding Best Hyperscores in MSFragger data
-        columns = list(combined_data.columns) + ['BestHit_Hyperscore', 'BestHit_Deltascore', 'BestHit_MSFsample']
-        combined_data = combined_data.reindex(columns=columns)
 
-        def best_hyperscore(row):
-            best_score = -1
-            best_delta = None
-            best_sample = None
-            for col in row.index.to_list():
-                if re.match('Hyperscore', col):
-                    if row[col] > best_score:
-                        best_score = row[col]
-                        best_sample = re.sub('^Hyperscore[ _]*', '', col)
-                        best_delta = row.filter(regex='^Delta[ _]+score[ _]*' + best_sample).iloc[0]
+def export(connector, output):
+    combined_data = pd.read_sql('SELECT * FROM combine ORDER BY Priority, Row_ID', connector)
+    combined_data.drop(columns=['Exp', 'Priority', 'Row_ID'], inplace=True)
+    CSV.write(combined_data, output, sep=',')
 
-            row['BestHit_Hyperscore'] = best_score
-            row['BestHit_Deltascore'] = best_delta
-            row['BestHit_MSFsample'] = best_sample
+    return combined_data
+
+# end of export()
+
+
+def combine(files, names, description_file, output, db_file=None, update=False, priorities=None):
+    # without the update mode the combined store is created from scratch
+    if len(files) != len(names):
+        raise ValueError("The number of files must correspond to the number of experiment names")
+    if priorities and len(priorities) != len(names):
+        raise ValueError("The number of priorities must correspond to the number of experiment names")
 
-            return row
+    connector = open_store(db_file, update)
+    if not priorities:  # the experiments are added after the existing ones in the order of names
+        last_priority = connector.cursor().execute('SELECT MAX(Priority) FROM experiments').fetchone()[0]
+        last_priority = last_priority if last_priority else 0
+        priorities = [last_priority + i + 1 for i in range(len(names))]
 
-        combined_data = combined_data.apply(best_hyperscore, axis=1)
+    desc_data = CSV.read(description_file)
+    TableSchema.apply(desc_data, 'sample_description')
+    for file_name, name, priority in zip(files, names, priorities):
+        with RunReport.section('add experiment'):
+            add_experiment(connector, file_name, name, priority, desc_data)
 
-    combined_data.to_csv(output, sep=delimiter, index=False)
+    with RunReport.section('export'):
+        combined_data = export(connector, output)
+    connector.close()
 
     return combined_data
 
@@ -155,6 +216,11 @@ def main():
                              'Source_File	Sample_Name	Sample_Replica	Sample_Type Group')
     parser.add_argument('-o', default='combined_file.csv', required=False, help='output file with joined data')
     parser.add_argument('-db', required=False, help='database file (if not specified, the data will be stored in memory')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='add the input files to the combined data in the database file (-db) as new experiments')
+    parser.add_argument('-p', nargs='+', type=float, required=False,
+                        help='experiment priorities: the row of the experiment with the lowest number is kept '
+                             '(default: the order of names after the existing experiments)')
 
     args = parser.parse_args()
 
@@ -163,11 +229,15 @@ def main():
     description_file = args.s
     output_file = args.o
     db_file = args.db
+    update = args.update
+    priorities = args.p
 
+    RunReport.start('scan_combiner', output_file)
     try:
-        combine(input_file_list, experiment_list, description_file, output_file, db_file)
+        combine(input_file_list, experiment_list, description_file, output_file, db_file, update, priorities)
     except Exception as err:
         print("Something went wrong: {}".format(err))
+        RunReport.error(err)
 
     print('Scan combiner: done')
 
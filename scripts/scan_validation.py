@@ -8,13 +8,15 @@ Created on Wed May 24 14:16:05 2023
 
 """
 
-__version__ = '1.0.1'
+__version__ = '1.1.0'
 
 import pathlib
 import argparse
 import os
 import numpy as np
 import pandas as pd
+from CSVtools import CSV
+from RunReport import RunReport
 
 
 def is_valid_path(parser, arg):
@@ -25,95 +27,108 @@ def is_valid_path(parser, arg):
 
 
 def get_scan_and_coverage_df(df, df_name):
-    # extract scan number columns and pivot to make new dataframe
-    # with [Sequence, Sample, and Scan number]
-    scan_cols = ['Sequence'] + [x for x in df.columns if 'Scan number' in str(x)]
+    # extract scan number and coverage columns and melt them to make new dataframe
+    # with [Sequence, Sample, Scan_number, Coverage] keyed by Sequence and Sample
+    df = df.query('Permutation_Index == 0')
+    scan_cols = [x for x in df.columns if 'Scan number' in str(x)]
+
+    # coverage columns for MaxQuant data, Hyperscore columns for MSFragger data
+    target = next((name for name in ['coverage', 'Hyperscore'] if any(name in str(x) for x in df.columns)), None)
+    if target is None:
+        raise ValueError('ERROR: no columns to validate!')
+    target_cols = [x for x in df.columns if target in str(x)]
+
     scan_df = (df
-               .query('Permutation_Index == 0')
-               .filter(scan_cols)
+               .filter(['Sequence'] + scan_cols)
                .melt(id_vars='Sequence',
-                     value_vars=scan_cols,
                      var_name='Sample',
-                     value_name='Scan_number').sort_values('Sequence'))
-
-    # extract coverage columns and pivot to make new dataframe
-    # with [Sequence, Sample, and coverage]
-    target_cols = [x for x in df.columns if 'coverage' in str(x)]
-    if not len(target_cols):  # the branch for MSFragger data
-        target_cols = [x for x in df.columns if 'Hyperscore' in str(x)]
-    if not len(target_cols):
-        raise ValueError('ERROR: no columns to validate!')
-
-    target_cols = ['Sequence'] + target_cols
+                     value_name='Scan_number')
+               .assign(Sample=lambda x: x['Sample'].str.replace('Scan number', '', regex=False)))
 
     cov_df = (df
-              .query('Permutation_Index == 0')
-              .filter(target_cols)
+              .filter(['Sequence'] + target_cols)
               .melt(id_vars='Sequence',
-                    value_vars=target_cols,
-                    var_name='Sample_cov',
-                    value_name='Coverage_' + df_name).sort_values('Sequence'))
-
-    # merge the two dataframe to have [Sequence, Sample, Scan_number, Coverage]
-    merge_df = (pd.merge(scan_df, cov_df, left_index=True, right_index=True)
-                .drop(['Sequence_y', 'Sample_cov'], axis=1)
-                .assign(Sample=lambda x: x['Sample'].str.replace('Scan number', ''))
-                .rename(columns=dict(Sequence_x='Sequence'))
+                    var_name='Sample',
+                    value_name='Coverage_' + df_name)
+              .assign(Sample=lambda x: x['Sample'].str.replace(target, '', regex=False)))
+
+    merge_df = (pd.merge(scan_df, cov_df, on=['Sequence', 'Sample'], how='inner')
                 .dropna(subset=['Scan_number', 'Coverage_' + df_name])
                 ).reset_index(drop=True)
 
     return merge_df
 
 
-def main(args):
+def get_conflicts(A_df, B_df):
+    # merge experimental and canonical on Sample and scan number to further compare the coverage
+    # select instances where:
+    # -- scan numbers are the same
+    # -- Sequences are different
+    # -- coverage is higher or equal in the canonical vs experimental
+    conflicts = (pd.merge(A_df, B_df, how='inner', on=['Sample', 'Scan_number'])
+                 .query('Sequence_x != Sequence_y and Coverage_A <= Coverage_B')
+                 .filter(['Sequence_x', 'Sample', 'Scan_number'])
+                 .rename(columns=dict(Sequence_x='Sequence'))
+                 .drop_duplicates())
+
+    return conflicts
+
+
+def remove_conflicts(df, conflicts):
+    # anti-join: only the scan number cells of the conflicting (Sequence, Sample, Scan_number) are removed
+    df = df.copy()
+    for sample, sample_conflicts in conflicts.groupby('Sample'):
+        col = 'Scan number' + sample
+        keys = pd.MultiIndex.from_frame(sample_conflicts[['Sequence', 'Scan_number']])
+        mask = pd.MultiIndex.from_arrays([df['Sequence'], df[col]]).isin(keys)
+        df.loc[mask, col] = np.nan
+
+    # finally remove rows with no scan numbers
+    cols = [x for x in df.columns if 'Scan number' in str(x)]
+
+    return df.dropna(subset=cols, how='all')
+
+
+def validate(experimental_file, B_df, output_folder):
     # read experiment IMP output
-    df = pd.read_csv(args.experimental_file, engine='python')
-    a_df = df.query("CDS.isna()", engine='python')
+    df = CSV.read(experimental_file, sep=',')
 
     # extract the cds only entries
     cds_df = df.query("CDS.notna() & nuORFs.isna()", engine='python')
 
     # remove sequences found in CDS (but keep nuORFs) database
-    a_df = a_df.query("CDS.isna()", engine='python')
+    a_df = df.query("CDS.isna()", engine='python')
 
     A_df = get_scan_and_coverage_df(a_df, 'A')
-
-    # read canonical  IMP output
-    b_df = pd.read_csv(args.canonical_file, engine='python')
-    B_df = get_scan_and_coverage_df(b_df, 'B')
-
-    # merge experimental ad canonical on Sample and scan number to further compare the coverage
-    A_B_merge_df = pd.merge(A_df, B_df, how='left', left_on=['Sample', 'Scan_number'],
-                            right_on=['Sample', 'Scan_number'])
-
-    # remove sequences that do not appear in the canonical database
-    # select instances where:
-    # -- scan numbers are the same
-    # -- Sequences are different
-    # -- coverage is higher or equal in the canonical vs experimental
-    scan_number_list = (A_B_merge_df
-                        .dropna(subset=['Sequence_y'])
-                        .query('Sequence_x != Sequence_y and Coverage_A <= Coverage_B'))['Scan_number'].astype(
-        np.int64).to_list()
-
-    # search for scan numbers in the ABC dataframe and remove them
-    # finally remove rows with no scan numbers
-    cols = [x for x in a_df.columns if 'Scan number' in str(x)]
-    a_df = (a_df
-            .assign(**df.loc(axis=1)[cols]
-                    .replace(scan_number_list, np.nan))
-            .dropna(subset=cols, how='all')
-            )
+    a_df = remove_conflicts(a_df, get_conflicts(A_df, B_df))
 
     # concatenate the validated experimental peptides
     # and the canonical (non-validated, original)
     scan_validation_df = pd.concat([a_df, cds_df])
 
-    scan_validation_file = os.path.join(args.output_folder, 'IMP_scan_validation.csv')
-    scan_validation_df.to_csv(scan_validation_file, index=False)
+    scan_validation_file = os.path.join(output_folder, 'IMP_scan_validation.csv')
+    CSV.write(scan_validation_df, scan_validation_file, sep=',')
 
     print('scan validation file saved to: %s' % (scan_validation_file))
 
+    return scan_validation_file
+
+
+def main(args):
+    if len(args.experimental_file) != len(args.output_folder):
+        raise ValueError('ERROR: the number of output folders must correspond to the number of experimental files')
+
+    RunReport.start('scan_validation', args.output_folder[0])
+
+    # read canonical IMP output (only once for all experimental files)
+    with RunReport.section('canonical scans'):
+        b_df = CSV.read(args.canonical_file, sep=',')
+        B_df = get_scan_and_coverage_df(b_df, 'B')
+
+    for experimental_file, output_folder in zip(args.experimental_file, args.output_folder):
+        with RunReport.section('validate'):
+            validate(experimental_file, B_df, output_folder)
+
 
 def make_parser():
     # define lambda function to validate file/path exists to use in add_argument
@@ -124,15 +139,15 @@ def make_parser():
 
     _input = parser.add_argument_group('input options')
 
-    _input.add_argument('-a', '--experimental_file', metavar='', type=str, required=True,
-                        help="experimental IMP filtered file")
+    _input.add_argument('-a', '--experimental_file', metavar='', type=str, nargs='+', required=True,
+                        help="experimental IMP filtered files (e.g. Aeffect, Peffect)")
     _input.add_argument('-b', '--canonical_file', metavar='', type=str, required=True,
                         help="canonical IMP filtered file")
 
     _output = parser.add_argument_group('output options')
 
-    _output.add_argument('-o', '--output_folder', metavar='', type=is_valid, required=True,
-                         help="folder location for output files (default: %(default)s)")
+    _output.add_argument('-o', '--output_folder', metavar='', type=is_valid, nargs='+', required=True,
+                         help="folder locations for output files, one per experimental file")
 
     parser.add_argument('-v', '--version', action='version', version="v%s" % (__version__))
 
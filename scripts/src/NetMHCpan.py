@@ -12,6 +12,8 @@ import subprocess
 import pandas as pd
 import numpy as np
 import csv
+from CSVtools import CSV
+from RunReport import RunReport
 
 
 class netMHCpan:
@@ -83,7 +85,7 @@ class netMHCpan:
 		# self._exp_alleles = ','.join(pd.read_csv(HLA_file, sep="\s*,\s*", quoting=csv.QUOTE_NONE, engine='python'))
 
 		# alleles should be in separate lines <- the correction
-		self._exp_alleles = ','.join(pd.read_csv(HLA_file, header=None, engine='python')[0].values.tolist())
+		self._exp_alleles = ','.join(CSV.read(HLA_file, sep=',', header=None)[0].values.tolist())
 
 		# check if all given HLA alleles are available in netMHCpan
 		try: 
@@ -122,7 +124,8 @@ class netMHCpan:
 
 		try:
 			if not self._args.dummy:
-				subprocess.run([self._netMHCpan_bin, "-BA", "-p", netMHC_peptides_file, "-a", self._exp_alleles, "-xls", "-xlsfile", self._netMHCpan_xls_file], stdout = netMHCpan_output)
+				with RunReport.section('netMHCpan run'):
+					subprocess.run([self._netMHCpan_bin, "-BA", "-p", netMHC_peptides_file, "-a", self._exp_alleles, "-xls", "-xlsfile", self._netMHCpan_xls_file], stdout = netMHCpan_output)
 			netMHCpan_output.close()
 
 		except Exception as e:
@@ -159,12 +162,12 @@ class netMHCpan:
 				if self._args.dummy:
 					# let's create a fake netMHCpan output file
 					netMHC_peptides_file = os.path.join(self._args.output_folder, 'peptides.pep')
-					netMHC_xls_df = pd.read_csv(netMHC_peptides_file, names=[('Unnamed: 1_level_0',  'Peptide')], header=None)
+					netMHC_xls_df = CSV.read(netMHC_peptides_file, sep=',', names=[('Unnamed: 1_level_0',  'Peptide')], header=None)
 					netMHC_xls_df[('Unnamed: 6_level_0',  'EL_Rank')] = 0
 					netMHC_xls_df[('Unnamed: 7_level_0', 'BA-score')] = 0
 					netMHC_xls_df[('HLA-A00:00', 'core')] = ''
 				else:
-					netMHC_xls_df = pd.read_csv(self._netMHCpan_xls_file, sep='\t', header=[0, 1])
+					netMHC_xls_df = CSV.read(self._netMHCpan_xls_file, sep='\t', header=[0, 1])
 			except (FileNotFoundError, IOError):
 				print("\033[1;31m %s netMHCpan xls file missing.." %(self._netMHCpan_xls_file))
 				return
@@ -203,5 +206,5 @@ class netMHCpan:
 			self.affinity_df = el_rank_df.join(aff_df) 
 
 			# save netMHC_out_df to csv
-			self.affinity_df.to_csv(netMHCpan_affinity_file, index=False)
+			CSV.write(self.affinity_df, netMHCpan_affinity_file, sep=',')
 
@@ -12,6 +12,8 @@ import subprocess
 import pandas as pd
 import numpy as np
 import csv
+from CSVtools import CSV
+from RunReport import RunReport
 
 
 class netMHCpan_II:
@@ -80,7 +82,7 @@ class netMHCpan_II:
 		# alleles should be comma delimited <- this option is not relevant, the correction is below
 		# and may be in separate lines <- it does not work, the correction is below
 		# self._exp_alleles = ','.join(pd.read_csv(HLA_II_file, sep="\s*,\s*", quoting=csv.QUOTE_NONE, engine='python'))
-		self._exp_alleles = ','.join(pd.read_csv(HLA_II_file, header=None, engine='python')[0].values.tolist())
+		self._exp_alleles = ','.join(CSV.read(HLA_II_file, sep=',', header=None)[0].values.tolist())
 
 		# check if all given HLA alleles are available in netMHCpan
 		try: 
@@ -118,7 +120,8 @@ class netMHCpan_II:
 		netMHCpan_II_output = open(os.path.join(self._args.output_folder, 'netMHCpan_II_binding_output.txt'), 'w')
 
 		try:
-			subprocess.run([self._netMHCpan_II_bin, "-BA", "-p", netMHC_II_peptides_file, "-a", self._exp_alleles, "-xls", "-xlsfile", self._netMHCpan_II_xls_file], stdout = netMHCpan_II_output)
+			with RunReport.section('netMHCpan run'):
+				subprocess.run([self._netMHCpan_II_bin, "-BA", "-p", netMHC_II_peptides_file, "-a", self._exp_alleles, "-xls", "-xlsfile", self._netMHCpan_II_xls_file], stdout = netMHCpan_II_output)
 			netMHCpan_II_output.close()
 
 		except Exception as e:
@@ -152,7 +155,7 @@ class netMHCpan_II:
 			# EL (eluted ligand data) 
 
 			try:
-				netMHC_II_xls_df = pd.read_csv(self._netMHCpan_II_xls_file, sep = '\t', header=[0,1])
+				netMHC_II_xls_df = CSV.read(self._netMHCpan_II_xls_file, sep='\t', header=[0, 1])
 
 			except (FileNotFoundError, IOError):
 				print("\033[1;31m %s netMHCpan_II xls file missing.." %(self._netMHCpan_II_xls_file))
@@ -192,5 +195,5 @@ class netMHCpan_II:
 			self.affinity_df = el_rank_df.join(aff_df) 
 
 			# save netMHC_out_df to csv
-			self.affinity_df.to_csv(netMHCpan_II_affinity_file, index=False)
+			CSV.write(self.affinity_df, netMHCpan_II_affinity_file, sep=',')
 
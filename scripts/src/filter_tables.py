@@ -13,6 +13,10 @@ import re
 import os
 import sys
 sys.path.insert(0, './src')
+from msms import msms
+from CSVtools import CSV
+from TableSchema import TableSchema
+from RunReport import RunReport
 
 
 # Class of different styles
@@ -29,6 +33,35 @@ class style():
     RESET = '\033[0m'
 
 
+def set_peptide_priority(df):
+    # we assign a negtive number for "hits" according to condition
+    # where the permutation with highest priority is assigned with the lowest negative number.
+    # we will then select the sequence with the lowest "hit" number to filter out permutations that
+    # do not take precedence over the original sequence.
+
+    conditions = [
+        (df['Permutation_Index']==0) & (df['CDS'].notna()),  # -5
+        (df['Permutation_Index']==0) & ((df['CDS'].isna()) & (df['nuORFs'].notna())),  # -3
+        (df['Permutation_Index']==0) & (df[['CDS', 'nuORFs']].isna().all(1)),  # -1
+        (df['Permutation_Index'] > 0) & (df['CDS'].notna()),  # -4
+        (df['Permutation_Index'] > 0) & ((df['CDS'].isna()) & (df['nuORFs'].notna()))  # -2
+        ]
+
+    choices = [-5, -3, -1, -4, -2]
+
+    return(np.select(conditions, choices, default = df['Permutation_Index']))
+
+
+def get_netMHCpan_candidates(df, max_len):
+    # only the permutations which take precedence over the others of the sequence in the length range
+    # can pass the filter (see filterTables), binding is not predicted for the rest.
+    # all copies of a repeated peptide are kept as they are merged with the netMHCpan output
+    hits = pd.Series(set_peptide_priority(df), index=df.index)
+    best = (hits == hits.groupby(df['Sequence']).transform('min')) & df['Length'].between(8, max_len)
+
+    return df['Sequence_Permutations'].isin(df.loc[best, 'Sequence_Permutations'])
+
+
 class filterTables:
     def __init__(self, args):
         # define class variables
@@ -45,30 +78,40 @@ class filterTables:
         print(style.RESET)
 
     def _set_peptide_priority(self, df):
-        # we assign a negtive number for "hits" according to condition
-        # where the permutation with highest priority is assigned with the lowest negative number.
-        # we will then select the sequence with the lowest "hit" number to filter out permutations that
-        # do not take precedence over the original sequence.
+        return set_peptide_priority(df)
 
-        conditions = [
-            (df['Permutation_Index']==0) & (df['CDS'].notna()),  # -5
-            (df['Permutation_Index']==0) & ((df['CDS'].isna()) & (df['nuORFs'].notna())),  # -3
-            (df['Permutation_Index']==0) & (df[['CDS', 'nuORFs']].isna().all(1)),  # -1
-            (df['Permutation_Index'] > 0) & (df['CDS'].notna()),  # -4
-            (df['Permutation_Index'] > 0) & ((df['CDS'].isna()) & (df['nuORFs'].notna()))  # -2
-            ]
+    def _export_filtered_peptides(self, df, psm_df):
+        # add msms data of the filtered peptides in the wide layout
+        df = df.merge(msms.pivot_psms(psm_df, df['Sequence']), on='Sequence', how='left')
 
-        choices = [-5, -3, -1, -4, -2]
+        df = (df.drop(df.filter(regex='[a-zA-Z\s]Count').columns, axis=1)
+            .drop(df.filter(regex=re.compile(r'amino acid', re.IGNORECASE)).columns, axis=1))
 
-        return(np.select(conditions, choices, default = df['Permutation_Index']))
+        # Remove the columns from their original positions.
+        # Add the columns back but in desired positions.
+        df.insert(1, 'Sequence_Permutations', df.pop('Sequence_Permutations'))
+        df.insert(2, 'Permutation_Index', df.pop('Permutation_Index'))
+        df.insert(3, 'CDS', df.pop('CDS'))
+        df.insert(4, 'nuORFs', df.pop('nuORFs'))
+        df.insert(5, 'hits', df.pop('hits'))
 
-    def filter_MQ_netMHCpan_peptides(self):
+        return df
+
+    def filter_MQ_netMHCpan_peptides(self, chunk_size=100000):
+        # combine peptide and netMHCpan output chunk by chunk and keep only the filtered peptides,
+        # the unfiltered table is written only on request (--unfiltered).
+        # The input tables are read whole (the peak memory is bounded by them), the merged table is not kept.
+        # The outputs are written to temporary files which are renamed at the end,
+        # so an interrupted run does not leave a partial IMP_filtered.csv which would skip the step
         # check if files exist:
-        IMP_unfiltered_file = os.path.join(self._args.output_folder, 'IMP_unfiltered.csv')
+        IL_peptides_file = os.path.join(self._args.output_folder, 'IL_peptides.csv')
+        HLA_aff_file = os.path.join(self._args.output_folder, 'netMHCpan_HLA_affinity.csv')
+        psm_file = os.path.join(self._args.output_folder, 'msms_psm.csv')
 
-        if not os.path.exists(IMP_unfiltered_file):
-            self._print_file_not_exists(IMP_unfiltered_file, "%s is essential for IMP" %(IMP_unfiltered_file))
-            return
+        for file_name in [IL_peptides_file, HLA_aff_file, psm_file]:
+            if not os.path.exists(file_name):
+                self._print_file_not_exists(file_name, "%s is essential for IMP" %(file_name))
+                return
 
         IMP_filtered_file = os.path.join(self._args.output_folder, 'IMP_filtered.csv')
 
@@ -76,26 +119,43 @@ class filterTables:
             self._print_file_exists_message(IMP_filtered_file)
             return
 
-        # read unfiltered IMP file
-        df = pd.read_csv(IMP_unfiltered_file, sep=',', engine='python')
-
-        # define database 'hits' status
-        df['hits'] = self._set_peptide_priority(df)
-
-        # perform some extra filtering steps
-        df = (df[df['hits'] == df.groupby('Sequence')['hits'].transform(min)]
-            .drop(df.filter(regex='[a-zA-Z\s]Count').columns, axis=1)
-            .drop(df.filter(regex=re.compile(r'amino acid', re.IGNORECASE)).columns, axis=1)
-            .query('`HLA affinity` in ["SB", "WB"]')
-            .query('Length >= 8 & Length <= {}'.format(self._args.max_len)))
-
-        # Remove the columns from their original positions.
-        # Add the columns back but in desired positions.
-        df.insert(1, 'Sequence_Permutations', df.pop('Sequence_Permutations'))
-        df.insert(2, 'Permutation_Index', df.pop('Permutation_Index'))
-        df.insert(3, 'CDS', df.pop('CDS'))
-        df.insert(4, 'nuORFs', df.pop('nuORFs'))
-        df.insert(5, 'hits', df.pop('hits'))
-
-        df.to_csv(IMP_filtered_file, index=False)
-
+        IMP_unfiltered_file = None
+        if self._args.unfiltered:
+            IMP_unfiltered_file = os.path.join(self._args.output_folder, 'IMP_unfiltered.csv')
+
+        peptides_df = TableSchema.apply(CSV.read(IL_peptides_file, sep=','), 'maxquant_peptides')
+        HLA_affinity_df = CSV.read(HLA_aff_file, sep=',')
+        psm_df = TableSchema.apply(CSV.read(psm_file, sep=','), 'maxquant_msms')
+
+        # define database 'hits' status: it does not depend on binding,
+        # so the best permutations of each sequence are known before the merge
+        hits = pd.Series(self._set_peptide_priority(peptides_df), index=peptides_df.index)
+        min_hits = hits.groupby(peptides_df['Sequence']).min()
+        best = (hits == peptides_df['Sequence'].map(min_hits)) & peptides_df['Length'].between(8, self._args.max_len)
+
+        # peptides without prediction have missing affinity values in the merged table
+        if not peptides_df['Sequence_Permutations'].isin(HLA_affinity_df['Peptide']).all():
+            HLA_affinity_df = HLA_affinity_df.astype(
+                {col: float for col in HLA_affinity_df.select_dtypes(include='integer').columns})
+
+        output_files = [IMP_filtered_file] + ([IMP_unfiltered_file] if IMP_unfiltered_file else [])
+        tmp_files = {file_name: file_name + '.tmp' for file_name in output_files}
+
+        rows = peptides_df.index if IMP_unfiltered_file else peptides_df.index[best]
+        for start in range(0, max(len(rows), 1), chunk_size):
+            df = peptides_df.loc[rows[start:start + chunk_size]].merge(HLA_affinity_df, left_on='Sequence_Permutations',
+                                                                       right_on='Peptide', how='left')
+            if IMP_unfiltered_file:
+                CSV.write(df, tmp_files[IMP_unfiltered_file], sep=',', mode='a' if start else 'w', header=not start)
+
+            # perform some extra filtering steps
+            df['hits'] = self._set_peptide_priority(df)
+            df = (df[(df['hits'] == df['Sequence'].map(min_hits)) & df['Length'].between(8, self._args.max_len)]
+                .query('`HLA affinity` in ["SB", "WB"]'))
+
+            df = self._export_filtered_peptides(df, psm_df)
+            CSV.write(df, tmp_files[IMP_filtered_file], sep=',', mode='a' if start else 'w', header=not start)
+            RunReport.progress('Filtering peptides', min(start + chunk_size, len(rows)), len(rows))
+
+        for file_name in output_files[::-1]:  # IMP_filtered.csv is the last one
+            os.replace(tmp_files[file_name], file_name)
@@ -16,6 +16,9 @@ import numpy as np
 
 from collections import defaultdict
 
+from CSVtools import CSV
+from TableSchema import TableSchema
+
 
 class msms:
 	def __init__(self, args):
@@ -25,22 +28,54 @@ class msms:
 		self._msms_dict = defaultdict(dict)
 		self._msms_df = None
 
-		# define dataframe for each category
-		self._pivot_msms_df = None
-		self._msms_pivot_file = os.path.join(self._args.output_folder, 'pivot_msms.csv')
+		# the best PSMs in the long format: one row for each sequence and experiment,
+		# the wide layout (one column for each metric and experiment) is made only for the filtered peptides
+		self._psm_df = None
+		self._psm_file = os.path.join(self._args.output_folder, 'msms_psm.csv')
 
-		if not os.path.exists(self._msms_pivot_file):
+		if not os.path.exists(self._psm_file):
 			print("processing msms data")
 			# call class functions
 			self._read_experimental_design()
 			self._parse_msms()
-			self._pivot_msms_df.to_csv(self._msms_pivot_file, index=False)
+			CSV.write(self._psm_df, self._psm_file, sep=',')
 		else:
-			print("\033[1;31m %s pivot msms output file exists.." %(self._msms_pivot_file))
+			print("\033[1;31m %s msms PSM output file exists.." %(self._psm_file))
 			print(' to re-run msms module delete output files from %s' %(args.output_folder))
 			print('\x1b[6;30;42m' + '' + '\x1b[0m')
 
-			self._pivot_msms_df = pd.read_csv(self._msms_pivot_file, sep=',', engine='python')
+			self._psm_df = TableSchema.apply(CSV.read(self._psm_file, sep=','), 'maxquant_msms')
+
+	@staticmethod
+	def pivot_psms(psm_df, sequences=None):
+		""" makes the wide layout of PSMs: one column for each metric and experiment (as '<metric> <experiment>')
+
+		@args psm_df: PSMs in the long format (msms_psm.csv)
+		@type psm_df: pandas dataframe
+
+		@args sequences: sequences to be included, all sequences by default
+		@type sequences: list-like
+
+		"""
+
+		metrics = [col for col in psm_df.columns if col not in ['Sequence', 'Raw file']]
+
+		# the columns are the same as for the whole table: experiments in the order of appearance,
+		# without the experiments where a metric is missing
+		experiments = pd.unique(psm_df['Raw file'])
+		has_data = psm_df.groupby('Raw file', sort=False, observed=True)[metrics].count() > 0
+		columns = [(metric, exp) for metric in metrics for exp in experiments if has_data.at[exp, metric]]
+
+		if sequences is not None:
+			psm_df = psm_df[psm_df['Sequence'].isin(sequences)]
+
+		pivot_df = (psm_df.set_index(['Sequence', 'Raw file'])[metrics]
+			.astype(float)
+			.unstack('Raw file')
+			.reindex(columns=pd.MultiIndex.from_tuples(columns)))
+		pivot_df.columns = [' '.join(col).strip() for col in pivot_df.columns.values]
+
+		return pivot_df.reset_index()
 
 	def _calc_fragmentation(self, fragmentation_ions ,Sequence):
 		""" calculates spectra fragmentations
@@ -117,7 +152,7 @@ class msms:
 
 	def _parse_msms(self):
 		msms_file = os.path.join(self._args.input_folder, self._args.msms_file)
-		self._msms_df = pd.read_csv(msms_file, sep='\t', engine='python')
+		self._msms_df = TableSchema.apply(CSV.read(msms_file, sep='\t'), 'maxquant_msms')
 		self._msms_df = self._msms_df[self._msms_df['Length'] >= 8]  # HARD CODDED FILTER!!!
 
 		# ions = msms_df['Matches'][0]
@@ -173,7 +208,7 @@ class msms:
 
 		self._msms_df_get_max_score()
 
-		self._msms_df_get_Scan_numbers()
+		self._msms_df_get_PSMs()
 		return
 
 	def _msms_df_get_max_score(self):
@@ -181,17 +216,17 @@ class msms:
 		# get sample with best MaxQuant Score
 		if 'Score' in self._msms_df.columns:
 			# MaxQuant data
-			self._msms_df = self._msms_df.loc[self._msms_df.groupby(['Sequence', 'Raw file'])['Score'].idxmax()]
+			self._msms_df = self._msms_df.loc[self._msms_df.groupby(['Sequence', 'Raw file'], observed=True)['Score'].idxmax()]
 		elif 'Hyperscore' in self._msms_df.columns:
 			# MSFragger data
-			self._msms_df = self._msms_df.loc[self._msms_df.groupby(['Sequence', 'Raw file'])['Hyperscore'].idxmax()]
+			self._msms_df = self._msms_df.loc[self._msms_df.groupby(['Sequence', 'Raw file'], observed=True)['Hyperscore'].idxmax()]
 
 		return
 
 	def _make_column_names_from_exp_data(self, col_text):
 		col_names = [v + ' ' + col_text for v in self._exp_design_dict.values()]
 
-	def _msms_df_get_Scan_numbers(self):
+	def _msms_df_get_PSMs(self):
 		colnames = [
 			'Scan number',
 			'Score',
@@ -218,18 +253,14 @@ class msms:
 				'Expectation'
 			]
 
-		self._pivot_msms_df = pd.pivot_table(self._msms_df,
-				values=colnames,
-				index='Sequence',
-				columns='Raw file',
-				sort=False).reset_index()
-
-		self._pivot_msms_df.columns = [' '.join(col).strip() for col in self._pivot_msms_df.columns.values]
+		# only numeric metrics are reported (as by the mean aggregation of the former pivot table)
+		colnames = [col for col in colnames if pd.api.types.is_numeric_dtype(self._msms_df[col])]
+		self._psm_df = self._msms_df.loc[:, ['Sequence', 'Raw file'] + colnames]
 
 	def _read_experimental_design(self):
 		# exp_design_file = os.path.join(self._args.input_folder, self._args.exp_design_file)
 		exp_design_file = self._args.sample_desc_file
-		exp_design_df = pd.read_csv(exp_design_file, sep='\t', engine='python')
+		exp_design_df = TableSchema.apply(CSV.read(exp_design_file, sep='\t'), 'sample_description')
 		exp_design_df['Source_File'] = exp_design_df['Source_File'].apply(lambda x: re.sub(r'\.[^.]+$', '', x))
 
 		# convert the experimental design dataframe to dictionary
@@ -21,6 +21,10 @@ rpy2.rinterface_lib.callbacks.consolewrite_warnerror = lambda *args: None  # to
 
 sys.path.append('..')
 from FastFastaSearch import FastaSearch
+from filter_tables import get_netMHCpan_candidates
+from CSVtools import CSV
+from TableSchema import TableSchema
+from RunReport import RunReport
 
 
 # Class of different styles
@@ -73,11 +77,8 @@ class peptides:
         print(message)
         print(style.RESET)
 
-    def _add_fasta_db_search_column(self, column_name, db_name, db_fasta_file):
-        """ adds a column marking the existence of a peptide in a given fasta database
-
-        @args column_name: Name of column containing the peptides
-        @type column_name: str
+    def _get_search_engine(self, db_name, db_fasta_file):
+        """ returns the search engine for a given fasta database
 
         @args db_name: Name of database to be searched
         @type db_name: str
@@ -102,8 +103,76 @@ class peptides:
         """
 
         search_engine = FastaSearch()
-        search_engine.set_db(db_fasta_file, true_match=False)
-        self._peptides_df = search_engine.db_search(self._peptides_df, str(column_name), str(db_name), i2l_mode=False)
+        # peptides in the IMP length range are searched by the k-mer index, longer ones by the full-text index
+        # after the Bloom filter
+        search_engine.set_db(db_fasta_file, true_match=False, kmer_len=(8, self._args.max_len), bloom_fpr=0.01)
+
+        return search_engine
+
+    def _add_fasta_db_search_hits(self, search_engine, column_name, db_name, rows):
+        """ fills the column <db_name> with the database hits of the peptides in the selected rows
+
+        @args search_engine: FastaSearch instance of the database
+        @type search_engine: FastaSearch
+
+        @args column_name: Name of column containing the peptides
+        @type column_name: str
+
+        @args db_name: Name of database to be searched (and the column name)
+        @type db_name: str
+
+        @args rows: rows of the peptides to be searched
+        @type rows: pd.Series of bool
+
+        """
+
+        if not rows.any():
+            return
+
+        peptides = self._peptides_df.loc[rows, column_name]
+        with RunReport.section('database search'):
+            data = search_engine.db_search(pd.DataFrame({column_name: peptides.unique()}), column_name, db_name,
+                                           i2l_mode=False)
+        hits = peptides.map(dict(zip(data[column_name], data[db_name])))
+
+        # the same as the search of the whole column: the hits of a repeated peptide are repeated
+        counts = peptides.map(self._peptides_df[column_name].value_counts())
+        self._peptides_df.loc[rows, db_name] = [';'.join([x] * n) if x else x for x, n in zip(hits, counts)]
+
+    def _add_prioritized_db_search_columns(self, column_name):
+        """ adds nuORFs and CDS columns marking the existence of the I to L permutations in the fasta databases
+
+        the permutations are searched in the order of their priority (see filterTables._set_peptide_priority):
+        original sequences first, then the permutations which can still take precedence over them.
+        the permutations which can never pass the filter are not searched, their columns are left empty
+
+        @args column_name: Name of column containing the peptides
+        @type column_name: str
+
+        """
+
+        df = self._peptides_df
+        original = df['Permutation_Index'] == 0
+        df['nuORFs'] = ''
+        df['CDS'] = ''
+
+        nuORFs_engine = self._get_search_engine('nuORFs', self._args.nuORFdb_fasta_file)
+        CDS_engine = self._get_search_engine('CDS', self._args.CDS_fasta_file)
+
+        # original sequences: both columns are reported by the filter if the original takes precedence
+        self._add_fasta_db_search_hits(CDS_engine, column_name, 'CDS', original)
+        self._add_fasta_db_search_hits(nuORFs_engine, column_name, 'nuORFs', original)
+
+        # an original sequence found in CDS wins over all its permutations
+        resolved = df['Sequence'].isin(df.loc[original & (df['CDS'] != ''), 'Sequence'])
+        self._add_fasta_db_search_hits(CDS_engine, column_name, 'CDS', ~original & ~resolved)
+
+        # a permutation in CDS wins over the other permutations and the original sequence in nuORFs only:
+        # nuORFs hits are needed for permutations in CDS and if there is neither a CDS hit nor an original in nuORFs
+        in_CDS = df['Sequence'].isin(df.loc[df['CDS'] != '', 'Sequence'])
+        in_nuORFs = df['Sequence'].isin(df.loc[original & (df['nuORFs'] != ''), 'Sequence'])
+        self._add_fasta_db_search_hits(nuORFs_engine, column_name, 'nuORFs',
+                                       ~original & ((df['CDS'] != '') | (~in_CDS & ~in_nuORFs)))
 
     def _add_ssrc_column(self, column_name):
         """ adds a column with ssrc measure for hydrophobicity
@@ -136,7 +205,7 @@ class peptides:
     def _read_peptides(self):
         peptides_file = os.path.join(self._args.input_folder, self._args.peptides_file)
         if os.path.exists(peptides_file):
-            self._peptides_df = pd.read_csv(peptides_file, sep='\t', engine='python')
+            self._peptides_df = TableSchema.apply(CSV.read(peptides_file, sep='\t'), 'maxquant_peptides')
             self._peptides_df = self._peptides_df[self._peptides_df['Length'] >= 8]  # HARD CODDED FILTER!!!
 
             # Filter out peptides dataframe for Reverse/Decoy peptides
@@ -160,25 +229,24 @@ class peptides:
         if os.path.exists(self._IL_peptides_file):
 
             self._print_file_exists_message(self._IL_peptides_file)
-            self._peptides_df = pd.read_csv(self._IL_peptides_file, engine='python')
+            self._peptides_df = TableSchema.apply(CSV.read(self._IL_peptides_file, sep=','), 'maxquant_peptides')
         else:
 
             self._print_file_not_exists(self._IL_peptides_file)
-            self._I_to_L()
+            with RunReport.section('I2L expansion'):
+                self._I_to_L()
 
             # perform database search on all peptides including I to L
 
             # add ssrc hydrophobicity column
-            self._add_ssrc_column('Sequence_Permutations')
+            with RunReport.section('ssrc hydrophobicity'):
+                self._add_ssrc_column('Sequence_Permutations')
 
-            # add nuORFdb database search
-            self._add_fasta_db_search_column('Sequence_Permutations', 'nuORFs', self._args.nuORFdb_fasta_file)
-
-            # add CDS database search
-            self._add_fasta_db_search_column('Sequence_Permutations', 'CDS', self._args.CDS_fasta_file)
+            # add nuORFdb and CDS database search
+            self._add_prioritized_db_search_columns('Sequence_Permutations')
 
             # write peptides_df to cvs file
-            self._peptides_df.to_csv(self._IL_peptides_file, index=False)
+            CSV.write(self._peptides_df, self._IL_peptides_file, sep=',')
 
     def _I_to_L_permutations(self, Sequence):
         """ Generates I to L permutations from a given amino acid sequence
@@ -234,7 +302,9 @@ class peptides:
 
         dfs = []  # define list of dataframes
 
-        for i in range(len(self._peptides_df.index)):
+        n_peptides = len(self._peptides_df.index)
+        for i in range(n_peptides):
+            RunReport.progress('I to L permutations', i + 1, n_peptides)
             row = self._peptides_df.iloc[i]
             Sequence = row['Sequence']
 
@@ -263,7 +333,13 @@ class peptides:
     def _write_petides_for_netMHCpan(self):
         print('writing peptides.pep for netMHCpan')
         netMHCpan_peptides_file = os.path.join(self._args.output_folder, 'peptides.pep')
-        self._peptides_df['Sequence_Permutations'].to_csv(netMHCpan_peptides_file, header=False, index=False)
+
+        # the empty database hits of a new search are the same as the missing values of IL_peptides.csv
+        df = self._peptides_df.replace({'CDS': {'': np.nan}, 'nuORFs': {'': np.nan}})
+        candidates = get_netMHCpan_candidates(df, self._args.max_len)
+        print('%d of %d peptides are candidates for netMHCpan' % (candidates.sum(), len(candidates)))
+        CSV.write(self._peptides_df.loc[candidates, 'Sequence_Permutations'], netMHCpan_peptides_file, sep=',',
+                  header=False)
 
     def filter_peptides(self):
         # check if files exist:
@@ -280,7 +356,7 @@ class peptides:
             return
 
         # read unfiltered IMP file
-        df = pd.read_csv(IMP_unfiltered_file, sep=',', engine='python')
+        df = CSV.read(IMP_unfiltered_file, sep=',')
 
         # define database 'hits' status
         df['hits'] = self._get_I_to_L_hits(df)
@@ -300,4 +376,4 @@ class peptides:
         df.insert(4, 'nuORFs', df.pop('nuORFs'))
         df.insert(5, 'hits', df.pop('hits'))
 
-        df.to_csv(IMP_filtered_file, index=False)
+        CSV.write(df, IMP_filtered_file, sep=',')
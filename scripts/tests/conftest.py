@@ -0,0 +1,11 @@
+"""conftest.py: The scripts and IMP modules (src) are imported as they are imported by the pipeline"""
+
+__author__ = "Dmitry Malko"
+
+
+import os
+import sys
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SCRIPTS_DIR, 'src'))
+sys.path.insert(0, SCRIPTS_DIR)
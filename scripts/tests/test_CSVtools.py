@@ -0,0 +1,69 @@
+"""test_CSVtools.py: The tests of BGZF outputs, their block index and the float parsing"""
+
+__author__ = "Dmitry Malko"
+
+
+import os
+import numpy as np
+import pandas as pd
+import CSVtools
+from CSVtools import CSV
+
+
+def make_table(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'Sequence': ['PEPTIDE{}'.format(i) for i in range(n_rows)],
+                         'Score': np.round(rng.random(n_rows) * 100, 3), 'Scan': np.arange(n_rows)})
+
+# end of make_table()
+
+
+def test_row_ranges_of_indexed_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(CSV, '_chunk_size', 1000)
+    data = make_table(5000)
+    file_path = CSV.write(data, str(tmp_path / 'table.csv.gz'))
+    assert os.path.exists(file_path + '.idx') and CSV.get_row_count(file_path) == 5000
+    pd.testing.assert_frame_equal(CSV.read(file_path, rows=(1234, 3456)),
+                                  data.iloc[1234:3456].reset_index(drop=True))
+
+# end of test_row_ranges_of_indexed_file()
+
+
+def test_line_breaks_in_values_are_not_indexed(tmp_path, monkeypatch):
+    monkeypatch.setattr(CSV, '_chunk_size', 1000)
+    data = make_table(5000)
+    file_path = CSV.write(data, str(tmp_path / 'table.csv.gz'))
+
+    # the rows with quoted multi-line values are appended: the index of the file is removed
+    extra = make_table(3000, seed=1)
+    extra.loc[2500, 'Sequence'] = 'PEPTIDE\nWITH LINE BREAK'
+    CSV.write(extra, file_path, mode='a', header=False)
+    assert not os.path.exists(file_path + '.idx') and CSV.get_row_count(file_path) is None
+
+    expected = pd.concat([data, extra], ignore_index=True)
+    pd.testing.assert_frame_equal(CSV.read(file_path), expected)
+    pd.testing.assert_frame_equal(CSV.read(file_path, rows=(4000, 7000)),
+                                  expected.iloc[4000:7000].reset_index(drop=True))
+
+    # a new file with line breaks has no index
+    file_path = CSV.write(extra, str(tmp_path / 'extra.csv.gz'))
+    assert not os.path.exists(file_path + '.idx')
+    pd.testing.assert_frame_equal(CSV.read(file_path, rows=(2000, 3000)),
+                                  extra.iloc[2000:3000].reset_index(drop=True))
+
+# end of test_line_breaks_in_values_are_not_indexed()
+
+
+def test_floats_are_exact_on_both_parsers(tmp_path, monkeypatch):
+    rng = np.random.default_rng(2)
+    data = pd.DataFrame({'Value': rng.random(20000) * 10.0 ** rng.integers(-10, 10, 20000), 'Scan': np.arange(20000)})
+    file_path = CSV.write(data, str(tmp_path / 'table.csv.gz'))
+
+    # the default C float parser misses the exact value of some of these floats in the last digit
+    assert (pd.read_csv(file_path, sep='\t')['Value'] != data['Value']).any()
+    for engine in [CSVtools.ENGINE, None]:
+        monkeypatch.setattr(CSVtools, 'ENGINE', engine)
+        for threads in [1, 4]:  # the gzip stream and the blocks of the index
+            pd.testing.assert_frame_equal(CSV.read(file_path, threads=threads), data, check_exact=True)
+
+# end of test_floats_are_exact_on_both_parsers()
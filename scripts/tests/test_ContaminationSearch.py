@@ -0,0 +1,125 @@
+"""test_ContaminationSearch.py: The tests of the contaminant search and its cached index"""
+
+__author__ = "Dmitry Malko"
+
+
+import os
+import glob
+import random
+import pytest
+import pandas as pd
+from Bio import SeqIO
+import ContaminationSearch
+from ContaminationSearch import ContSearch
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def write_fasta(file_path, entries):
+    with open(file_path, 'w') as f:
+        for header, seq in entries:
+            f.write('>{}\n{}\n'.format(header, '\n'.join([seq[i:i + 60] for i in range(0, len(seq), 60)])))
+
+# end of write_fasta()
+
+
+def make_fasta_files(tmp_path, n_proteins=200, seed=0):
+    rng = random.Random(seed)
+    ref = [('sp|P{0}|G{0} desc'.format(i), ''.join(rng.choices(AMINO_ACIDS, k=rng.randint(30, 300))))
+           for i in range(n_proteins)]
+    contaminants = [('contam_K{} keratin'.format(i), ''.join(rng.choices(AMINO_ACIDS, k=rng.randint(30, 200))))
+                    for i in range(10)]
+    contaminants.append(('contam_COPY copy', contaminants[0][1][5:60]))  # a peptide is found in several entries
+    decoys = [('rev_' + header, seq[::-1]) for header, seq in ref]
+
+    ref_file, fas_file = str(tmp_path / 'ref.fasta'), str(tmp_path / 'ref.fasta.fas')
+    write_fasta(ref_file, ref)
+    write_fasta(fas_file, ref + contaminants + decoys)
+
+    peptides = [contaminants[0][1][10:25], contaminants[0][1][10:25], contaminants[1][1], 'A', '']
+    for entries in [ref, contaminants, decoys]:
+        for _ in range(300):
+            header, seq = rng.choice(entries)
+            k = rng.randint(5, min(40, len(seq)))
+            i = rng.randint(0, len(seq) - k)
+            peptides.append(seq[i:i + k])
+    peptides += [''.join(rng.choices(AMINO_ACIDS, k=rng.randint(7, 20))) for _ in range(300)]
+
+    return ref_file, fas_file, contaminants + decoys, peptides
+
+# end of make_fasta_files()
+
+
+def naive_search(peptides, entries):
+    # the reference result: the first position of each peptide in each contaminant entry
+    hits = {}
+    for pep in pd.Series(peptides).drop_duplicates():
+        if pep:
+            found = ['{}_{}/{}:{}'.format(pep, seq.find(pep) + 1, len(seq), header.split()[0])
+                     for header, seq in entries if pep in seq]
+            if found:
+                hits[pep] = ','.join(found)
+
+    return hits
+
+# end of naive_search()
+
+
+def test_search_equals_substring_search(tmp_path):
+    ref_file, fas_file, entries, peptides = make_fasta_files(tmp_path)
+    expected = naive_search(peptides, entries)
+
+    assert ContSearch(ref_file, fas_file).search(peptides) == expected
+    assert ContSearch(None, fas_file, ['rev_', 'contam_']).search(peptides) == expected
+    assert ContSearch(ref_file, fas_file).search(peptides) == expected  # from the cache
+
+    data = ContSearch(ref_file, fas_file).filter(pd.DataFrame({'Peptide Sequence': peptides}), 'Peptide Sequence')
+    assert not data['Peptide Sequence'].isin(list(expected.keys())).any()
+
+# end of test_search_equals_substring_search()
+
+
+def test_cache_depends_on_both_fasta_files(tmp_path):
+    ref_file, fas_file, entries, peptides = make_fasta_files(tmp_path)
+    cache_dir = ContSearch.get_cache_dir(ref_file, fas_file)
+    ContSearch(ref_file, fas_file)
+    assert os.path.isdir(cache_dir)
+
+    # another reference FASTA file: the whole MSFragger FASTA file is contaminated
+    other_ref_file = str(tmp_path / 'other.fasta')
+    write_fasta(other_ref_file, [('sp|X|Y', 'MMMMMMMMMM')])
+    assert ContSearch.get_cache_dir(other_ref_file, fas_file) != cache_dir
+    hits = ContSearch(other_ref_file, fas_file).search(peptides)
+    assert len(hits) > len(naive_search(peptides, entries))
+
+    # the reference FASTA file is replaced by an older one: the cache is rebuilt in the same directory
+    with open(fas_file) as f:
+        fas_entries = list(SeqIO.FastaIO.SimpleFastaParser(f))
+    mtime_ns = os.stat(ref_file).st_mtime_ns
+    write_fasta(ref_file, [(header, seq) for header, seq in fas_entries if header.startswith('contam_')])
+    os.utime(ref_file, ns=(mtime_ns - 10 ** 9, mtime_ns - 10 ** 9))
+    assert ContSearch.get_cache_dir(ref_file, fas_file) == cache_dir
+    hits = ContSearch(ref_file, fas_file).search(peptides)
+    assert hits == naive_search(peptides, [(header, seq) for header, seq in fas_entries
+                                           if not header.startswith('contam_')])
+    assert sorted(glob.glob(str(tmp_path / 'ref.fasta.contaminant*'))) == \
+        sorted([cache_dir, ContSearch.get_cache_dir(other_ref_file, fas_file)])
+
+# end of test_cache_depends_on_both_fasta_files()
+
+
+def test_interrupted_build_leaves_no_cache(tmp_path, monkeypatch):
+    ref_file, fas_file, entries, peptides = make_fasta_files(tmp_path)
+
+    def fail(self, index_dir):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(ContaminationSearch.KmerIndex, 'save', fail)
+    with pytest.raises(KeyboardInterrupt):
+        ContSearch(ref_file, fas_file)
+    assert not glob.glob(str(tmp_path / 'ref.fasta.contaminant*'))
+
+    monkeypatch.undo()
+    assert ContSearch(ref_file, fas_file).search(peptides) == naive_search(peptides, entries)
+
+# end of test_interrupted_build_leaves_no_cache()
@@ -0,0 +1,210 @@
+"""test_FastFastaSearch.py: The tests of the proteome store and the Bloom filter over the k-mers of the proteome"""
+
+__author__ = "Dmitry Malko"
+
+
+import os
+import random
+import pytest
+import pandas as pd
+import numpy as np
+from FastFastaSearch import ProteomeStore, KmerIndex, BloomFilter, PeptideMap
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWYX*'
+
+
+def write_fasta(fasta_file, n_proteins=300, seed=0):
+    rng = random.Random(seed)
+    sequences = [''.join(rng.choices(AMINO_ACIDS, k=rng.randint(3, 400))) for _ in range(n_proteins)]
+    with open(fasta_file, 'w') as f:
+        for i, seq in enumerate(sequences):
+            f.write('>P{} protein\n{}\n'.format(i, seq))
+
+    return sequences
+
+# end of write_fasta()
+
+
+def make_store(tmp_path, n_proteins=300, seed=0):
+    fasta_file = str(tmp_path / 'proteome.fasta')
+    sequences = write_fasta(fasta_file, n_proteins, seed)
+
+    return ProteomeStore.create(fasta_file, str(tmp_path / 'store')), sequences
+
+# end of make_store()
+
+
+def get_bits(bloom, sequences):
+    # the bits of all k-mers of the sequences set one by one in a bool array
+    bits = np.zeros(bloom._n_bits, dtype=bool)
+    kmers = [seq[i:i + bloom.k] for seq in sequences for i in range(len(seq) - bloom.k + 1)]
+    text = '\n'.join(kmers) + '\n'
+    codes = bloom._get_codes(bloom._lut[np.frombuffer(text.encode('ascii'), dtype=np.uint8)])
+    for bit_index in bloom._get_bit_index(codes[::bloom.k + 1]):
+        bits[bit_index] = True
+
+    return bits
+
+# end of get_bits()
+
+
+def test_bloom_filter_is_built_by_chunks(tmp_path, monkeypatch):
+    store, sequences = make_store(tmp_path)
+    for k in [3, 8, 12]:
+        monkeypatch.setattr(BloomFilter, '_chunk_size', 1000)  # many chunks, k-mers across the chunk borders
+        bloom = BloomFilter(k, 0.01).build(store)
+        bits = get_bits(bloom, sequences)
+        assert np.array_equal(np.unpackbits(bloom._bit_array, bitorder='little')[:bloom._n_bits], bits)
+        assert abs(bloom.fpr_estimated - bits.mean() ** bloom._n_hashes) < 1e-12
+
+        monkeypatch.setattr(BloomFilter, '_chunk_size', 1 << 20)
+        assert np.array_equal(BloomFilter(k, 0.01).build(store)._bit_array, bloom._bit_array)
+
+        # no false negatives: all peptides of the proteome are kept
+        peptides = [seq[i:i + 15] for seq in sequences for i in range(0, len(seq) - 15, 7)]
+        peptides = [peptide for peptide in peptides if peptide.isalpha()]
+        assert len(peptides) and bloom.contains(peptides).all()
+
+# end of test_bloom_filter_is_built_by_chunks()
+
+
+def test_store_is_replaced_when_fasta_changes(tmp_path, monkeypatch):
+    fasta_file = str(tmp_path / 'proteome.fasta')
+    sequences = write_fasta(fasta_file)
+    store = ProteomeStore.from_fasta(fasta_file)
+    assert ProteomeStore.from_fasta(fasta_file)._store_dir == fasta_file + '.store'
+
+    # the FASTA file is replaced by another one with an older modification time
+    mtime_ns = os.stat(fasta_file).st_mtime_ns
+    new_sequences = write_fasta(fasta_file, n_proteins=200, seed=1)
+    os.utime(fasta_file, ns=(mtime_ns - 10 ** 9, mtime_ns - 10 ** 9))
+    new_store = ProteomeStore.from_fasta(fasta_file)
+    assert list(new_store.sequences()) == new_sequences
+
+    # the store which is in use is not rewritten in place
+    assert list(store.sequences()) == sequences
+
+    # an interrupted run leaves the previous store and no temporary files
+    last_sequences = write_fasta(fasta_file, n_proteins=100, seed=2)
+
+    def interrupted_save(file_name, array):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(np, 'save', interrupted_save)
+    with pytest.raises(KeyboardInterrupt):
+        ProteomeStore.from_fasta(fasta_file)
+    assert sorted(os.listdir(str(tmp_path))) == ['proteome.fasta', 'proteome.fasta.store']
+    monkeypatch.undo()
+    assert list(ProteomeStore.from_fasta(fasta_file).sequences()) == last_sequences
+
+# end of test_store_is_replaced_when_fasta_changes()
+
+
+def replace_fasta(fasta_file, seed):
+    # the FASTA file is replaced by another one with an older modification time
+    mtime_ns = os.stat(fasta_file).st_mtime_ns
+    sequences = write_fasta(fasta_file, seed=seed)
+    os.utime(fasta_file, ns=(mtime_ns - 10 ** 9, mtime_ns - 10 ** 9))
+
+    return sequences
+
+# end of replace_fasta()
+
+
+def test_kmer_index_cache(tmp_path, monkeypatch):
+    fasta_file = str(tmp_path / 'proteome.fasta')
+    sequences = write_fasta(fasta_file)
+    peptides = [seq[10:19] for seq in sequences if len(seq) > 20 and seq[10:19].isalpha()]
+    kmer_index = KmerIndex(8, 14)
+    index_dir = kmer_index.get_index_dir(fasta_file)
+
+    # an interrupted save leaves no cache
+    save = np.save
+
+    def interrupted_save(file_name, array):
+        if os.path.basename(file_name) == 'positions.npy':
+            raise KeyboardInterrupt
+        save(file_name, array)
+
+    monkeypatch.setattr(np, 'save', interrupted_save)
+    with pytest.raises(KeyboardInterrupt):
+        kmer_index.set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file))
+    assert not os.path.exists(index_dir) and not [f for f in os.listdir(str(tmp_path)) if '.kmer' in f]
+    monkeypatch.undo()
+
+    query_index = kmer_index.set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file)).search(peptides)[0]
+    assert os.path.isdir(index_dir) and set(query_index) == set(range(len(peptides)))
+    loaded = KmerIndex(8, 14).set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file))
+    assert isinstance(loaded._codes, np.memmap) and np.array_equal(loaded._codes, kmer_index._codes)
+
+    new_sequences = replace_fasta(fasta_file, seed=1)
+    new_index = KmerIndex(8, 14).set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file))
+    assert not isinstance(new_index._codes, np.memmap)
+    seq_index, offsets = new_index.search(peptides)[1:]
+    assert all([new_sequences[i][offset:offset + 9] in peptides for i, offset in zip(seq_index, offsets)])
+
+# end of test_kmer_index_cache()
+
+
+def test_bloom_filter_cache(tmp_path, monkeypatch):
+    fasta_file = str(tmp_path / 'proteome.fasta')
+    write_fasta(fasta_file)
+    filter_file = BloomFilter(8, 0.01).get_filter_file(fasta_file)
+
+    # an interrupted save leaves no cache
+    def interrupted_savez(file, **arrays):
+        file.write(b'PK')
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(np, 'savez', interrupted_savez)
+    with pytest.raises(KeyboardInterrupt):
+        BloomFilter(8, 0.01).set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file))
+    assert not [f for f in os.listdir(str(tmp_path)) if '.bloom' in f]
+    monkeypatch.undo()
+
+    bloom = BloomFilter(8, 0.01).set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file))
+    assert os.path.exists(filter_file)
+    monkeypatch.setattr(BloomFilter, 'build', None)  # the filter is loaded from the cache
+    loaded = BloomFilter(8, 0.01).set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file))
+    assert np.array_equal(loaded._bit_array, bloom._bit_array) and loaded._n_hashes == bloom._n_hashes
+    monkeypatch.undo()
+
+    replace_fasta(fasta_file, seed=1)
+    store = ProteomeStore.from_fasta(fasta_file)
+    new_bloom = BloomFilter(8, 0.01).set_fasta(fasta_file, store)
+    assert np.array_equal(new_bloom._bit_array, BloomFilter(8, 0.01).build(store)._bit_array)
+    assert not np.array_equal(new_bloom._bit_array, bloom._bit_array)
+    assert np.array_equal(BloomFilter(8, 0.01).load(filter_file)._bit_array, new_bloom._bit_array)
+
+# end of test_bloom_filter_cache()
+
+
+def test_peptide_map_cache(tmp_path, monkeypatch):
+    fasta_file = str(tmp_path / 'proteome.fasta')
+    sequences = write_fasta(fasta_file)
+    map_file = PeptideMap.get_map_file(fasta_file)
+
+    # an interrupted save leaves no cache
+    def interrupted_to_pickle(obj, file_name):
+        with open(file_name, 'wb') as f:
+            f.write(b'\x80')
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(pd, 'to_pickle', interrupted_to_pickle)
+    with pytest.raises(KeyboardInterrupt):
+        PeptideMap().set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file))
+    assert not [f for f in os.listdir(str(tmp_path)) if '.peptides' in f]
+    monkeypatch.undo()
+
+    PeptideMap().set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file))
+    monkeypatch.setattr(PeptideMap, 'build', None)  # the map is loaded from the cache
+    hits = PeptideMap().set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file)).search(sequences[:5])
+    assert list(hits['Hit']) == ['{}:P{}'.format(seq, i) for i, seq in enumerate(sequences[:5])]
+    monkeypatch.undo()
+
+    new_sequences = replace_fasta(fasta_file, seed=1)
+    hits = PeptideMap().set_fasta(fasta_file, ProteomeStore.from_fasta(fasta_file)).search(new_sequences[:5])
+    assert list(hits['Hit']) == ['{}:P{}'.format(seq, i) for i, seq in enumerate(new_sequences[:5])]
+    assert os.path.exists(map_file) and not os.path.exists(map_file + '.tmp{}'.format(os.getpid()))
+
+# end of test_peptide_map_cache()
@@ -0,0 +1,98 @@
+"""test_MSF_combiner.py: The tests of the streaming pepXML reader of MSF_combiner.py"""
+
+__author__ = "Dmitry Malko"
+
+
+import os
+import tracemalloc
+import pandas as pd
+from MSF_combiner import FragPipeCombiner
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def get_peptide(i):
+    return ''.join([AMINO_ACIDS[(i * 7 + j * 3) % len(AMINO_ACIDS)] for j in range(9)])
+
+
+def write_pep_xml(file_path, n_queries):
+    # the top hit and a second hit of each query, the scan numbers are in spectrumNativeID
+    with open(file_path, 'w') as f:
+        f.write('<?xml version="1.0"?>\n<msms_pipeline_analysis xmlns="http://regis-web.systemsbiology.net/pepXML">'
+                '<msms_run_summary base_name="raw_0">\n')
+        for i in range(n_queries):
+            f.write('<spectrum_query spectrum="raw_0.{0}.{0}.2" spectrumNativeID="controllerType=0 '
+                    'controllerNumber=1 scan={0}" start_scan="{0}" end_scan="{0}" index="{0}"><search_result>'
+                    '<search_hit hit_rank="1" peptide="{1}"><search_score name="hyperscore" value="{2}"/>'
+                    '<search_score name="expect" value="0.01"/></search_hit>'
+                    '<search_hit hit_rank="2" peptide="AAAAAAAAA"><search_score name="hyperscore" value="1"/>'
+                    '</search_hit></search_result></spectrum_query>\n'.format(i + 1, get_peptide(i), i % 30))
+        f.write('</msms_run_summary></msms_pipeline_analysis>\n')
+
+# end of write_pep_xml()
+
+
+def get_parsing_peak(file_path):
+    # the peak of memory allocated while the records are streamed (the records are not kept)
+    tracemalloc.start()
+    n_records = sum(1 for _ in FragPipeCombiner.iter_pep_xml(file_path))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return n_records, peak
+
+# end of get_parsing_peak()
+
+
+def test_iter_pep_xml_memory_is_bounded(tmp_path):
+    small_file, large_file = str(tmp_path / 'small.pep.xml'), str(tmp_path / 'large.pep.xml')
+    write_pep_xml(small_file, 5000)
+    write_pep_xml(large_file, 50000)
+
+    n_small, peak_small = get_parsing_peak(small_file)
+    n_large, peak_large = get_parsing_peak(large_file)
+
+    assert (n_small, n_large) == (5000, 50000)
+    assert os.path.getsize(large_file) > 9 * os.path.getsize(small_file)
+    # the memory does not grow with the file (a tree of the whole file would take ~10 times more)
+    assert peak_large < 2 * peak_small + 1024 * 1024
+
+# end of test_iter_pep_xml_memory_is_bounded()
+
+
+def test_make_msms_xml_merges_top_hits(tmp_path):
+    n_queries = 2000
+    run_dir = tmp_path / 'raw_0'
+    run_dir.mkdir()
+    write_pep_xml(str(run_dir / 'interact-raw_0.pep.xml'), n_queries)
+
+    # PSMs of every second query, the last one has another peptide than the top hit of its query
+    scans = list(range(1, n_queries + 1, 2))
+    peptides = [get_peptide(scan - 1) for scan in scans]
+    peptides[-1] = 'CCCCCCCCC'
+    psm = pd.DataFrame({
+        'Spectrum': ['raw_0.{0:05d}.{0:05d}.2'.format(scan) for scan in scans],
+        'Spectrum File': 'interact-raw_0.pep.xml',
+        'Peptide': peptides,
+        'Peptide Length': 9,
+        'Charge': 2,
+        'Retention': 10.0,
+        'Calculated Peptide Mass': 1000.0,
+        'Expectation': 0.01,
+        'Hyperscore': 20.0,
+        'Nextscore': 10.0,
+        'PeptideProphet Probability': 0.99
+    })
+    psm.to_csv(run_dir / 'psm.tsv', sep='\t', index=False)
+
+    data = FragPipeCombiner(str(tmp_path)).make_msms_xml(threads=1)
+
+    assert len(data.index) == len(scans)
+    assert data['Scan'].tolist() == scans
+    matched = data.iloc[:-1]
+    assert (matched['Spectrum Native ID'] == 'controllerType=0 controllerNumber=1 scan=' +
+            matched['Scan'].astype(str)).all()
+    assert (matched['hyperscore'] == [(scan - 1) % 30 for scan in scans[:-1]]).all()
+    assert data.iloc[-1][['Spectrum Native ID', 'hyperscore', 'expect']].isna().all()  # no hit with the peptide
+
+# end of test_make_msms_xml_merges_top_hits()
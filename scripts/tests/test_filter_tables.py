@@ -0,0 +1,145 @@
+"""test_filter_tables.py: The tests of IMP filtering with the pruned netMHCpan input"""
+
+__author__ = "Dmitry Malko"
+
+
+import os
+import zlib
+import random
+import itertools
+import pytest
+import numpy as np
+import pandas as pd
+from argparse import Namespace
+from CSVtools import CSV
+from filter_tables import filterTables, get_netMHCpan_candidates
+
+MAX_LEN = 12
+ALLELES = ['HLA-A02:01', 'HLA-B07:02']
+
+
+def make_il_peptides(seed=0):
+    # I/L permutations of the sequences as in IL_peptides.csv: some sequences share their permutations,
+    # the lengths are around the length window 8..MAX_LEN
+    rng = random.Random(seed)
+    sequences = []
+    for length in [7, 8, 9, 11, MAX_LEN, MAX_LEN + 1]:
+        for _ in range(15):
+            seq = ''.join(rng.choices('ACDEGKNPQRSTVY', k=length - 2))
+            pos = sorted(rng.sample(range(length - 1), 2))
+            sequences.append(seq[:pos[0]] + 'I' + seq[pos[0]:pos[1]] + 'L' + seq[pos[1]:])
+            sequences.append(sequences[-1].replace('I', '#').replace('L', 'I').replace('#', 'L'))
+    sequences = sorted(set(sequences))
+
+    rows = []
+    for seq in sequences:
+        il_index = [i for i, aa in enumerate(seq) if aa in 'IL']
+        permutations = []
+        for letters in itertools.product('IL', repeat=len(il_index)):
+            perm = list(seq)
+            for i, aa in zip(il_index, letters):
+                perm[i] = aa
+            permutations.append(''.join(perm))
+        permutations.remove(seq)
+        for i, perm in enumerate([seq] + permutations):
+            hit = zlib.crc32(perm.encode()) % 5
+            rows.append({'Sequence': seq, 'Length': len(seq), 'Score': rng.randint(50, 200),
+                         'Sequence_Permutations': perm, 'Permutation_Index': i,
+                         'CDS': 'CDS_{}'.format(perm) if hit == 0 else np.nan,
+                         'nuORFs': 'nuORF_{}'.format(perm) if hit in [1, 2] else np.nan})
+
+    return pd.DataFrame(rows)
+
+# end of make_il_peptides()
+
+
+def predict_binding(peptides):
+    # a deterministic stand-in for netMHCpan: one output row for each line of peptides.pep
+    ranks = np.array([[zlib.crc32((allele + peptide).encode()) % 400 / 100 for allele in ALLELES]
+                      for peptide in peptides])
+    data = pd.DataFrame({'Peptide': list(peptides)})
+    for i, allele in enumerate(ALLELES):
+        data[allele + ' EL_Rank'] = ranks[:, i]
+    data['HLA rank'] = ranks.min(axis=1)
+    data['HLA Allele'] = np.array(ALLELES)[ranks.argmin(axis=1)]
+    data['HLA affinity'] = np.select([data['HLA rank'] < 0.5, data['HLA rank'] <= 2.0], ['SB', 'WB'], default='')
+    for i, allele in enumerate(ALLELES):
+        data[allele + ' Aff(nM)'] = np.round(50000 ** (1 - ranks[:, i] / 4), 2)
+
+    return data
+
+# end of predict_binding()
+
+
+def write_inputs(output_folder, peptides_df, pep_peptides):
+    os.makedirs(output_folder)
+    CSV.write(peptides_df, os.path.join(output_folder, 'IL_peptides.csv'), sep=',')
+    CSV.write(predict_binding(pep_peptides), os.path.join(output_folder, 'netMHCpan_HLA_affinity.csv'), sep=',')
+    psms = pd.DataFrame({'Sequence': np.repeat(peptides_df['Sequence'].unique(), 2)})
+    psms['Raw file'] = np.where(np.arange(len(psms.index)) % 2, 'raw_2', 'raw_1')
+    psms['Score'] = np.arange(len(psms.index)) % 97
+    CSV.write(psms, os.path.join(output_folder, 'msms_psm.csv'), sep=',')
+
+# end of write_inputs()
+
+
+def run_filter(output_folder, peptides_df, pep_peptides):
+    write_inputs(output_folder, peptides_df, pep_peptides)
+    args = Namespace(output_folder=output_folder, max_len=MAX_LEN, unfiltered=False)
+    filterTables(args).filter_MQ_netMHCpan_peptides(chunk_size=50)
+
+    with open(os.path.join(output_folder, 'IMP_filtered.csv'), 'rb') as f:
+        return f.read()
+
+# end of run_filter()
+
+
+def test_pruned_netMHCpan_input_gives_the_same_output(tmp_path):
+    peptides_df = make_il_peptides()
+    assert peptides_df['Sequence_Permutations'].duplicated().any()  # repeated permutations
+
+    candidates = get_netMHCpan_candidates(peptides_df, MAX_LEN)
+    assert 0 < candidates.sum() < len(candidates)
+    full = run_filter(str(tmp_path / 'full'), peptides_df, peptides_df['Sequence_Permutations'])
+    pruned = run_filter(str(tmp_path / 'pruned'), peptides_df, peptides_df.loc[candidates, 'Sequence_Permutations'])
+    assert full == pruned
+
+    # the filtered peptides cover the edges of the length window and the repeated permutations
+    filtered = CSV.read(str(tmp_path / 'full' / 'IMP_filtered.csv'))
+    assert set(filtered['Length']) >= {8, MAX_LEN} and filtered['Length'].between(8, MAX_LEN).all()
+    assert filtered['Sequence_Permutations'].isin(
+        peptides_df.loc[peptides_df['Sequence_Permutations'].duplicated(), 'Sequence_Permutations']).any()
+
+# end of test_pruned_netMHCpan_input_gives_the_same_output()
+
+
+def test_interrupted_filter_leaves_no_output(tmp_path, monkeypatch):
+    peptides_df = make_il_peptides()
+    output_folder = str(tmp_path / 'output')
+    write_inputs(output_folder, peptides_df, peptides_df['Sequence_Permutations'])
+    args = Namespace(output_folder=output_folder, max_len=MAX_LEN, unfiltered=True)
+
+    export = filterTables._export_filtered_peptides
+    calls = []
+
+    def interrupted_export(self, df, psm_df):
+        calls.append(len(df.index))
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        return export(self, df, psm_df)
+
+    monkeypatch.setattr(filterTables, '_export_filtered_peptides', interrupted_export)
+    with pytest.raises(KeyboardInterrupt):
+        filterTables(args).filter_MQ_netMHCpan_peptides(chunk_size=50)
+    for file_name in ['IMP_filtered.csv', 'IMP_unfiltered.csv']:
+        assert not os.path.exists(os.path.join(output_folder, file_name))
+
+    # the step is not skipped by the next run
+    monkeypatch.setattr(filterTables, '_export_filtered_peptides', export)
+    filterTables(args).filter_MQ_netMHCpan_peptides(chunk_size=50)
+    unfiltered = CSV.read(os.path.join(output_folder, 'IMP_unfiltered.csv'))
+    assert set(unfiltered['Sequence_Permutations']) == set(peptides_df['Sequence_Permutations'])
+    filtered = CSV.read(os.path.join(output_folder, 'IMP_filtered.csv'))
+    assert len(filtered.index) and not os.path.exists(os.path.join(output_folder, 'IMP_filtered.csv.tmp'))
+
+# end of test_interrupted_filter_leaves_no_output()
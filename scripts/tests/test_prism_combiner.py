@@ -0,0 +1,98 @@
+"""test_prism_combiner.py: The tests of the categories, partitions and the stored state of PRISM combiner"""
+
+__author__ = "Dmitry Malko"
+
+
+import os
+import re
+import glob
+import pytest
+import pandas as pd
+from CSVtools import CSV
+from TableSchema import TableSchema
+from benchmark import SyntheticData
+from prism_combiner import get_categories, Partitions, update_state
+
+CAT_ALIASES = ['frameshift', 'prio1', 'prio2', 'prio3']
+FILES = ['prism/frameshift.S1.pep.annotated.csv.gz', 'prism/prio1.S1.pep.annotated.csv.gz',
+         'prism/prio2.S1.pep.annotated.csv.gz']
+
+
+def test_decoy_categories():
+    # the same categories for targets and decoys: both kinds of peptides are kept from each file
+    assert get_categories(FILES, CAT_ALIASES) == [('frameshift', None), ('prio1', None), ('prio2', None)]
+    assert get_categories(FILES, CAT_ALIASES, CAT_ALIASES) == [('frameshift', None), ('prio1', None),
+                                                                ('prio2', None)]
+
+    # prio1 files give decoy peptides only (MetaPept.sh: -cat frameshift prio2 prio3 -decoy_cat ... prio1 ...)
+    assert get_categories(FILES, ['frameshift', 'prio2', 'prio3'], CAT_ALIASES) == [('frameshift', None),
+                                                                                     ('prio1', True),
+                                                                                     ('prio2', None)]
+    assert get_categories(FILES, ['frameshift', 'prio1'], ['prio2']) == [('frameshift', False), ('prio1', False),
+                                                                         ('prio2', True)]
+    with pytest.raises(ValueError):
+        get_categories(FILES, ['frameshift'], ['prio3'])
+
+# end of test_decoy_categories()
+
+
+def test_partitions_release_spilled_data(tmp_path):
+    data = pd.DataFrame({'Group': ['G1', 'G2'] * 500, 'Sequence': ['PEPTIDE{}'.format(i % 97) for i in range(1000)],
+                         'Value': range(1000)})
+    partitions = Partitions(n_buckets=4, mem_limit=1, tmp_dir=str(tmp_path / 'partitions'))
+    partitions.add(data)  # the memory limit is exceeded: the partitions are spilled
+    assert not len(partitions._buffers) and len(partitions._spilled)
+
+    partitions._mem_limit = None
+    partitions.add(data)  # the same partitions are buffered in memory
+    assert len(partitions._buffers)
+
+    for group in partitions.groups():
+        rows = pd.concat(list(partitions.get(group)))
+        expected = pd.concat([data, data])
+        expected = expected[expected['Group'] == group]
+        assert sorted(rows['Value']) == sorted(expected['Value'])
+        # the spilled data are not accumulated in the buffers, the taken partitions are released
+        assert not any([key[0] == group for key in partitions._buffers])
+    assert not len(partitions._buffers) and partitions._buffer_size == 0
+
+    partitions.clear()
+    assert not (tmp_path / 'partitions').exists()
+
+# end of test_partitions_release_spilled_data()
+
+
+def test_state_is_reset_when_categories_change(tmp_path, capsys):
+    data = SyntheticData(str(tmp_path / 'data'), 200, raw_files=2)
+    data.make_proteome()
+    data.make_peptides()
+    data.make_description()
+    data.make_psms()
+    data.make_prism()
+    file_paths = sorted(glob.glob(str(tmp_path / 'data' / 'prism' / '*.pep.annotated.csv.gz')))
+    sample_file = str(tmp_path / 'data' / 'sample_description.csv')
+    sample_description = CSV.read(sample_file)
+    TableSchema.apply(sample_description, 'sample_description')
+    state_dir = str(tmp_path / 'state')
+
+    def update(cat_aliases, decoy_cat_aliases=None):
+        index = update_state(file_paths, sample_file, sample_description, cat_aliases, state_dir, True, 1,
+                             decoy_cat_aliases)
+        return index, int(re.search(r'(\d+) new or changed files', capsys.readouterr().out).group(1))
+
+    index, n_new = update(['frameshift', 'prio2'])
+    assert n_new == len(file_paths)
+    index, n_new = update(['frameshift', 'prio2'])
+    assert n_new == 0
+
+    # the prio2 files give target peptides only with the decoy categories, all files are processed again
+    index, n_new = update(['frameshift', 'prio2'], ['frameshift'])
+    assert n_new == len(file_paths)
+    assert index['cat_aliases'] == {'target': ['frameshift', 'prio2'], 'decoy': ['frameshift']}
+    for file_path, entry in index['files'].items():
+        for state_file in entry['groups'].values():
+            state = pd.read_pickle(os.path.join(state_dir, state_file))
+            assert (state['decoy'] is None) == (os.path.basename(file_path).startswith('prio2'))
+    assert len(os.listdir(state_dir)) == 1 + sum([len(entry['groups']) for entry in index['files'].values()])
+
+# end of test_state_is_reset_when_categories_change()
@@ -0,0 +1,88 @@
+"""test_scan_combiner.py: The tests of the IMP scan combiner"""
+
+__author__ = "Dmitry Malko"
+
+
+import sqlite3
+import pytest
+import numpy as np
+import pandas as pd
+from CSVtools import CSV
+from scan_combiner import combine
+
+EXPERIMENTS = ['S1 1 HLA-I', 'S1 2 HLA-I', 'S2 1 HLA-I', 'S2 2 HLA-I']
+SAMPLE_TYPES = ['wt', 'wt', 'ko', 'ko']
+
+
+def write_description(file_path, n_samples=4):
+    description = pd.DataFrame({'Source_File': ['raw_{}.raw'.format(i) for i in range(4)],
+                                'Sample_Name': ['S1', 'S1', 'S2', 'S2'], 'Sample_Replica': [1, 2, 1, 2],
+                                'Sample_Type': SAMPLE_TYPES, 'Group': 'G1', 'Experiment': EXPERIMENTS})
+
+    return CSV.write(description.head(n_samples), file_path)
+
+# end of write_description()
+
+
+def write_imp_table(file_path, scans, first=0, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(scans)
+    data = pd.DataFrame({'Sequence': ['PEPTIDE{}K'.format(i) for i in range(first, first + n)], 'Length': 9,
+                         'hits': -5})
+    for i, experiment in enumerate(EXPERIMENTS):
+        data['Scan number ' + experiment] = np.where(scans[:, i] > 0, scans[:, i], np.nan)
+        data['Score ' + experiment] = np.round(rng.random(n) * 100, 2)
+
+    return CSV.write(data, file_path, sep=',')
+
+# end of write_imp_table()
+
+
+def test_status_over_sequence(tmp_path):
+    description_file = write_description(str(tmp_path / 'sample_description.csv'))
+    rng = np.random.default_rng(0)
+    scans = rng.integers(1, 1000, (50, 4)) * (rng.random((50, 4)) < 0.4)
+    imp_file = write_imp_table(str(tmp_path / 'IMP_scan_validation.csv'), scans)
+
+    combined = combine([imp_file], ['A_effect'], description_file, str(tmp_path / 'combined.csv'))
+
+    # the column names are normalized by regular expressions: Scan number S1 1 HLA-I -> Scan_number_S1_1_HLA_I
+    assert 'Scan_number_S1_1_HLA_I' in combined.columns
+    expected = [','.join(sorted(set([SAMPLE_TYPES[i] for i in range(4) if row[i] > 0]))) for row in scans]
+    assert list(combined['IMP_Status_over_sequence'].fillna('')) == expected
+    assert len(set(expected)) > 2
+
+# end of test_status_over_sequence()
+
+
+def test_failed_update_leaves_the_store_unchanged(tmp_path):
+    description_file = write_description(str(tmp_path / 'sample_description.csv'))
+    rng = np.random.default_rng(1)
+    scans = rng.integers(1, 1000, (40, 4)) * (rng.random((40, 4)) < 0.5)
+    scans[:, 2:] = 0  # the first experiment has the samples S1 only
+    first_file = write_imp_table(str(tmp_path / 'E1.csv'), scans[:30])
+    second_file = write_imp_table(str(tmp_path / 'E2.csv'), scans[20:] + [[0, 0, 7, 0]], first=20, seed=1)
+    db_file = str(tmp_path / 'combined.db')
+    combine([first_file], ['E1'], description_file, str(tmp_path / 'combined.csv'), db_file)
+
+    def read_store():
+        with sqlite3.connect(db_file) as connector:
+            return [pd.read_sql('SELECT * FROM {}'.format(table), connector)
+                    for table in ['experiments', 'sequences', 'combine']]
+
+    stored = read_store()
+
+    # the sample S2 is missing in the description: the status of the new sequences can't be found
+    short_description_file = write_description(str(tmp_path / 'short_description.csv'), n_samples=2)
+    with pytest.raises(IndexError):
+        combine([second_file], ['E2'], short_description_file, str(tmp_path / 'combined.csv'), db_file, update=True)
+    for table, table_stored in zip(read_store(), stored):
+        pd.testing.assert_frame_equal(table, table_stored)
+
+    # the experiment can be added again, the result is the same as the result of the whole combining
+    updated = combine([second_file], ['E2'], description_file, str(tmp_path / 'combined.csv'), db_file, update=True)
+    combined = combine([first_file, second_file], ['E1', 'E2'], description_file, str(tmp_path / 'all.csv'))
+    pd.testing.assert_frame_equal(updated, combined)
+    assert list(combined['Experiment'].iloc[20:30]) == ['E1,E2'] * 10
+
+# end of test_failed_update_leaves_the_store_unchanged()